@@ -31,6 +31,30 @@ def create_app(config_name=None):
     mail.init_app(app)
     cache.init_app(app)
     
+    # Per-family cache counters, summed over workers
+    from . import cache_metrics
+    cache_metrics.init_app(app, cache)
+    
+    # Evict local cache copies invalidated by other workers
+    from . import cache_bus
+    cache_bus.init_app(app)
+    
+    # Answer 404s for unknown slugs/handles without a query
+    from . import negative_cache
+    negative_cache.init_app(app)
+    
+    # Warm each worker's cache once it starts serving
+    from . import cache_warmup
+    cache_warmup.init_app(app)
+    
+    # Live viewers, summed over workers
+    from . import live_viewers
+    live_viewers.init_app(app)
+    
+    # Reference-counted, content-addressed uploads
+    from . import upload_store
+    upload_store.init_app(app)
+    
     # Configure Flask-Login
     login_manager.login_view = 'auth.login'
     login_manager.login_message = 'Por favor inicia sesión para acceder a esta página.'
@@ -49,9 +73,14 @@ def create_app(config_name=None):
     @app.context_processor
     def inject_timezone_utils():
         from .timezone_utils import format_local_datetime, now_local
+        from .image_derivatives import responsive_image, srcset
+        from .image_resize import resized_url
         return {
             'format_local_datetime': format_local_datetime,
-            'now_local': now_local
+            'now_local': now_local,
+            'responsive_image': responsive_image,
+            'image_srcset': srcset,
+            'resized_image_url': resized_url
         }
     
     # Register blueprints
@@ -70,6 +99,9 @@ def create_app(config_name=None):
     from .api import bp as api_bp
     app.register_blueprint(api_bp)
 
+    from .image_resize import bp as image_resize_bp
+    app.register_blueprint(image_resize_bp)
+
     from .api_mobile import bp as api_mobile_bp
     from .csrf_utils import csrf_exempt_mobile
     csrf_exempt_mobile(csrf, api_mobile_bp)   # Debe ir ANTES del register_blueprint
@@ -1,11 +1,13 @@
 from flask import render_template, redirect, url_for, flash, request
-from flask_login import login_required
+from flask_login import login_required, current_user
 from ..models import User, Card, Theme, CardView
 from .. import db
 from . import bp
 from .forms import UserForm, NewUserForm, ThemeForm
 from ..utils import admin_required
+from ..cache_utils import CacheManager
 from datetime import datetime
+from sqlalchemy.orm import undefer_group
 
 @bp.route('/')
 @login_required
@@ -18,7 +20,7 @@ def index():
     total_cards = Card.query.count()
     public_cards = Card.query.filter_by(is_public=True).count()
     private_cards = total_cards - public_cards
-    total_views = CardView.query.count()
+    total_views = db.session.query(db.func.coalesce(db.func.sum(Card.views_total), 0)).scalar()
     
     stats = {
         'total_users': total_users,
@@ -158,6 +160,7 @@ def edit_theme(id):
         theme.avatar_shape = form.avatar_shape.data
         
         db.session.commit()
+        CacheManager.invalidate_theme(theme.id)
         flash(f'¡Tema "{theme.name}" actualizado exitosamente!', 'success')
         return redirect(url_for('admin.themes'))
     
@@ -173,8 +176,10 @@ def delete_theme(id):
         flash('No se puede eliminar un tema que está siendo usado por tarjetas.', 'error')
         return redirect(url_for('admin.themes'))
     
+    theme_id = theme.id
     db.session.delete(theme)
     db.session.commit()
+    CacheManager.invalidate_theme(theme_id)
     
     flash(f'Tema "{theme.name}" eliminado exitosamente.', 'success')
     return redirect(url_for('admin.themes'))
@@ -207,7 +212,10 @@ def cards():
         page=page, per_page=20, error_out=False
     )
     
-    return render_template('admin/cards.html', cards=cards, search=search, status=status)
+    unique_views = Card.unique_views_by_card([card.id for card in cards.items])
+    
+    return render_template('admin/cards.html', cards=cards, search=search, status=status,
+                           unique_views=unique_views)
 
 @bp.route('/cards/<int:id>/views')
 @login_required
@@ -216,7 +224,7 @@ def card_views(id):
     card = Card.query.get_or_404(id)
     page = request.args.get('page', 1, type=int)
     
-    views = card.views.order_by(CardView.viewed_at.desc()).paginate(
+    views = card.views.options(undefer_group('dimensions')).order_by(CardView.viewed_at.desc()).paginate(
         page=page, per_page=50, error_out=False
     )
     
@@ -245,6 +253,7 @@ def suspend_user(id):
     user.suspend(reason, current_user)
     
     db.session.commit()
+    CacheManager.invalidate_user(user.id)
     flash(f'Usuario {user.email} suspendido correctamente', 'success')
     return redirect(url_for('admin.users'))
 
@@ -257,6 +266,7 @@ def unsuspend_user(id):
     
     user.unsuspend()
     db.session.commit()
+    CacheManager.invalidate_user(user.id)
     flash(f'Suspensión removida para {user.email}', 'success')
     return redirect(url_for('admin.users'))
 
@@ -394,11 +404,13 @@ def toggle_tickets(id):
         )
         db.session.add(ticket_system)
         db.session.commit()
+        CacheManager.invalidate_user(user.id)
         flash(f'Sistema de turnos activado para {user.email}', 'success')
     else:
         # Toggle del estado
         user.ticket_system.is_enabled = not user.ticket_system.is_enabled
         db.session.commit()
+        CacheManager.invalidate_user(user.id)
         status = 'activado' if user.ticket_system.is_enabled else 'desactivado'
         flash(f'Sistema de turnos {status} para {user.email}', 'success')
 
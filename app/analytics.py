@@ -1,9 +1,13 @@
 from flask import request, current_app
 from datetime import datetime, timedelta
 from sqlalchemy import func, desc, and_, or_
-from .models import Card, CardView, User
-from . import db, cache
+from .models import Card, CardView, CardViewDaily, User, ViewDimension
+from . import db
 from .timezone_utils import now_utc_for_db, get_date_range_utc, get_month_range_utc
+from .geoip import lookup_ip
+from .view_storage import encode_view_fields, hash_ip
+from .leaderboard import get_top_cards
+from .analytics_cache import cached_analytics, invalidate_all
 import json
 from collections import defaultdict
 
@@ -12,17 +16,22 @@ class AnalyticsService:
     """Service for handling analytics and metrics"""
     
     @staticmethod
-    @cache.memoize(timeout=300)  # Cache for 5 minutes
+    @cached_analytics('card', timeout=300)  # Fresh for 5 minutes
     def get_card_analytics(card_id, days=30):
         """Get comprehensive analytics for a specific card"""
         start_date, end_date = get_date_range_utc(days)
         
-        # Basic metrics
-        total_views = CardView.query.filter_by(card_id=card_id).count()
+        # Basic metrics (views are deduplicated per session window, raw_views counts every hit).
+        # Days past the retention window only survive as card_view_daily aggregates.
+        archived_views, archived_hits, _ = CardViewDaily.archived_totals([card_id])
+        total_views = CardView.query.filter_by(card_id=card_id).count() + archived_views
+        raw_views = db.session.query(func.coalesce(func.sum(CardView.hits), 0)).filter(
+            CardView.card_id == card_id
+        ).scalar() + archived_hits
         period_views = CardView.query.filter(
             CardView.card_id == card_id,
             CardView.viewed_at >= start_date
-        ).count()
+        ).count() + CardViewDaily.archived_totals([card_id], since=start_date)[0]
         
         # Daily views for chart
         daily_views = db.session.query(
@@ -32,6 +41,10 @@ class AnalyticsService:
             CardView.card_id == card_id,
             CardView.viewed_at >= start_date
         ).group_by(func.date(CardView.viewed_at)).all()
+        archived_daily = CardViewDaily.query.filter(
+            CardViewDaily.card_id == card_id,
+            CardViewDaily.day >= start_date.date()
+        ).all()
         
         # Device analytics
         device_stats = db.session.query(
@@ -42,14 +55,17 @@ class AnalyticsService:
             CardView.viewed_at >= start_date
         ).group_by(CardView.device_type).all()
         
-        # Browser analytics
+        # Browser analytics (interned names, legacy column for rows not yet compacted)
+        browser_name = func.coalesce(ViewDimension.value, CardView.legacy_browser)
         browser_stats = db.session.query(
-            CardView.browser,
+            browser_name.label('browser'),
             func.count(CardView.id).label('count')
+        ).outerjoin(
+            ViewDimension, ViewDimension.id == CardView.browser_id
         ).filter(
             CardView.card_id == card_id,
             CardView.viewed_at >= start_date
-        ).group_by(CardView.browser).all()
+        ).group_by(browser_name).all()
         
         # Location analytics (if available)
         location_stats = db.session.query(
@@ -81,9 +97,11 @@ class AnalyticsService:
         
         return {
             'total_views': total_views,
+            'raw_views': int(raw_views),
             'period_views': period_views,
             'views_today': views_today,
-            'daily_views': [{'date': str(d.date), 'views': d.views} for d in daily_views],
+            'daily_views': [{'date': str(d.day), 'views': d.views} for d in archived_daily]
+                           + [{'date': str(d.date), 'views': d.views} for d in daily_views],
             'device_stats': [{'device': d.device_type or 'Unknown', 'count': d.count} for d in device_stats],
             'browser_stats': [{'browser': b.browser or 'Unknown', 'count': b.count} for b in browser_stats],
             'location_stats': [{'country': l.country or 'Unknown', 'count': l.count} for l in location_stats],
@@ -91,7 +109,7 @@ class AnalyticsService:
         }
     
     @staticmethod
-    @cache.memoize(timeout=600)  # Cache for 10 minutes
+    @cached_analytics('user', timeout=600)  # Fresh for 10 minutes
     def get_user_analytics(user_id, days=30):
         """Get analytics for all user's cards"""
         start_date, end_date = get_date_range_utc(days)
@@ -103,17 +121,22 @@ class AnalyticsService:
         if not card_ids:
             return {
                 'total_views': 0,
+                'raw_views': 0,
                 'period_views': 0,
                 'cards_analytics': [],
                 'top_performing_card': None
             }
         
         # Total views across all cards
-        total_views = CardView.query.filter(CardView.card_id.in_(card_ids)).count()
+        archived_views, archived_hits, _ = CardViewDaily.archived_totals(card_ids)
+        total_views = CardView.query.filter(CardView.card_id.in_(card_ids)).count() + archived_views
+        raw_views = db.session.query(func.coalesce(func.sum(CardView.hits), 0)).filter(
+            CardView.card_id.in_(card_ids)
+        ).scalar() + archived_hits
         period_views = CardView.query.filter(
             CardView.card_id.in_(card_ids),
             CardView.viewed_at >= start_date
-        ).count()
+        ).count() + CardViewDaily.archived_totals(card_ids, since=start_date)[0]
         
         # Individual card performance
         cards_performance = db.session.query(
@@ -141,6 +164,7 @@ class AnalyticsService:
         
         return {
             'total_views': total_views,
+            'raw_views': int(raw_views),
             'period_views': period_views,
             'cards_analytics': cards_analytics,
             'top_performing_card': {
@@ -151,7 +175,7 @@ class AnalyticsService:
         }
     
     @staticmethod
-    @cache.memoize(timeout=300)
+    @cached_analytics('global', timeout=300)
     def get_global_analytics(days=30):
         """Get platform-wide analytics (admin only)"""
         start_date, end_date = get_date_range_utc(days)
@@ -161,21 +185,16 @@ class AnalyticsService:
         active_users = User.query.filter_by(is_active=True).count()
         total_cards = Card.query.count()
         public_cards = Card.query.filter_by(is_public=True).count()
-        total_views = CardView.query.count()
+        total_views = CardView.query.count() + CardViewDaily.archived_totals()[0]
         
         # Growth metrics
         new_users = User.query.filter(User.created_at >= start_date).count()
         new_cards = Card.query.filter(Card.created_at >= start_date).count()
-        period_views = CardView.query.filter(CardView.viewed_at >= start_date).count()
+        period_views = (CardView.query.filter(CardView.viewed_at >= start_date).count()
+                        + CardViewDaily.archived_totals(since=start_date)[0])
         
-        # Top cards
-        top_cards = db.session.query(
-            Card.name,
-            Card.slug,
-            func.count(CardView.id).label('views')
-        ).join(CardView, Card.id == CardView.card_id)\
-         .group_by(Card.id, Card.name, Card.slug)\
-         .order_by(desc('views')).limit(10).all()
+        # Top cards come from the maintained leaderboard, not a scan of card_view
+        top_cards = get_top_cards('all', 10)
         
         return {
             'total_users': total_users,
@@ -186,11 +205,11 @@ class AnalyticsService:
             'new_users': new_users,
             'new_cards': new_cards,
             'period_views': period_views,
-            'top_cards': [{'name': c.name, 'slug': c.slug, 'views': c.views} for c in top_cards]
+            'top_cards': [{'name': c['name'], 'slug': c['slug'], 'views': c['views']} for c in top_cards]
         }
     
     @staticmethod
-    def track_card_view(card, request):
+    def track_card_view(card, request, session_id=None):
         """Enhanced view tracking with device and location info"""
         user_agent = request.user_agent
         user_agent_string = str(user_agent)
@@ -198,26 +217,42 @@ class AnalyticsService:
         # Enhanced device detection
         device_type = AnalyticsService._detect_device_type(user_agent, user_agent_string)
         
-        # Get IP for geolocation (you'd implement actual geolocation service)
-        ip_address = request.environ.get('HTTP_X_FORWARDED_FOR') or request.environ.get('REMOTE_ADDR')
+        ip_address = AnalyticsService.get_client_ip(request)
+        
+        # Local range-table lookup (no network call); None when not configured
+        country, city = lookup_ip(ip_address)
+        
+        # Repeated strings are stored as dimension ids, the IP only as a keyed hash
+        dimensions = encode_view_fields(
+            db.session,
+            user_agent=user_agent_string,
+            referrer=request.referrer,
+            browser=user_agent.browser,
+            platform=user_agent.platform
+        )
         
         view = CardView(
             card_id=card.id,
-            ip_address=ip_address,
-            user_agent=str(user_agent),
+            ip_hash=hash_ip(ip_address),
             device_type=device_type,
-            browser=user_agent.browser,
-            platform=user_agent.platform,
-            viewed_at=now_utc_for_db()
+            country=country,
+            city=city,
+            session_id=session_id,
+            viewed_at=now_utc_for_db(),
+            **dimensions
         )
         
-        # You could add geolocation lookup here
-        # view.country = get_country_from_ip(ip_address)
-        # view.city = get_city_from_ip(ip_address)
-        
         db.session.add(view)
         return view
     
+    @staticmethod
+    def get_client_ip(request):
+        """First hop of X-Forwarded-For, falling back to the socket address"""
+        forwarded = request.environ.get('HTTP_X_FORWARDED_FOR')
+        if forwarded:
+            return forwarded.split(',')[0].strip()[:45]
+        return request.environ.get('REMOTE_ADDR')
+    
     @staticmethod
     def _detect_device_type(user_agent, user_agent_string):
         """Enhanced device type detection"""
@@ -265,7 +300,7 @@ class AnalyticsService:
         return 'desktop'
     
     @staticmethod
-    @cache.memoize(timeout=300)
+    @cached_analytics('card', timeout=300)
     def get_device_analytics(card_id=None, days=30):
         """Get detailed device analytics with mobile vs desktop breakdown"""
         start_date, end_date = get_date_range_utc(days)
@@ -329,7 +364,7 @@ class AnalyticsService:
         }
     
     @staticmethod
-    @cache.memoize(timeout=600)
+    @cached_analytics('card', timeout=600)
     def get_hourly_device_pattern(card_id=None, days=7):
         """Get device usage patterns by hour of day"""
         start_date, end_date = get_date_range_utc(days)
@@ -365,8 +400,8 @@ class AnalyticsService:
     
     @staticmethod
     def clear_cache():
-        """Clear analytics cache"""
-        cache.clear()
+        """Mark every cached analytics result stale (other cache entries are kept)"""
+        invalidate_all()
 
 
 def get_analytics_summary(card_id, days=7):
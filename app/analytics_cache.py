@@ -0,0 +1,222 @@
+"""
+Namespaced analytics memoization with explicit invalidation.
+
+Results are cached per namespace: one card, one user, or the global
+admin view. Each namespace has a version counter, and so does the whole
+analytics cache. A cached entry records the versions it was computed
+under:
+
+- fresh: versions match and the entry is younger than its timeout. It is
+  returned as is. Near the timeout, a read may start the refresh early
+  (see cache_stampede.should_refresh).
+- stale: the versions moved (new views, edits) or the timeout passed, but
+  the entry is still within ``ANALYTICS_CACHE_STALE_TTL``. It is returned
+  immediately and a background thread recomputes it. A shared lock keeps
+  that to one worker.
+- missing: computed synchronously, once. Concurrent callers in this
+  worker, and in other workers, wait for that result.
+
+New views bump only the affected card, its owner and the global
+namespace, in batches from the view counter flush. Dashboards therefore
+load from cache and catch up within one refresh.
+"""
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import cache, cache_bus
+from .cache_stampede import acquire_lock, release_lock, should_refresh, single_flight, wait_for_value
+
+KEY_PREFIX = 'analytics'
+ALL_NAMESPACES = 'all'
+
+_executor = None
+_executor_lock = threading.Lock()
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+def _config(name, default):
+    from flask import current_app
+    return current_app.config.get(name, default)
+
+
+def namespace(scope, object_id=None):
+    """'card:12', 'user:3' or 'global'"""
+    return f'{scope}:{object_id}' if object_id is not None else 'global'
+
+
+def _version_key(ns):
+    return f'{KEY_PREFIX}_version:{ns}'
+
+
+def bump(*namespaces):
+    """Invalidate every entry cached under the given namespaces"""
+    keys = [_version_key(ns) for ns in set(namespaces)]
+    for key in keys:
+        try:
+            # Never goes back in time, even if the counter was evicted. Two
+            # concurrent bumps may land on the same value; both still differ
+            # from what cached entries were computed under.
+            version = max((cache.get(key) or 0) + 1, int(time.time() * 1000))
+            cache.set(key, version, timeout=0)
+        except Exception:
+            pass
+    # Other workers may hold the old counters in their local tier
+    cache_bus.publish(*keys)
+
+
+def get_versions(ns):
+    values = cache.get_many(_version_key(ALL_NAMESPACES), _version_key(ns))
+    return tuple(value or 0 for value in values)
+
+
+def invalidate_card(card_id, owner_id=None):
+    """A card's analytics changed; its owner's and the global view change too"""
+    namespaces = [namespace('card', card_id), namespace('global')]
+    if owner_id is not None:
+        namespaces.append(namespace('user', owner_id))
+    bump(*namespaces)
+
+
+def invalidate_cards(session, card_ids):
+    """Bump the namespaces of several cards and their owners at once"""
+    from .models import Card
+
+    if not card_ids:
+        return
+    owners = {owner_id for (owner_id,) in session.query(Card.owner_id).filter(Card.id.in_(list(card_ids)))}
+    bump(namespace('global'),
+         *[namespace('card', card_id) for card_id in card_ids],
+         *[namespace('user', owner_id) for owner_id in owners])
+
+
+def invalidate_user(user_id):
+    bump(namespace('user', user_id), namespace('global'))
+
+
+def invalidate_all():
+    """Make every cached analytics result stale at once"""
+    bump(ALL_NAMESPACES)
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=_config('ANALYTICS_REFRESH_WORKERS', 2),
+                    thread_name_prefix='analytics-refresh'
+                )
+    return _executor
+
+
+def _store(key, versions, value, timeout, delta=0.0):
+    entry = {'versions': versions, 'computed_at': time.time(), 'timeout': timeout, 'delta': delta, 'value': value}
+    cache.set(key, entry, timeout=timeout + _config('ANALYTICS_CACHE_STALE_TTL', 3600))
+
+
+def _compute_and_store(key, ns, compute, timeout, versions=None):
+    if versions is None:
+        versions = get_versions(ns)
+    started = time.time()
+    value = compute()
+    _store(key, versions, value, timeout, delta=time.time() - started)
+    return value
+
+
+def _refresh_in_background(key, ns, compute, timeout):
+    """Recompute an entry once per key across workers, off the request thread"""
+    from flask import current_app
+
+    with _refreshing_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+    if not acquire_lock(key):
+        # Another worker is already refreshing it
+        with _refreshing_lock:
+            _refreshing.discard(key)
+        return
+    app = current_app._get_current_object()
+
+    def run():
+        try:
+            with app.app_context():
+                _compute_and_store(key, ns, compute, timeout)
+        except Exception as e:
+            print(f"Analytics refresh failed for {key}: {e}")
+        finally:
+            with app.app_context():
+                release_lock(key)
+            with _refreshing_lock:
+                _refreshing.discard(key)
+
+    try:
+        _get_executor().submit(run)
+    except Exception:
+        release_lock(key)
+        with _refreshing_lock:
+            _refreshing.discard(key)
+
+
+def cached_analytics(scope, timeout=300):
+    """Memoize an analytics function in the namespace of its first argument.
+
+    ``scope`` is 'card' or 'user' (first argument is the id; None means the
+    global view) or 'global'.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            object_id = None
+            if scope != 'global':
+                object_id = args[0] if args else kwargs.get(f'{scope}_id')
+            ns = namespace(scope, object_id) if object_id is not None else namespace('global')
+            arguments = ','.join([repr(a) for a in args] + [f'{k}={v!r}' for k, v in sorted(kwargs.items())])
+            key = f'{KEY_PREFIX}:{ns}:{f.__name__}({arguments})'
+
+            def compute():
+                return f(*args, **kwargs)
+
+            try:
+                versions = get_versions(ns)
+                entry = cache.get(key)
+            except Exception:
+                return compute()
+
+            if entry is not None:
+                # Refreshed a little early, at random, so hot entries rarely go stale
+                fresh = (tuple(entry['versions']) == versions
+                         and not should_refresh(entry['computed_at'], entry['timeout'], entry.get('delta', 0)))
+                if not fresh:
+                    _refresh_in_background(key, ns, compute, timeout)
+                return entry['value']
+
+            def fill():
+                # Missing everywhere: one thread of one worker computes it
+                locked = acquire_lock(key)
+                if not locked:
+                    entry = wait_for_value(key, _config('CACHE_LOCK_WAIT', 2))
+                    if entry is not None:
+                        return entry['value']
+                try:
+                    return _compute_and_store(key, ns, compute, timeout, versions)
+                finally:
+                    if locked:
+                        release_lock(key)
+
+            try:
+                leader, value = single_flight(key, fill)
+            except Exception:
+                return compute()
+            if leader:
+                return value
+            entry = cache.get(key)
+            return entry['value'] if entry is not None else compute()
+
+        wrapper.uncached = f
+        return wrapper
+    return decorator
@@ -335,7 +335,8 @@ def upload_service_image(current_user, service_id):
         return jsonify({'error': 'Archivo inválido'}), 400
 
     from .utils import save_image
-    filename, _ = save_image(file, 'static/uploads')
+    from .image_jobs import status_of
+    filename, _ = save_image(file, 'static/uploads', user_id=current_user.id)
     if not filename:
         return jsonify({'error': 'Error al procesar la imagen'}), 400
 
@@ -343,6 +344,7 @@ def upload_service_image(current_user, service_id):
     db.session.commit()
     return jsonify({
         'image_path': f"/static/uploads/{filename}",
+        'image_status': status_of(filename),
         'message': 'Imagen subida'
     })
 
@@ -575,44 +577,21 @@ def toggle_accepting(current_user):
 @token_required
 def analytics_summary(current_user):
     """Resumen de analíticas para todas las tarjetas."""
-    from .models import CardView
-    from .timezone_utils import today_start_utc, get_month_range_utc
-
-    card_ids = [c.id for c in current_user.cards.all()]
-    day_start = today_start_utc()
-    month_start, month_end = get_month_range_utc()
-
-    total = CardView.query.filter(CardView.card_id.in_(card_ids)).count()
-    today_views = CardView.query.filter(
-        CardView.card_id.in_(card_ids),
-        CardView.viewed_at >= day_start
-    ).count()
-    month_views = CardView.query.filter(
-        CardView.card_id.in_(card_ids),
-        CardView.viewed_at >= month_start,
-        CardView.viewed_at <= month_end
-    ).count()
+    cards = current_user.cards.all()
 
-    # Per-card stats
-    per_card = []
-    for card in current_user.cards.all():
-        card_total = CardView.query.filter_by(card_id=card.id).count()
-        card_today = CardView.query.filter(
-            CardView.card_id == card.id,
-            CardView.viewed_at >= day_start
-        ).count()
-        per_card.append({
-            'card_id': card.id,
-            'card_name': card.name,
-            'card_slug': card.slug,
-            'total': card_total,
-            'today': card_today,
-        })
+    # Contadores mantenidos en Card (sin COUNT sobre card_view)
+    per_card = [{
+        'card_id': card.id,
+        'card_name': card.name,
+        'card_slug': card.slug,
+        'total': card.get_total_views(),
+        'today': card.get_views_today(),
+    } for card in cards]
 
     return jsonify({
-        'total': total,
-        'today': today_views,
-        'this_month': month_views,
+        'total': sum(c['total'] for c in per_card),
+        'today': sum(c['today'] for c in per_card),
+        'this_month': sum(card.get_views_this_month() for card in cards),
         'per_card': per_card,
     })
 
@@ -641,18 +620,13 @@ def list_gallery(current_user, card_id):
 @token_required
 def dashboard(current_user):
     """Resumen del dashboard."""
-    from .models import CardView, Appointment
-    from .timezone_utils import today_start_utc
+    from .models import Appointment
 
     cards = current_user.cards.all()
     card_ids = [c.id for c in cards]
-    day_start = today_start_utc()
 
-    # Views today
-    views_today = CardView.query.filter(
-        CardView.card_id.in_(card_ids),
-        CardView.viewed_at >= day_start
-    ).count() if card_ids else 0
+    # Views today (contador mantenido en Card)
+    views_today = sum(card.get_views_today() for card in cards)
 
     # Pending appointments
     pending_apts = Appointment.query.filter(
@@ -767,8 +741,9 @@ def upload_avatar(current_user, card_id):
         return jsonify({'error': 'Archivo inválido'}), 400
 
     from .utils import save_avatar
+    from .image_jobs import status_of
     try:
-        square_filename, rect_filename = save_avatar(file)
+        square_filename, rect_filename = save_avatar(file, user_id=current_user.id)
         if not square_filename:
             return jsonify({'error': 'Error al procesar la imagen'}), 400
         card.avatar_square_path = square_filename
@@ -777,6 +752,7 @@ def upload_avatar(current_user, card_id):
         db.session.commit()
         return jsonify({
             'avatar_url': f"/static/uploads/{square_filename}",
+            'image_status': status_of(square_filename),
             'message': 'Avatar actualizado'
         })
     except Exception as e:
@@ -814,8 +790,9 @@ def upload_gallery_image(current_user, card_id):
         return jsonify({'error': 'Archivo inválido'}), 400
 
     from .utils import save_image
+    from .image_jobs import status_of
     try:
-        filename, thumb_filename = save_image(file, 'static/uploads')
+        filename, thumb_filename = save_image(file, 'static/uploads', user_id=current_user.id)
         if not filename:
             return jsonify({'error': 'Error al procesar la imagen'}), 400
         caption = request.form.get('caption', '')
@@ -833,6 +810,7 @@ def upload_gallery_image(current_user, card_id):
             'image_url': f"/static/uploads/{item.image_path}",
             'thumb_url': f"/static/thumbs/{item.thumbnail_path}" if item.thumbnail_path else None,
             'caption': item.caption,
+            'image_status': status_of(item.image_path),
         }), 201
     except Exception as e:
         return jsonify({'error': str(e)}), 400
@@ -967,7 +945,8 @@ def upload_product_image(current_user, product_id):
         return jsonify({'error': 'Archivo inválido'}), 400
 
     from .utils import save_image
-    filename, _ = save_image(file, 'static/uploads')
+    from .image_jobs import status_of
+    filename, _ = save_image(file, 'static/uploads', user_id=current_user.id)
     if not filename:
         return jsonify({'error': 'Error al procesar la imagen'}), 400
 
@@ -975,10 +954,23 @@ def upload_product_image(current_user, product_id):
     db.session.commit()
     return jsonify({
         'image_url': f"/static/uploads/{filename}",
+        'image_status': status_of(filename),
         'message': 'Imagen subida'
     })
 
 
+@bp.route('/images/status', methods=['GET'])
+@token_required
+def image_status(current_user):
+    """Estado del procesamiento de una imagen subida (?file=<nombre devuelto al subir>)."""
+    from .image_jobs import status_payload
+    from .upload_store import job_filename
+    filename = job_filename(request.args.get('file', ''))
+    if not filename:
+        return jsonify({'error': 'Parámetro file requerido'}), 400
+    return jsonify(status_payload(filename, current_user.id))
+
+
 @bp.route('/products/<int:product_id>/image', methods=['DELETE'])
 @token_required
 def delete_product_image(current_user, product_id):
@@ -0,0 +1,296 @@
+"""
+Streaming full and incremental backups.
+
+A backup is a single NDJSON stream (optionally gzip-compressed on the fly):
+
+    {"type": "manifest", "mode": "full" | "incremental", "since": ..., "started_at": ..., "tables": [...]}
+    {"type": "row", "table": "user", "row": {...}}
+    ...
+    {"type": "end", "started_at": ..., "finished_at": ..., "counts": {...}}
+
+Tables are written in foreign-key order straight from ``db.metadata``, so
+every model is included. Each table is read with a server-side cursor, so
+memory use stays flat. Incremental backups keep rows changed since a
+timestamp: ``updated_at`` (falling back to ``created_at``) for editable
+models, ``viewed_at`` / ``day`` for the view tables. Tables without an
+``updated_at`` column are small and always exported in full, since their
+rows can be edited without leaving a trace. Deletions are not captured;
+take a full backup periodically.
+
+Only ``flask backup-export`` writes credentials (password hashes, tokens,
+key hashes). The download from the admin dashboard is redacted: those
+columns and the SSO token table are left out and the manifest is marked
+``redacted``, so it cannot be restored over live accounts.
+"""
+import base64
+import gzip
+import json
+import zlib
+from datetime import date, datetime, time
+from decimal import Decimal
+
+from sqlalchemy import func, select, text
+
+from .write_buffer import upsert
+
+BACKUP_FORMAT = 'vcard-backup'
+BACKUP_VERSION = 1
+
+# Append-only or day-bucketed tables and the column that tells when a row changed
+CHANGE_COLUMNS = {
+    'card_view': 'viewed_at',
+    'card_view_daily': 'day',
+    'card_view_counter': 'day',
+}
+
+# Credentials and secrets left out of redacted (browser) backups
+SECRET_COLUMNS = {
+    'user': ('password_hash', 'reset_token', 'reset_token_expires', 'mobile_token'),
+    'ticket': ('cancellation_token',),
+    'push_subscription': ('endpoint', 'p256dh', 'auth'),
+    'partner_api_keys': ('key_hash',),
+}
+SECRET_TABLES = ('sso_tokens',)
+
+
+def backup_tables(session):
+    """Model tables in foreign-key order, skipping those missing from this database"""
+    from sqlalchemy import inspect
+    from . import db
+    existing = set(inspect(session.get_bind()).get_table_names())
+    return [table for table in db.metadata.sorted_tables if table.name in existing]
+
+
+def _change_filter(table, since):
+    """WHERE clause for rows changed since `since`, or None to export the whole table"""
+    name = CHANGE_COLUMNS.get(table.name)
+    if name is not None:
+        column = table.c[name]
+        return column >= (since.date() if name == 'day' else since)
+    if 'updated_at' in table.c:
+        if 'created_at' in table.c:
+            return func.coalesce(table.c.updated_at, table.c.created_at) >= since
+        return table.c.updated_at >= since
+    return None
+
+
+def _encode(value):
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode('ascii')
+    return value
+
+
+def _exported_columns(table, redact):
+    secret = SECRET_COLUMNS.get(table.name, ()) if redact else ()
+    return [column for column in table.c if column.name not in secret]
+
+
+def iter_backup_lines(session, since=None, batch_size=1000, report=None, redact=False):
+    """Yield the backup as NDJSON lines; `report` receives the manifest and end records.
+    `redact` leaves out credentials (see SECRET_COLUMNS)"""
+    started_at = datetime.utcnow().isoformat()
+    tables = backup_tables(session)
+    if redact:
+        tables = [table for table in tables if table.name not in SECRET_TABLES]
+    manifest = {
+        'type': 'manifest',
+        'format': BACKUP_FORMAT,
+        'version': BACKUP_VERSION,
+        'mode': 'incremental' if since else 'full',
+        'since': since.isoformat() if since else None,
+        'started_at': started_at,
+        'redacted': redact,
+        'tables': [table.name for table in tables],
+    }
+    yield json.dumps(manifest) + '\n'
+
+    counts = {}
+    for table in tables:
+        query = select(*_exported_columns(table, redact)).order_by(*table.primary_key.columns)
+        condition = _change_filter(table, since) if since else None
+        if condition is not None:
+            query = query.where(condition)
+
+        result = session.execute(query.execution_options(stream_results=True, yield_per=batch_size))
+        count = 0
+        for row in result.mappings():
+            yield json.dumps({
+                'type': 'row',
+                'table': table.name,
+                'row': {key: _encode(value) for key, value in row.items()},
+            }, ensure_ascii=False) + '\n'
+            count += 1
+        counts[table.name] = count
+
+    end = {
+        'type': 'end',
+        'started_at': started_at,
+        'finished_at': datetime.utcnow().isoformat(),
+        'counts': counts,
+    }
+    if report is not None:
+        report.update(manifest=manifest, end=end)
+    yield json.dumps(end) + '\n'
+
+
+def iter_backup_chunks(session, since=None, compress=False, chunk_bytes=64 * 1024, report=None, redact=False):
+    """Group backup lines into ~64 KB chunks, gzip-compressed on the fly if asked"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    buffer = []
+    size = 0
+    for line in iter_backup_lines(session, since=since, report=report, redact=redact):
+        data = line.encode('utf-8')
+        buffer.append(data)
+        size += len(data)
+        if size >= chunk_bytes:
+            block = b''.join(buffer)
+            buffer, size = [], 0
+            block = compressor.compress(block) if compressor else block
+            if block:
+                yield block
+    block = b''.join(buffer)
+    if compressor:
+        block = compressor.compress(block) + compressor.flush()
+    if block:
+        yield block
+
+
+def read_manifest(path):
+    """Manifest and end records of an existing backup file"""
+    manifest = end = None
+    for record in _iter_records(path):
+        if record.get('type') == 'manifest':
+            manifest = record
+        elif record.get('type') == 'end':
+            end = record
+    return manifest, end
+
+
+def _iter_records(path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def _decoder(column):
+    python_type = None
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        pass
+
+    if python_type is datetime:
+        return datetime.fromisoformat
+    if python_type is date:
+        return date.fromisoformat
+    if python_type is time:
+        return time.fromisoformat
+    if python_type is Decimal:
+        return Decimal
+    if python_type is bytes:
+        return base64.b64decode
+    return None
+
+
+def _upsert(connection, table, rows):
+    """Insert rows, replacing those whose primary key already exists"""
+    keys = [column.name for column in table.primary_key.columns]
+    upsert(connection, table, rows, key=keys,
+           replace=[column.name for column in table.c if column.name not in keys])
+
+
+def _clear_caches():
+    """Restored rows bypass the ORM events that keep caches and slug filters current"""
+    from . import cache, cache_bus, negative_cache
+    try:
+        cache.clear()
+        negative_cache.get_slug_filter().reset()
+        cache_bus.publish('*')  # every other worker drops its local copies and rebuilds its slug filter
+    except Exception as e:
+        print(f"Cache clear after restore failed: {e}")
+
+
+def restore_backup(session, path, batch_size=1000, progress=None):
+    """Bulk-load a backup file; rows already present are overwritten"""
+    tables = {table.name: table for table in backup_tables(session)}
+    decoders = {
+        name: {column.name: _decoder(column) for column in table.c}
+        for name, table in tables.items()
+    }
+    session.close()
+    # One connection throughout: FOREIGN_KEY_CHECKS is a session variable
+    try:
+        with session.get_bind().connect() as connection:
+            return _restore(connection, tables, decoders, path, batch_size, progress)
+    finally:
+        _clear_caches()  # committed batches of a failed restore too
+
+
+def _restore(connection, tables, decoders, path, batch_size, progress):
+    dialect = connection.dialect.name
+    if dialect == 'mysql':
+        connection.execute(text('SET FOREIGN_KEY_CHECKS = 0'))
+        connection.commit()
+
+    counts = {}
+    skipped = 0
+    manifest = end = None
+    batch_table, batch = None, []
+
+    def write():
+        if batch:
+            _upsert(connection, tables[batch_table], batch)
+            connection.commit()
+            counts[batch_table] = counts.get(batch_table, 0) + len(batch)
+            if progress:
+                progress(batch_table, counts[batch_table])
+
+    try:
+        for record in _iter_records(path):
+            kind = record.get('type')
+            if kind == 'manifest':
+                if record.get('format') != BACKUP_FORMAT:
+                    raise ValueError(f'{path} is not a {BACKUP_FORMAT} file')
+                if record.get('redacted'):
+                    raise ValueError(f'{path} is a redacted download; restore from a flask backup-export file')
+                manifest = record
+                continue
+            if kind == 'end':
+                end = record
+                continue
+
+            name = record.get('table')
+            if name not in tables:
+                skipped += 1
+                continue
+            if name != batch_table or len(batch) >= batch_size:
+                write()
+                batch_table, batch = name, []
+
+            row = {}
+            for key, value in record['row'].items():
+                if key not in decoders[name]:
+                    continue
+                decode = decoders[name][key]
+                row[key] = decode(value) if decode and value is not None else value
+            batch.append(row)
+        write()
+    finally:
+        connection.rollback()  # a batch that failed
+        if dialect == 'mysql':
+            connection.execute(text('SET FOREIGN_KEY_CHECKS = 1'))
+            connection.commit()
+
+    return {
+        'manifest': manifest,
+        'complete': end is not None,
+        'counts': counts,
+        'skipped': skipped,
+    }
@@ -0,0 +1,185 @@
+"""
+Pre-ingestion filter that keeps bots, link previews and prefetches out of card_view.
+
+Classification is done entirely in memory: one compiled regex over the
+User-Agent, a sorted table of known crawler IP ranges searched with bisect,
+and header checks for HEAD/prefetch requests. Filtered hits never reach the
+database; they are tallied in per-worker counters instead.
+"""
+import bisect
+import ipaddress
+import re
+import threading
+from collections import Counter
+
+# Link-preview bots, crawlers, uptime monitors and HTTP libraries
+BOT_UA_PATTERNS = [
+    r'(?<!cu)bot\b', r'crawl', r'spider', r'slurp', r'archiver', r'scrape',
+    r'facebookexternalhit', r'facebot', r'whatsapp/', r'telegrambot', r'twitterbot',
+    r'linkedinbot', r'slackbot', r'slack-imgproxy', r'discordbot', r'skypeuripreview',
+    r'pinterest', r'redditbot', r'embedly', r'quora link preview', r'vkshare',
+    r'google-inspectiontool', r'googleother', r'mediapartners-google', r'adsbot',
+    r'bingpreview', r'applebot', r'yandex', r'baiduspider', r'duckduckbot', r'petalbot',
+    r'uptimerobot', r'pingdom', r'statuscake', r'site24x7', r'newrelicpinger',
+    r'better uptime', r'hetrixtools', r'monitor', r'gtmetrix', r'lighthouse',
+    r'pagespeed', r'headlesschrome', r'phantomjs', r'python-requests', r'python-urllib',
+    r'aiohttp', r'httpx', r'curl/', r'wget/', r'go-http-client', r'okhttp', r'java/',
+    r'libwww', r'apache-httpclient', r'axios/', r'node-fetch', r'undici', r'postmanruntime',
+]
+BOT_UA_REGEX = re.compile('|'.join(BOT_UA_PATTERNS), re.IGNORECASE)
+
+# Published crawler ranges (Google, Bing, Meta, Yandex, Baidu, Apple)
+KNOWN_CRAWLER_RANGES = [
+    '66.249.64.0/19', '64.233.160.0/19', '72.14.199.0/24', '2001:4860:4801::/48',
+    '40.77.167.0/24', '157.55.39.0/24', '207.46.13.0/24', '52.167.144.0/24',
+    '69.63.176.0/20', '66.220.144.0/20', '31.13.24.0/21', '31.13.64.0/18',
+    '173.252.64.0/18', '69.171.224.0/19', '2a03:2880::/32',
+    '5.255.253.0/24', '77.88.5.0/24', '95.108.213.0/24', '213.180.203.0/24',
+    '180.76.15.0/24', '220.181.108.0/24', '17.241.0.0/16',
+]
+
+PREFETCH_HEADERS = {
+    'Purpose': ('prefetch', 'preview'),
+    'Sec-Purpose': ('prefetch', 'prerender'),
+    'X-Purpose': ('preview', 'prefetch'),
+    'X-Moz': ('prefetch',),
+}
+
+# Rough size of a card_view row without its variable-length strings
+ROW_OVERHEAD_BYTES = 96
+
+
+class IPRangeSet:
+    """Sorted, merged IP ranges with O(log n) membership checks."""
+
+    def __init__(self, cidrs=()):
+        self._networks = {4: [], 6: []}
+        self._starts = {4: [], 6: []}
+        self._ends = {4: [], 6: []}
+        self.update(cidrs)
+
+    def update(self, cidrs):
+        for cidr in cidrs:
+            try:
+                network = ipaddress.ip_network(cidr.strip(), strict=False)
+            except ValueError:
+                continue
+            self._networks[network.version].append(network)
+
+        for version, networks in self._networks.items():
+            collapsed = list(ipaddress.collapse_addresses(networks))
+            self._networks[version] = collapsed
+            self._starts[version] = [int(n.network_address) for n in collapsed]
+            self._ends[version] = [int(n.broadcast_address) for n in collapsed]
+
+    def __contains__(self, ip_string):
+        try:
+            ip = ipaddress.ip_address(ip_string)
+        except ValueError:
+            return False
+        if ip.version == 6 and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+        value = int(ip)
+        index = bisect.bisect_right(self._starts[ip.version], value) - 1
+        return index >= 0 and value <= self._ends[ip.version][index]
+
+    def __len__(self):
+        return len(self._starts[4]) + len(self._starts[6])
+
+
+class BotFilter:
+    """Classifies incoming card hits and counts what was filtered out"""
+
+    def __init__(self, extra_ranges=()):
+        self.crawler_ranges = IPRangeSet(KNOWN_CRAWLER_RANGES)
+        if extra_ranges:
+            self.crawler_ranges.update(extra_ranges)
+        self._lock = threading.Lock()
+        self._reasons = Counter()
+        self._per_card = Counter()
+        self._accepted = 0
+        self._bytes_avoided = 0
+
+    @staticmethod
+    def classify(request, ip_address=None, ranges=None):
+        """Return the reason a hit should be ignored, or None for a real visitor"""
+        if request.method == 'HEAD':
+            return 'head'
+
+        for header, values in PREFETCH_HEADERS.items():
+            value = request.headers.get(header)
+            if value and value.split(';')[0].strip().lower() in values:
+                return 'prefetch'
+
+        user_agent = request.headers.get('User-Agent', '')
+        if not user_agent.strip():
+            return 'empty_user_agent'
+        if BOT_UA_REGEX.search(user_agent):
+            return 'user_agent'
+
+        if ip_address and ranges is not None and ip_address in ranges:
+            return 'crawler_ip'
+
+        return None
+
+    def check(self, request, card_id, ip_address=None):
+        """Classify and tally a hit. Returns True when the hit must be dropped."""
+        reason = self.classify(request, ip_address, self.crawler_ranges)
+
+        with self._lock:
+            if reason is None:
+                self._accepted += 1
+                return False
+            self._reasons[reason] += 1
+            self._per_card[card_id] += 1
+            self._bytes_avoided += (ROW_OVERHEAD_BYTES
+                                    + len(request.headers.get('User-Agent', ''))
+                                    + len(request.headers.get('Referer', ''))
+                                    + len(ip_address or ''))
+        return True
+
+    def stats(self, top_cards=10):
+        """Snapshot of this worker's counters"""
+        with self._lock:
+            filtered = sum(self._reasons.values())
+            total = filtered + self._accepted
+            return {
+                'accepted': self._accepted,
+                'filtered': filtered,
+                'filtered_percent': round(filtered / total * 100, 1) if total else 0,
+                'rows_avoided': filtered,
+                'bytes_avoided': self._bytes_avoided,
+                'by_reason': dict(self._reasons),
+                'top_cards': self._per_card.most_common(top_cards),
+            }
+
+    def reset(self):
+        with self._lock:
+            self._reasons.clear()
+            self._per_card.clear()
+            self._accepted = 0
+            self._bytes_avoided = 0
+
+
+_bot_filter = None
+_bot_filter_lock = threading.Lock()
+
+
+def get_bot_filter():
+    """Process-wide filter configured from BOT_FILTER_EXTRA_RANGES"""
+    global _bot_filter
+    if _bot_filter is None:
+        from flask import current_app
+        with _bot_filter_lock:
+            if _bot_filter is None:
+                extra = current_app.config.get('BOT_FILTER_EXTRA_RANGES') or ''
+                _bot_filter = BotFilter(extra.split(',') if isinstance(extra, str) else extra)
+    return _bot_filter
+
+
+def should_skip_view(request, card_id, ip_address=None):
+    """True when a card hit comes from a bot/prefetch and must not be stored"""
+    from flask import current_app
+    if not current_app.config.get('BOT_FILTER_ENABLED', True):
+        return False
+    return get_bot_filter().check(request, card_id, ip_address)
@@ -0,0 +1,216 @@
+"""
+Two-tier Flask-Caching backend.
+
+Each worker keeps a small in-process LRU (tier 1) in front of a store
+shared by all workers (tier 2). The shared store is the filesystem by
+default; any Flask-Caching backend can be used through CACHE_L2_TYPE.
+Reads try the LRU first and fill it from the shared store. Writes and
+deletes go to both tiers, so an edit is visible to every worker after at
+most CACHE_L1_TTL seconds, which is how long tier 1 may keep a copy.
+
+Tier 1 stores pickled values. Its size is bounded by entry count and by
+bytes, and callers always get a fresh copy, never a shared object.
+
+Enable it with ``CACHE_TYPE=app.cache_backends.TwoTierCache``.
+"""
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from flask_caching.backends.base import BaseCache
+from werkzeug.utils import import_string
+
+
+class LocalLRU:
+    """Bounded per-process LRU of pickled values with byte accounting"""
+
+    def __init__(self, max_entries=1000, max_bytes=16 * 1024 * 1024, ttl=30):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, payload)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.on_evict = None  # optional callback(key), e.g. per-family metrics
+        self.on_store = None  # optional callback(key, pickled size in bytes)
+
+    def get(self, key):
+        """(found, value)"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return False, None
+            expires_at, payload = entry
+            if expires_at <= time.time():
+                self._drop(key)
+                return False, None
+            self._data.move_to_end(key)
+        return True, pickle.loads(payload)
+
+    def set(self, key, value, timeout=None):
+        payload = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if self.on_store is not None:
+            self.on_store(key, len(payload))
+        if len(payload) > self.max_bytes // 4:
+            # Large values would flush the whole tier; leave them to the shared store
+            self.delete(key)
+            return
+        ttl = self.ttl if not timeout else min(self.ttl, timeout)
+        with self._lock:
+            self._drop(key)
+            self._data[key] = (time.time() + ttl, payload)
+            self._bytes += len(payload)
+            while self._data and (len(self._data) > self.max_entries or self._bytes > self.max_bytes):
+                oldest = next(iter(self._data))
+                self._drop(oldest)
+                self.evictions += 1
+                if self.on_evict is not None:
+                    self.on_evict(oldest)
+
+    def _drop(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry[1])
+
+    def delete(self, key):
+        with self._lock:
+            self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._data),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'evictions': self.evictions,
+            }
+
+
+class TwoTierCache(BaseCache):
+    """Per-worker LRU in front of a shared Flask-Caching backend"""
+
+    def __init__(self, shared, default_timeout=300, l1_max_entries=1000,
+                 l1_max_bytes=16 * 1024 * 1024, l1_ttl=30):
+        super().__init__(default_timeout=default_timeout)
+        self.shared = shared
+        self.local = LocalLRU(l1_max_entries, l1_max_bytes, l1_ttl)
+        self._lock = threading.Lock()
+        self.l1_hits = 0
+        self.l2_hits = 0
+        self.misses = 0
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        shared_type = config.get('CACHE_L2_TYPE', 'FileSystemCache')
+        if '.' not in shared_type:
+            shared_type = 'flask_caching.backends.' + shared_type
+        shared_class = import_string(shared_type)
+        shared = shared_class.factory(app, config, list(args), dict(kwargs))
+        return cls(
+            shared,
+            default_timeout=kwargs.get('default_timeout', 300),
+            l1_max_entries=config.get('CACHE_L1_MAX_ENTRIES', 1000),
+            l1_max_bytes=config.get('CACHE_L1_MAX_BYTES', 16 * 1024 * 1024),
+            l1_ttl=config.get('CACHE_L1_TTL', 30),
+        )
+
+    def _count(self, tier):
+        with self._lock:
+            setattr(self, tier, getattr(self, tier) + 1)
+
+    def get(self, key):
+        found, value = self.local.get(key)
+        if found:
+            self._count('l1_hits')
+            return value
+        value = self.shared.get(key)
+        if value is None:
+            self._count('misses')
+            return None
+        self._count('l2_hits')
+        self.local.set(key, value)
+        return value
+
+    def get_many(self, *keys):
+        return [self.get(key) for key in keys]
+
+    def get_dict(self, *keys):
+        return dict(zip(keys, self.get_many(*keys)))
+
+    def has(self, key):
+        found, _ = self.local.get(key)
+        return found or self.shared.has(key)
+
+    def set(self, key, value, timeout=None):
+        timeout = self._normalize_timeout(timeout)
+        result = self.shared.set(key, value, timeout=timeout)
+        if result:
+            self.local.set(key, value, timeout)
+        else:
+            self.local.delete(key)
+        return result
+
+    def set_many(self, mapping, timeout=None):
+        return [key for key, value in mapping.items() if self.set(key, value, timeout)]
+
+    def add(self, key, value, timeout=None):
+        timeout = self._normalize_timeout(timeout)
+        added = self.shared.add(key, value, timeout=timeout)
+        if added:
+            self.local.set(key, value, timeout)
+        return added
+
+    def delete(self, key):
+        self.local.delete(key)
+        return self.shared.delete(key)
+
+    def delete_many(self, *keys):
+        for key in keys:
+            self.local.delete(key)
+        return self.shared.delete_many(*keys)
+
+    def inc(self, key, delta=1):
+        self.local.delete(key)
+        return self.shared.inc(key, delta)
+
+    def dec(self, key, delta=1):
+        self.local.delete(key)
+        return self.shared.dec(key, delta)
+
+    def clear(self):
+        self.local.clear()
+        return self.shared.clear()
+
+    def stats(self):
+        """Hit rates per tier for this worker plus tier 1 memory use"""
+        with self._lock:
+            l1_hits, l2_hits, misses = self.l1_hits, self.l2_hits, self.misses
+        lookups = l1_hits + l2_hits + misses
+        return {
+            'backend': f'two-tier (lru + {type(self.shared).__name__})',
+            'lookups': lookups,
+            'l1_hits': l1_hits,
+            'l2_hits': l2_hits,
+            'misses': misses,
+            'l1_hit_rate': round(l1_hits / lookups * 100, 1) if lookups else 0,
+            'l2_hit_rate': round(l2_hits / (l2_hits + misses) * 100, 1) if l2_hits + misses else 0,
+            'hit_rate': round((l1_hits + l2_hits) / lookups * 100, 1) if lookups else 0,
+            'l1': self.local.stats(),
+        }
+
+
+def cache_backend_stats(cache):
+    """Stats of the configured backend, or just its name when it keeps none"""
+    from .cache_metrics import unwrap
+    backend = unwrap(cache.cache)
+    if hasattr(backend, 'stats'):
+        return backend.stats()
+    return {'backend': type(backend).__name__, 'hit_rate': 'N/A'}
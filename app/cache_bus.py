@@ -0,0 +1,247 @@
+"""
+Cross-worker cache invalidation bus.
+
+Workers keep process-local cache copies: the tier-1 LRU of TwoTierCache,
+or the whole store with SimpleCache. An invalidation in one worker is
+published as rows in ``cache_invalidation``, whose autoincrement id
+serves as a change sequence. Every worker polls for ids above the last
+one it saw, at most every CACHE_BUS_POLL_INTERVAL seconds, before
+handling a request. It then evicts those keys locally. A worker
+therefore never serves a local copy older than one poll interval after
+an invalidation.
+
+Keys invalidated while the session holds uncommitted writes are
+published after that commit. Otherwise another worker could evict, read
+the old rows and cache them again. Rows older than
+CACHE_BUS_RETENTION are pruned. A worker that has not polled for that
+long clears its local cache instead of trusting a sequence with holes.
+"""
+import os
+import secrets
+import threading
+import time
+from datetime import timedelta
+
+from sqlalchemy import delete, event, func, insert, select
+
+from . import cache, db
+from .cache_metrics import unwrap
+from .timezone_utils import now_utc_for_db
+
+# Backends whose whole store lives inside the worker process
+PROCESS_LOCAL_BACKENDS = ('SimpleCache', 'NullCache')
+
+
+def evict_local(key):
+    """Drop a key ('*' for everything) from this worker's local cache copy"""
+    backend = unwrap(cache.cache)
+    local = getattr(backend, 'local', None)
+    if local is None:
+        if type(backend).__name__ not in PROCESS_LOCAL_BACKENDS:
+            return  # nothing held locally; the shared store is already up to date
+        local = backend
+    if key == '*':
+        local.clear()
+    else:
+        local.delete(key)
+
+
+class InvalidationBus:
+    """Publishes invalidations and applies those of other workers"""
+
+    def __init__(self, poll_interval=1.0, retention=3600, batch_size=1000):
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._origin = None
+        self.last_id = None
+        self.last_poll = 0.0
+        self.last_success = 0.0
+        self.last_prune = time.time()
+        self.published = 0
+        self.received = 0
+        self.polls = 0
+        self.listeners = []  # called with every key received from another worker
+
+    @property
+    def origin(self):
+        # Regenerated after a fork so preloaded workers never share an identity
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._origin = f'{self._pid}-{secrets.token_hex(6)}'
+            self.last_id = None
+        return self._origin
+
+    def publish(self, engine, keys):
+        """Append keys to the change sequence in their own short transaction"""
+        from .models import CacheInvalidation
+
+        rows = [{'key': key[:255], 'origin': self.origin} for key in dict.fromkeys(keys)]
+        if not rows:
+            return
+        with engine.begin() as connection:
+            connection.execute(insert(CacheInvalidation.__table__), rows)
+        with self._lock:
+            self.published += len(rows)
+
+    def poll(self, engine, evict=evict_local, force=False):
+        """Apply invalidations published by other workers; returns keys evicted"""
+        from .models import CacheInvalidation
+
+        now = time.time()
+        origin = self.origin
+        with self._lock:
+            if not force and now - self.last_poll < self.poll_interval:
+                return 0
+            self.last_poll = now
+
+        table = CacheInvalidation.__table__
+        evicted = 0
+        with engine.connect() as connection:
+            if self.last_id is None:
+                # Fresh worker: its local cache is empty, start from the current head
+                self.last_id = connection.execute(select(func.max(table.c.id))).scalar() or 0
+                self.last_success = now
+                return 0
+
+            if self.last_success and now - self.last_success > self.retention:
+                self._apply('*', evict)
+                evicted += 1
+
+            while True:
+                rows = connection.execute(
+                    select(table.c.id, table.c.key, table.c.origin)
+                    .where(table.c.id > self.last_id)
+                    .order_by(table.c.id)
+                    .limit(self.batch_size)
+                ).all()
+                for row in rows:
+                    if row.origin != origin:
+                        self._apply(row.key, evict)
+                        evicted += 1
+                    self.last_id = row.id
+                if len(rows) < self.batch_size:
+                    break
+
+            if now - self.last_prune > self.retention / 4:
+                self.last_prune = now
+                cutoff = now_utc_for_db() - timedelta(seconds=self.retention)
+                connection.execute(delete(table).where(table.c.created_at < cutoff))
+                connection.commit()
+
+        with self._lock:
+            self.last_success = now
+            self.polls += 1
+            self.received += evicted
+        return evicted
+
+    def _apply(self, key, evict):
+        evict(key)
+        for listener in self.listeners:
+            try:
+                listener(key)
+            except Exception as e:
+                print(f"Cache invalidation listener failed for {key}: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'last_id': self.last_id,
+                'published': self.published,
+                'received': self.received,
+                'polls': self.polls,
+                'lag_seconds': round(time.time() - self.last_success, 1) if self.last_success else None,
+            }
+
+
+_bus = None
+_bus_lock = threading.Lock()
+
+
+def get_cache_bus():
+    """Process-wide bus configured from CACHE_BUS_* settings"""
+    global _bus
+    if _bus is None:
+        from flask import current_app
+        with _bus_lock:
+            if _bus is None:
+                config = current_app.config
+                _bus = InvalidationBus(
+                    poll_interval=config.get('CACHE_BUS_POLL_INTERVAL', 1.0),
+                    retention=config.get('CACHE_BUS_RETENTION', 3600),
+                )
+    return _bus
+
+
+def add_listener(listener):
+    """Call listener(key) for every key another worker invalidates ('*' = all)"""
+    bus = get_cache_bus()
+    if listener not in bus.listeners:
+        bus.listeners.append(listener)
+
+
+def _enabled():
+    from flask import current_app
+    return current_app.config.get('CACHE_BUS_ENABLED', True)
+
+
+def _has_pending_writes(session):
+    return bool(session.info.get('cache_bus_writes') or session.new or session.dirty or session.deleted)
+
+
+def publish(*keys):
+    """Tell every other worker to evict these keys ('*' = all) from its local cache"""
+    if not keys or not _enabled():
+        return
+    try:
+        session = db.session()
+        if _has_pending_writes(session):
+            # Publish once the change is visible to the other workers
+            session.info.setdefault('cache_bus_keys', []).extend(keys)
+            return
+        get_cache_bus().publish(db.engine, keys)
+    except Exception as e:
+        print(f"Cache invalidation publish failed: {e}")
+
+
+def poll():
+    """before_request hook: apply pending invalidations from other workers"""
+    if not _enabled():
+        return
+    try:
+        get_cache_bus().poll(db.engine)
+    except Exception as e:
+        # A missing table (not migrated yet) or a DB hiccup must not break requests
+        print(f"Cache invalidation poll failed: {e}")
+
+
+def _mark_writes(session, flush_context):
+    session.info['cache_bus_writes'] = True
+
+
+def _publish_deferred(session):
+    session.info.pop('cache_bus_writes', None)
+    keys = session.info.pop('cache_bus_keys', None)
+    if keys:
+        try:
+            get_cache_bus().publish(db.engine, keys)
+        except Exception as e:
+            print(f"Cache invalidation publish failed: {e}")
+
+
+def _drop_deferred(session):
+    session.info.pop('cache_bus_writes', None)
+    session.info.pop('cache_bus_keys', None)
+
+
+def init_app(app):
+    """Poll before every request and publish deferred keys after commits"""
+    from sqlalchemy.orm import Session
+
+    app.before_request(poll)
+    if not event.contains(Session, 'after_flush', _mark_writes):
+        event.listen(Session, 'after_flush', _mark_writes)
+        event.listen(Session, 'after_commit', _publish_deferred)
+        event.listen(Session, 'after_rollback', _drop_deferred)
@@ -0,0 +1,258 @@
+"""
+Cache instrumentation per key family.
+
+The configured Flask-Caching backend is wrapped in ``MeteredCache``. It
+counts gets, hits, misses, sets, deletes, bytes written and evictions
+per key family: 'card_data_', 'card_view_', 'analytics:get_card_analytics'
+and so on. Counters are kept per worker and added every
+CACHE_METRICS_FLUSH_INTERVAL seconds to ``cache_metric_daily`` with one
+upsert. The admin page and the JSON endpoint therefore show totals for
+every worker.
+
+Evictions are those the app can see: entries pushed out of the
+two-tier backend's local LRU. Other backends prune internally without
+reporting it.
+
+Bytes written come from the payload the two-tier backend pickles anyway.
+With other backends one set in CACHE_METRICS_BYTES_SAMPLE is pickled
+again to measure it, and counted that many times.
+"""
+import itertools
+import pickle
+import re
+import threading
+
+from sqlalchemy import func, select
+
+from .timezone_utils import now_utc_for_db
+from .write_buffer import WriteBuffer, register_exit_flush, upsert
+
+METRICS = ('gets', 'hits', 'misses', 'sets', 'deletes', 'bytes_set', 'evictions')
+
+# Known prefixes, longest first where they overlap
+FAMILIES = (
+    'analytics_version:',
+    'card_data_',
+    'card_view_',
+    'card_services_',
+    'card_products_',
+    'card_gallery_',
+    'card_featured_',
+    'negative:slug:',
+    'negative:handle',
+    'lock:',
+    'theme_',
+    'leaderboard',
+    'public_cards_count',
+)
+
+
+def key_family(key):
+    """Group a cache key with the keys built from the same template"""
+    if key.startswith('analytics:'):
+        # analytics:card:12:get_card_analytics(12,30) -> analytics:get_card_analytics
+        return 'analytics:' + key.rsplit(':', 1)[-1].split('(', 1)[0]
+    for prefix in FAMILIES:
+        if key.startswith(prefix):
+            return prefix
+    if ':' in key:
+        return key.split(':', 1)[0] + ':'
+    return (re.sub(r'\d.*$', '', key) or 'other')[:64]
+
+
+class MetricsBuffer(WriteBuffer):
+    """Per-worker counters waiting to be added to cache_metric_daily"""
+
+    def __init__(self, flush_interval=60):
+        super().__init__(flush_interval=flush_interval)  # pending: (family, metric) -> n
+
+    def count(self, key, metric, n=1):
+        family = key_family(key)
+        with self._lock:
+            self._add((family, metric), n)
+
+    def flush(self, engine):
+        """Add the buffered counters to today's rows in one transaction"""
+        pending = self._take()
+        if not pending:
+            return 0
+
+        rows = {}
+        for (family, metric), n in pending.items():
+            rows.setdefault(family, dict.fromkeys(METRICS, 0))[metric] += n
+        try:
+            with engine.begin() as connection:
+                increment_metrics(connection, now_utc_for_db().date(), rows)
+        except Exception as e:
+            print(f"Cache metrics flush failed: {e}")
+            self._put_back(pending)
+            return 0
+        return len(rows)
+
+
+def increment_metrics(connection, day, rows):
+    """Add {family: {metric: n}} to the day's cache_metric_daily rows with a single upsert"""
+    from .models import CacheMetricDaily
+
+    table = CacheMetricDaily.__table__
+    values = [dict(counts, family=family, day=day) for family, counts in rows.items()]
+    upsert(connection, table, values, key=('family', 'day'), increments=METRICS)
+
+
+class MeteredCache:
+    """Counting proxy around a Flask-Caching backend"""
+
+    def __init__(self, wrapped, metrics, bytes_sample=10):
+        self.wrapped = wrapped
+        self.metrics = metrics
+        self.bytes_sample = max(int(bytes_sample), 1)
+        self._sets = itertools.count(1)
+        self._sizes_reported = False
+        local = getattr(wrapped, 'local', None)
+        if local is not None and hasattr(local, 'on_evict'):
+            local.on_evict = lambda key: metrics.count(key, 'evictions')
+        if local is not None and hasattr(local, 'on_store'):
+            local.on_store = lambda key, nbytes: metrics.count(key, 'bytes_set', nbytes)
+            self._sizes_reported = True
+
+    def __getattr__(self, name):
+        return getattr(self.wrapped, name)
+
+    def _read(self, key, value):
+        self.metrics.count(key, 'gets')
+        self.metrics.count(key, 'misses' if value is None else 'hits')
+        return value
+
+    def _written(self, key, value):
+        self.metrics.count(key, 'sets')
+        if self._sizes_reported or next(self._sets) % self.bytes_sample:
+            return
+        try:
+            size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+            self.metrics.count(key, 'bytes_set', size * self.bytes_sample)
+        except Exception:
+            pass
+
+    def get(self, key):
+        return self._read(key, self.wrapped.get(key))
+
+    def get_many(self, *keys):
+        values = self.wrapped.get_many(*keys)
+        for key, value in zip(keys, values):
+            self._read(key, value)
+        return values
+
+    def get_dict(self, *keys):
+        return dict(zip(keys, self.get_many(*keys)))
+
+    def has(self, key):
+        return self.wrapped.has(key)
+
+    def set(self, key, value, timeout=None):
+        result = self.wrapped.set(key, value, timeout=timeout)
+        self._written(key, value)
+        return result
+
+    def set_many(self, mapping, timeout=None):
+        result = self.wrapped.set_many(mapping, timeout=timeout)
+        for key, value in mapping.items():
+            self._written(key, value)
+        return result
+
+    def add(self, key, value, timeout=None):
+        added = self.wrapped.add(key, value, timeout=timeout)
+        if added:
+            self._written(key, value)
+        return added
+
+    def delete(self, key):
+        self.metrics.count(key, 'deletes')
+        return self.wrapped.delete(key)
+
+    def delete_many(self, *keys):
+        for key in keys:
+            self.metrics.count(key, 'deletes')
+        return self.wrapped.delete_many(*keys)
+
+    def inc(self, key, delta=1):
+        self.metrics.count(key, 'sets')
+        return self.wrapped.inc(key, delta)
+
+    def dec(self, key, delta=1):
+        self.metrics.count(key, 'sets')
+        return self.wrapped.dec(key, delta)
+
+    def clear(self):
+        return self.wrapped.clear()
+
+
+def unwrap(backend):
+    """The real backend behind the metering proxy"""
+    return getattr(backend, 'wrapped', backend)
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_metrics_buffer(flush_interval=60):
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = MetricsBuffer(flush_interval)
+    return _buffer
+
+
+def summarize(session, days=1, include_pending=True):
+    """Per-family totals over the last `days` UTC days, worst hit rate first"""
+    from datetime import timedelta
+    from .models import CacheMetricDaily
+
+    start = now_utc_for_db().date() - timedelta(days=days - 1)
+    totals = {}
+    rows = session.execute(
+        select(CacheMetricDaily.family, *[func.sum(getattr(CacheMetricDaily, metric)) for metric in METRICS])
+        .where(CacheMetricDaily.day >= start)
+        .group_by(CacheMetricDaily.family)
+    )
+    for row in rows:
+        totals[row[0]] = {metric: int(value or 0) for metric, value in zip(METRICS, row[1:])}
+    if include_pending and _buffer is not None:
+        for (family, metric), n in _buffer.pending().items():
+            totals.setdefault(family, dict.fromkeys(METRICS, 0))[metric] += n
+
+    families = []
+    overall = dict.fromkeys(METRICS, 0)
+    for family, counts in totals.items():
+        for metric in METRICS:
+            overall[metric] += counts[metric]
+        families.append(dict(counts, family=family, hit_rate=_hit_rate(counts)))
+    families.sort(key=lambda item: (-item['gets'], item['family']))
+    overall['hit_rate'] = _hit_rate(overall)
+    return {'days': days, 'since': start.isoformat(), 'families': families, 'totals': overall}
+
+
+def _hit_rate(counts):
+    return round(counts['hits'] / counts['gets'] * 100, 1) if counts['gets'] else 0
+
+
+def init_app(app, cache):
+    """Wrap the app's cache backend and flush counters after requests"""
+    if not app.config.get('CACHE_METRICS_ENABLED', True):
+        return
+    from . import db
+
+    metrics = get_metrics_buffer(app.config.get('CACHE_METRICS_FLUSH_INTERVAL', 60))
+    backends = app.extensions['cache']
+    if not isinstance(backends[cache], MeteredCache):
+        backends[cache] = MeteredCache(backends[cache], metrics,
+                                       app.config.get('CACHE_METRICS_BYTES_SAMPLE', 10))
+
+    @app.after_request
+    def flush_cache_metrics(response):
+        if metrics.should_flush():
+            metrics.flush(db.engine)
+        return response
+
+    register_exit_flush(app, lambda db: metrics.flush(db.engine))
@@ -0,0 +1,197 @@
+"""
+Stampede-safe cache reads.
+
+``get_or_set(key, compute, timeout)`` keeps these cases from turning
+into a burst of identical queries:
+
+- A popular entry expires. It has a soft TTL (``timeout``) and stays in
+  the cache CACHE_STALE_TTL seconds longer. Past the soft TTL, one caller
+  recomputes it while everyone else keeps getting the stale value.
+- Refreshes are spread out. Each read may refresh a little before the
+  soft TTL, with a probability that grows as expiry nears and with how
+  long the value takes to compute (XFetch). Hot keys are usually
+  refreshed before anyone sees them stale.
+- A key is missing. Threads of this worker asking for the same key wait
+  for a single computation (single-flight). Other workers see a short
+  lock in the shared cache and wait for its result instead of
+  computing it too.
+
+Entries are stored as small envelopes. A plain value found under the key
+(written by older code) is treated as fresh.
+"""
+import math
+import random
+import threading
+import time
+
+from . import cache
+
+ENVELOPE = '_stampede'
+LOCK_PREFIX = 'lock:'
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def _config(name, default):
+    try:
+        from flask import current_app
+        return current_app.config.get(name, default)
+    except RuntimeError:
+        return default
+
+
+def _envelope(value, timeout, delta):
+    return {ENVELOPE: 1, 'value': value, 'computed_at': time.time(), 'timeout': timeout, 'delta': delta}
+
+
+def store(key, value, timeout=300, delta=0.0):
+    """Write a value with a soft TTL of `timeout`; it stays servable CACHE_STALE_TTL longer"""
+    try:
+        cache.set(key, _envelope(value, timeout, delta), timeout=timeout + _config('CACHE_STALE_TTL', 300))
+    except Exception:
+        pass
+
+
+def should_refresh(computed_at, timeout, delta, beta=None, now=None):
+    """XFetch: recompute early with a probability that rises towards expiry"""
+    if beta is None:
+        beta = _config('CACHE_EARLY_EXPIRY_BETA', 1.0)
+    now = time.time() if now is None else now
+    jitter = -delta * beta * math.log(1.0 - random.random()) if delta and beta else 0.0
+    return now + jitter >= computed_at + timeout
+
+
+def acquire_lock(key, timeout=None):
+    """Short lock in the shared cache so only one worker recomputes a key"""
+    try:
+        return bool(cache.add(LOCK_PREFIX + key, 1, timeout=timeout or _config('CACHE_LOCK_TIMEOUT', 10)))
+    except Exception:
+        return True  # no cache, no coordination: just compute
+
+
+def release_lock(key):
+    try:
+        cache.delete(LOCK_PREFIX + key)
+    except Exception:
+        pass
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+
+
+def single_flight(key, compute, wait=None):
+    """Run compute() once per key across this worker's threads.
+
+    Followers wait for the leader and return None. They read the fresh
+    value from the cache themselves instead of sharing the leader's
+    objects, which may be bound to another thread's session.
+    Returns (leader, value).
+    """
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+
+    if not leader:
+        flight.done.wait(wait or _config('CACHE_LOCK_TIMEOUT', 10))
+        return False, None
+
+    try:
+        return True, compute()
+    finally:
+        with _flights_lock:
+            _flights.pop(key, None)
+        flight.done.set()
+
+
+def is_refreshing(key):
+    with _flights_lock:
+        return key in _flights
+
+
+def _read(key):
+    try:
+        return cache.get(key)
+    except Exception:
+        return None
+
+
+def wait_for_value(key, wait):
+    """Poll for the value another worker is computing"""
+    deadline = time.time() + wait
+    while time.time() < deadline:
+        time.sleep(0.05)
+        entry = _read(key)
+        if entry is not None:
+            return entry
+    return None
+
+
+def _unwrap(entry):
+    if isinstance(entry, dict) and entry.get(ENVELOPE):
+        return entry['value']
+    return entry
+
+
+def get_or_set(key, compute, timeout=300, cacheable=None):
+    """Cached value of compute(), recomputed by a single caller when missing or stale.
+
+    ``cacheable(value)`` may veto storing a result (e.g. a card that is not
+    public); None results are never stored, and an older entry under the
+    key is removed so it is not served stale either.
+    """
+    def compute_and_store():
+        started = time.time()
+        value = compute()
+        if value is not None and (cacheable is None or cacheable(value)):
+            store(key, value, timeout, delta=time.time() - started)
+        else:
+            try:
+                cache.delete(key)
+            except Exception:
+                pass
+        return value
+
+    entry = _read(key)
+    if entry is not None:
+        if not (isinstance(entry, dict) and entry.get(ENVELOPE)):
+            return entry
+        if not should_refresh(entry['computed_at'], entry['timeout'], entry.get('delta', 0)):
+            return entry['value']
+        # Stale or about to be: one caller refreshes, the rest keep the old value
+        if is_refreshing(key) or not acquire_lock(key):
+            return entry['value']
+        try:
+            leader, value = single_flight(key, compute_and_store)
+        finally:
+            release_lock(key)
+        if leader:
+            return value
+        entry = _read(key)
+        return _unwrap(entry) if entry is not None else compute()
+
+    wait = _config('CACHE_LOCK_TIMEOUT', 10)
+
+    def fill():
+        locked = acquire_lock(key)
+        if not locked:
+            entry = wait_for_value(key, min(wait, _config('CACHE_LOCK_WAIT', 2)))
+            if entry is not None:
+                return _unwrap(entry)
+        try:
+            return compute_and_store()
+        finally:
+            if locked:
+                release_lock(key)
+
+    leader, value = single_flight(key, fill, wait)
+    if leader:
+        return value
+    entry = _read(key)
+    if entry is not None:
+        return _unwrap(entry)
+    return compute()  # the leader's result was not cacheable (or it failed)
@@ -1,5 +1,32 @@
-from . import cache
+from . import cache, analytics_cache, cache_bus
 from .models import Card
+from .cache_stampede import store
+
+
+def card_cache_keys(card_id, slug):
+    """Every cache key derived from a card"""
+    return [
+        f'card_data_{slug}',
+        f'card_view_{slug}',
+        f'card_services_{card_id}',
+        f'card_products_{card_id}',
+        f'card_gallery_{card_id}',
+        f'card_featured_{card_id}',
+        # ID-based keys in case they exist
+        f'card_data_{card_id}',
+        f'card_view_{card_id}',
+    ]
+
+
+def _delete_keys(keys):
+    """Delete keys here and tell the other workers to drop their local copies"""
+    try:
+        for key in keys:
+            cache.delete(key)
+    except Exception as e:
+        # Silent fail - don't break functionality if cache fails
+        pass
+    cache_bus.publish(*keys)
 
 
 def clear_card_cache(card_id):
@@ -8,30 +35,19 @@ def clear_card_cache(card_id):
     if not card:
         return
     
-    # Clear main card cache using slug
-    try:
-        cache.delete(f'card_data_{card.slug}')
-        cache.delete(f'card_view_{card.slug}')
-        
-        # Clear related data cache
-        cache.delete(f'card_services_{card_id}')
-        cache.delete(f'card_products_{card_id}')
-        cache.delete(f'card_gallery_{card_id}')
-        cache.delete(f'card_featured_{card_id}')
-        
-        # Also try to clear with ID-based keys in case they exist
-        cache.delete(f'card_data_{card_id}')
-        cache.delete(f'card_view_{card_id}')
-        
-        # Cache cleared successfully
-        pass
-    except Exception as e:
-        # Silent fail - don't break functionality if cache fails
-        pass
+    _delete_keys(card_cache_keys(card_id, card.slug))
     
-    # Clear analytics cache (Flask-Caching doesn't have delete_many with patterns)
-    # We'll need to manually track or use cache keys instead
-    pass  # TODO: Implement pattern-based cache clearing if needed
+    # Analytics are memoized per namespace; bumping its version makes them stale
+    analytics_cache.invalidate_card(card_id, card.owner_id)
+
+
+def clear_theme_cache(theme_id):
+    """Clear the rendered pages of every card using a theme"""
+    cards = Card.query.with_entities(Card.id, Card.slug).filter_by(theme_id=theme_id).all()
+    keys = [f'theme_{theme_id}']
+    for card_id, slug in cards:
+        keys.extend(card_cache_keys(card_id, slug))
+    _delete_keys(keys)
 
 
 def clear_user_cache(user_id):
@@ -41,8 +57,8 @@ def clear_user_cache(user_id):
     for card in user_cards:
         clear_card_cache(card.id)
     
-    # Clear user analytics cache (Flask-Caching doesn't have delete_many with patterns)
-    pass  # TODO: Implement pattern-based cache clearing if needed
+    # Clear user analytics cache
+    analytics_cache.invalidate_user(user_id)
 
 
 def warm_card_cache(card_id):
@@ -51,21 +67,24 @@ def warm_card_cache(card_id):
     if not card:
         return
     
-    # Cache card data
-    cache.set(f'card_data_{card.slug}', card, timeout=300)
+    # Cache card data under the same rule as card_view (this also loads the
+    # owner, which the page reads after the card is detached from the session)
+    if card.is_public and not card.owner.is_suspended:
+        store(f'card_data_{card.slug}', card, timeout=300)
     
     # Cache related data
     services = card.services.filter_by(is_visible=True).order_by('order_index').all()
-    cache.set(f'card_services_{card_id}', services, timeout=600)
+    store(f'card_services_{card_id}', services, timeout=600)
     
     products = card.products.filter_by(is_visible=True).order_by('order_index').all()
-    cache.set(f'card_products_{card_id}', products, timeout=600)
+    store(f'card_products_{card_id}', products, timeout=600)
     
     gallery_items = card.gallery_items.filter_by(is_visible=True).order_by('order_index').all()
-    cache.set(f'card_gallery_{card_id}', gallery_items, timeout=600)
+    store(f'card_gallery_{card_id}', gallery_items, timeout=600)
     
     featured_image = card.gallery_items.filter_by(is_featured=True, is_visible=True).first()
-    cache.set(f'card_featured_{card_id}', featured_image, timeout=600)
+    if featured_image is not None:
+        store(f'card_featured_{card_id}', featured_image, timeout=600)
 
 
 class CacheManager:
@@ -81,22 +100,19 @@ class CacheManager:
         """Invalidate all caches related to a user"""
         clear_user_cache(user_id)
     
+    @staticmethod
+    def invalidate_theme(theme_id):
+        """Invalidate the cached pages of all cards using a theme"""
+        clear_theme_cache(theme_id)
+    
     @staticmethod
     def warm_popular_cards(limit=10):
         """Pre-warm cache for most viewed cards"""
         try:
-            from sqlalchemy import func
-            from .models import CardView
-            from . import db
-            
-            popular_cards = db.session.query(
-                Card.id
-            ).join(CardView).group_by(Card.id)\
-             .order_by(func.count(CardView.id).desc())\
-             .limit(limit).all()
+            from flask import current_app
+            from .cache_warmup import warm_cache
             
-            for card in popular_cards:
-                warm_card_cache(card.id)
+            return warm_cache(current_app._get_current_object(), limit=limit)
         except Exception as e:
             # Silent fail for cache warming
             pass
@@ -0,0 +1,170 @@
+"""
+Cache warm-up for fresh workers and after deploys.
+
+``warm_cache(app)`` loads into the cache whatever the first visitors
+would otherwise pay for:
+
+- The popular-cards leaderboard.
+- For the top CACHE_WARM_LIMIT cards: their card data, related lists
+  and rendered public page. These go through the same stampede-safe
+  helpers as card_view.
+- The compiled Jinja templates of active themes and of the /turnos
+  pages. Handle lookups themselves are never cached positively, so
+  compiling their templates is what warms /turnos.
+- The slug Bloom filter used for unknown-slug 404s.
+
+Tasks run on a small thread pool (CACHE_WARM_WORKERS) within a time
+budget (CACHE_WARM_BUDGET seconds). Tasks not started when the budget
+runs out are skipped. The returned report counts what was warmed,
+skipped or failed.
+
+With CACHE_WARM_ON_START, every worker warms itself once in the
+background after its first request, so a worker never warms twice.
+``flask warm-cache`` runs the same warm-up by hand; it only helps
+backends shared between processes.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+TICKET_TEMPLATES = (
+    'public/tickets/take_ticket.html',
+    'public/tickets/ticket_status.html',
+    'public/tickets/queue_display.html',
+    'public/tickets/not_available.html',
+)
+
+
+def _top_cards(limit):
+    from .leaderboard import get_top_card_ids
+    from .models import Card
+
+    ids = [card_id for card_id, _ in get_top_card_ids('all', limit)]
+    if len(ids) < limit:
+        # Young installs have few ranked cards; fill up with the newest public ones
+        extra = (Card.query.with_entities(Card.id)
+                 .filter(Card.is_public == True, ~Card.id.in_(ids or [0]))
+                 .order_by(Card.id.desc()).limit(limit - len(ids)))
+        ids.extend(card_id for (card_id,) in extra)
+    if not ids:
+        return []
+    slugs = dict(Card.query.with_entities(Card.id, Card.slug).filter(Card.id.in_(ids)))
+    return [slugs[card_id] for card_id in ids if card_id in slugs]
+
+
+def _warm_card(app, slug):
+    from .public.routes import get_cached_card, get_cached_card_page
+
+    with app.test_request_context(f'/c/{slug}'):
+        card = get_cached_card(slug)
+        if card is None or not card.is_public or card.owner.is_suspended:
+            return 'skipped'
+        get_cached_card_page(card)
+        return 'card'
+
+
+def _compile_template(app, name):
+    with app.app_context():
+        app.jinja_env.get_template(name)
+    return 'template'
+
+
+def _build_slug_filter(app):
+    from . import db
+    from .negative_cache import get_slug_filter
+
+    with app.app_context():
+        if not (app.config.get('NEGATIVE_BLOOM_ENABLED', True) and app.config.get('CACHE_BUS_ENABLED', True)):
+            return 'skipped'
+        get_slug_filter().current(db.engine)
+    return 'slug_filter'
+
+
+def warm_cache(app, limit=None, workers=None, budget=None):
+    """Warm the cache within a time budget; returns a report dict"""
+    from .models import Theme
+
+    config = app.config
+    limit = config.get('CACHE_WARM_LIMIT', 20) if limit is None else limit
+    workers = config.get('CACHE_WARM_WORKERS', 4) if workers is None else workers
+    budget = config.get('CACHE_WARM_BUDGET', 20) if budget is None else budget
+    started = time.time()
+    report = {'cards': 0, 'templates': 0, 'slug_filter': False,
+              'skipped': 0, 'failed': [], 'budget_exceeded': False}
+
+    with app.app_context():
+        slugs = _top_cards(limit)
+        templates = {theme.get_template_path() for theme in Theme.query.filter_by(is_active=True)}
+    templates.update(TICKET_TEMPLATES)
+
+    tasks = [('slug filter', _build_slug_filter, (app,))]
+    tasks += [(f'card {slug}', _warm_card, (app, slug)) for slug in slugs]
+    tasks += [(f'template {name}', _compile_template, (app, name)) for name in sorted(templates)]
+
+    def collect(name, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            report['failed'].append(f'{name}: {e}')
+            return
+        if result == 'card':
+            report['cards'] += 1
+        elif result == 'template':
+            report['templates'] += 1
+        elif result == 'slug_filter':
+            report['slug_filter'] = True
+        else:
+            report['skipped'] += 1
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix='cache-warmup') as pool:
+        pending = {pool.submit(fn, *args): name for name, fn, args in tasks}
+        while pending:
+            remaining = budget - (time.time() - started)
+            if remaining <= 0:
+                report['budget_exceeded'] = True
+                break
+            done, _ = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                collect(pending.pop(future), future)
+        # Tasks still queued when the budget ran out are dropped; running ones finish
+        for future in list(pending):
+            if future.cancel():
+                pending.pop(future)
+                report['skipped'] += 1
+    for future, name in pending.items():
+        collect(name, future)
+
+    report['elapsed'] = round(time.time() - started, 2)
+    return report
+
+
+_warmed_pid = None
+_warmed_lock = threading.Lock()
+
+
+def init_app(app):
+    """Warm each worker once, in the background, after its first request"""
+    if not app.config.get('CACHE_WARM_ON_START', False):
+        return
+
+    @app.after_request
+    def warm_worker_once(response):
+        global _warmed_pid
+        if _warmed_pid != os.getpid():
+            with _warmed_lock:
+                if _warmed_pid != os.getpid():
+                    _warmed_pid = os.getpid()
+                    threading.Thread(target=_warm_in_background, args=(app,),
+                                     name='cache-warmup', daemon=True).start()
+        return response
+
+
+def _warm_in_background(app):
+    try:
+        report = warm_cache(app)
+        print(f"Cache warmed in worker {os.getpid()}: {report['cards']} cards, "
+              f"{report['templates']} templates in {report['elapsed']}s"
+              + (f", {len(report['failed'])} failed" if report['failed'] else ''))
+    except Exception as e:
+        print(f"Cache warm-up failed: {e}")
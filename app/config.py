@@ -23,6 +23,36 @@ class Config:
     MAX_UPLOAD_SIZE = MAX_CONTENT_LENGTH  # Alias for backward compatibility
     UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER', 'app/static/uploads')
     THUMBNAIL_FOLDER = os.environ.get('THUMBNAIL_FOLDER', 'app/static/thumbs')
+    # Background image processing (app.image_jobs): uploads are staged and resized off the request
+    IMAGE_JOBS_ENABLED = os.environ.get('IMAGE_JOBS_ENABLED', 'false').lower() == 'true'
+    IMAGE_JOB_WORKERS = int(os.environ.get('IMAGE_JOB_WORKERS', '2'))  # processes per app worker
+    IMAGE_QUEUE_MAX = int(os.environ.get('IMAGE_QUEUE_MAX', '16'))  # in-flight jobs before uploads are processed inline
+    IMAGE_JOB_MAX_ATTEMPTS = int(os.environ.get('IMAGE_JOB_MAX_ATTEMPTS', '3'))
+    IMAGE_JOB_STALE_AFTER = int(os.environ.get('IMAGE_JOB_STALE_AFTER', '600'))  # seconds in 'running' before a job counts as abandoned
+    IMAGE_JOB_STAGING_DIR = os.environ.get('IMAGE_JOB_STAGING_DIR', os.path.join(os.path.dirname(os.path.dirname(__file__)), 'instance', 'image_staging'))
+    # Responsive derivatives (app.image_derivatives): static/derived/<upload>/<width>.webp|jpg
+    IMAGE_DERIVATIVES_ENABLED = os.environ.get('IMAGE_DERIVATIVES_ENABLED', 'true').lower() == 'true'
+    IMAGE_DERIVATIVE_WIDTHS = os.environ.get('IMAGE_DERIVATIVE_WIDTHS', '160,320,480,640,800')
+    IMAGE_DERIVATIVE_FORMATS = os.environ.get('IMAGE_DERIVATIVE_FORMATS', 'webp,jpeg')
+    IMAGE_WEBP_QUALITY = int(os.environ.get('IMAGE_WEBP_QUALITY', '80'))
+    IMAGE_JPEG_QUALITY = int(os.environ.get('IMAGE_JPEG_QUALITY', '82'))
+    # On-demand variants at /img/<WxH>/<format>/<upload> (app.image_resize)
+    IMAGE_RESIZE_CACHE_DIR = os.environ.get('IMAGE_RESIZE_CACHE_DIR', os.path.join(os.path.dirname(os.path.dirname(__file__)), 'instance', 'image_cache'))
+    IMAGE_RESIZE_CACHE_MAX_BYTES = int(os.environ.get('IMAGE_RESIZE_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+    IMAGE_RESIZE_MAX_DIM = int(os.environ.get('IMAGE_RESIZE_MAX_DIM', '2000'))
+    IMAGE_RESIZE_SIZES = os.environ.get('IMAGE_RESIZE_SIZES', '160x0,320x0,480x0,640x0,800x0,150x150c,300x300c')  # empty allows any size
+    IMAGE_RESIZE_LOCK_WAIT = float(os.environ.get('IMAGE_RESIZE_LOCK_WAIT', '10'))  # seconds to wait for another render
+    # Bulk recompression of stored uploads (flask optimize-images, app.image_optimizer)
+    IMAGE_OPTIMIZE_MANIFEST = os.environ.get('IMAGE_OPTIMIZE_MANIFEST', os.path.join(os.path.dirname(os.path.dirname(__file__)), 'instance', 'image_manifest.json'))
+    IMAGE_OPTIMIZE_MAX_DIM = int(os.environ.get('IMAGE_OPTIMIZE_MAX_DIM', '1920'))
+    IMAGE_OPTIMIZE_MIN_SAVING = float(os.environ.get('IMAGE_OPTIMIZE_MIN_SAVING', '0.05'))  # keep the original unless this much smaller
+    # Content-addressed uploads (app.upload_store): cas/ab/cd/<sha256>.jpg, shared and reference counted
+    UPLOAD_CONTENT_ADDRESSED = os.environ.get('UPLOAD_CONTENT_ADDRESSED', 'true').lower() == 'true'
+    UPLOAD_RELEASE_GRACE = int(os.environ.get('UPLOAD_RELEASE_GRACE', '300'))  # seconds an unreferenced file is kept
+    # Orphan collection (flask gc-uploads, app.upload_gc)
+    UPLOAD_GC_GRACE_HOURS = float(os.environ.get('UPLOAD_GC_GRACE_HOURS', '24'))  # files modified since are never collected
+    UPLOAD_GC_QUARANTINE_DIR = os.environ.get('UPLOAD_GC_QUARANTINE_DIR', os.path.join(os.path.dirname(os.path.dirname(__file__)), 'instance', 'upload_quarantine'))
+    UPLOAD_GC_QUARANTINE_DAYS = int(os.environ.get('UPLOAD_GC_QUARANTINE_DAYS', '7'))  # then deleted
 
     # Additional security headers
     SEND_FILE_MAX_AGE_DEFAULT = 31536000  # 1 year for static files
@@ -39,6 +69,79 @@ class Config:
     # Cache configuration
     CACHE_TYPE = os.environ.get('CACHE_TYPE', 'simple')
     CACHE_DEFAULT_TIMEOUT = int(os.environ.get('CACHE_DEFAULT_TIMEOUT', '300'))
+    # Two-tier cache (CACHE_TYPE=app.cache_backends.TwoTierCache): per-worker LRU in front of a shared store
+    CACHE_L2_TYPE = os.environ.get('CACHE_L2_TYPE', 'FileSystemCache')
+    CACHE_DIR = os.environ.get('CACHE_DIR', os.path.join(os.path.dirname(os.path.dirname(__file__)), 'instance', 'cache'))
+    CACHE_THRESHOLD = int(os.environ.get('CACHE_THRESHOLD', '500'))  # max entries per store
+    CACHE_L1_MAX_ENTRIES = int(os.environ.get('CACHE_L1_MAX_ENTRIES', '1000'))
+    CACHE_L1_MAX_BYTES = int(os.environ.get('CACHE_L1_MAX_BYTES', str(16 * 1024 * 1024)))
+    CACHE_L1_TTL = int(os.environ.get('CACHE_L1_TTL', '30'))  # seconds a worker may keep its own copy
+    # Per-family cache metrics (cache_metric_daily)
+    CACHE_METRICS_ENABLED = os.environ.get('CACHE_METRICS_ENABLED', 'true').lower() == 'true'
+    CACHE_METRICS_FLUSH_INTERVAL = int(os.environ.get('CACHE_METRICS_FLUSH_INTERVAL', '60'))  # seconds
+    CACHE_METRICS_BYTES_SAMPLE = int(os.environ.get('CACHE_METRICS_BYTES_SAMPLE', '10'))  # 1 in N sets measured (two-tier: every set, free)
+    # Stampede protection (app.cache_stampede)
+    CACHE_STALE_TTL = int(os.environ.get('CACHE_STALE_TTL', '300'))  # seconds an expired entry is still served while one caller refreshes it
+    CACHE_LOCK_TIMEOUT = int(os.environ.get('CACHE_LOCK_TIMEOUT', '10'))  # recompute lock lifetime
+    CACHE_LOCK_WAIT = float(os.environ.get('CACHE_LOCK_WAIT', '2'))  # how long to wait for another worker's result
+    CACHE_EARLY_EXPIRY_BETA = float(os.environ.get('CACHE_EARLY_EXPIRY_BETA', '1.0'))  # 0 disables early refresh
+    # Negative lookups for unknown card slugs and /turnos handles (app.negative_cache)
+    NEGATIVE_CACHE_TTL = int(os.environ.get('NEGATIVE_CACHE_TTL', '60'))
+    NEGATIVE_BLOOM_ENABLED = os.environ.get('NEGATIVE_BLOOM_ENABLED', 'true').lower() == 'true'  # needs the bus below
+    NEGATIVE_BLOOM_ERROR_RATE = float(os.environ.get('NEGATIVE_BLOOM_ERROR_RATE', '0.01'))
+    NEGATIVE_BLOOM_REBUILD = int(os.environ.get('NEGATIVE_BLOOM_REBUILD', '3600'))  # seconds
+    # Cache warm-up (app.cache_warmup): once per worker after its first request, or `flask warm-cache`
+    CACHE_WARM_ON_START = os.environ.get('CACHE_WARM_ON_START', 'false').lower() == 'true'
+    CACHE_WARM_LIMIT = int(os.environ.get('CACHE_WARM_LIMIT', '20'))  # top cards
+    CACHE_WARM_WORKERS = int(os.environ.get('CACHE_WARM_WORKERS', '4'))
+    CACHE_WARM_BUDGET = float(os.environ.get('CACHE_WARM_BUDGET', '20'))  # seconds
+    # Cross-worker invalidation bus (cache_invalidation table polled before each request)
+    CACHE_BUS_ENABLED = os.environ.get('CACHE_BUS_ENABLED', 'true').lower() == 'true'
+    CACHE_BUS_POLL_INTERVAL = float(os.environ.get('CACHE_BUS_POLL_INTERVAL', '1'))  # max staleness in seconds
+    CACHE_BUS_RETENTION = int(os.environ.get('CACHE_BUS_RETENTION', '3600'))  # seconds rows are kept
+
+    # Offline geolocation (binary range file built with `flask import-geoip`)
+    GEOIP_DATABASE = os.environ.get('GEOIP_DATABASE', os.path.join(os.path.dirname(os.path.dirname(__file__)), 'instance', 'geoip.bin'))
+    GEOIP_CACHE_SIZE = int(os.environ.get('GEOIP_CACHE_SIZE', '10000'))
+
+    # Bot/crawler filtering before card views are written
+    BOT_FILTER_ENABLED = os.environ.get('BOT_FILTER_ENABLED', 'true').lower() == 'true'
+    BOT_FILTER_EXTRA_RANGES = os.environ.get('BOT_FILTER_EXTRA_RANGES', '')  # comma-separated CIDRs
+
+    # Session-window view deduplication (repeats bump CardView.hits instead of inserting)
+    VIEW_DEDUP_WINDOW = int(os.environ.get('VIEW_DEDUP_WINDOW', '1800'))  # seconds
+    VIEW_DEDUP_MAX_ENTRIES = int(os.environ.get('VIEW_DEDUP_MAX_ENTRIES', '100000'))
+    VIEW_DEDUP_FLUSH_SIZE = int(os.environ.get('VIEW_DEDUP_FLUSH_SIZE', '50'))
+    VIEW_DEDUP_FLUSH_INTERVAL = int(os.environ.get('VIEW_DEDUP_FLUSH_INTERVAL', '30'))  # seconds
+
+    # Compact card_view storage (interned strings, hashed IPs)
+    VIEW_DIMENSION_CACHE_SIZE = int(os.environ.get('VIEW_DIMENSION_CACHE_SIZE', '5000'))
+    VIEW_IP_HASH_SECRET = os.environ.get('VIEW_IP_HASH_SECRET')  # defaults to SECRET_KEY; keep stable
+
+    # Raw card_view retention; older days are kept as card_view_daily aggregates
+    VIEW_RETENTION_DAYS = int(os.environ.get('VIEW_RETENTION_DAYS', '90'))
+    VIEW_RETENTION_CHUNK_SIZE = int(os.environ.get('VIEW_RETENTION_CHUNK_SIZE', '5000'))
+
+    # Batched per-card view counters and the popular-cards leaderboard built from them
+    VIEW_COUNTER_FLUSH_SIZE = int(os.environ.get('VIEW_COUNTER_FLUSH_SIZE', '20'))
+    VIEW_COUNTER_FLUSH_INTERVAL = int(os.environ.get('VIEW_COUNTER_FLUSH_INTERVAL', '10'))  # seconds
+    LEADERBOARD_SIZE = int(os.environ.get('LEADERBOARD_SIZE', '50'))  # cards kept per window
+    LEADERBOARD_CACHE_TIMEOUT = int(os.environ.get('LEADERBOARD_CACHE_TIMEOUT', '86400'))
+
+    # Live viewers per card: per-worker ring buffers, shared between workers through the cache
+    LIVE_VIEWERS_WINDOW = int(os.environ.get('LIVE_VIEWERS_WINDOW', '60'))  # seconds
+    LIVE_VIEWERS_MAX_VISITORS = int(os.environ.get('LIVE_VIEWERS_MAX_VISITORS', '1000'))  # per card and worker
+    LIVE_VIEWERS_PUBLISH_INTERVAL = int(os.environ.get('LIVE_VIEWERS_PUBLISH_INTERVAL', '2'))  # seconds
+    LIVE_VIEWERS_POLL_INTERVAL = int(os.environ.get('LIVE_VIEWERS_POLL_INTERVAL', '10'))  # dashboard refresh, seconds
+
+    # Booking funnel events (services page, booking form, bookings, tickets)
+    FUNNEL_TRACKING_ENABLED = os.environ.get('FUNNEL_TRACKING_ENABLED', 'true').lower() == 'true'
+    FUNNEL_FLUSH_SIZE = int(os.environ.get('FUNNEL_FLUSH_SIZE', '20'))
+    FUNNEL_FLUSH_INTERVAL = int(os.environ.get('FUNNEL_FLUSH_INTERVAL', '10'))  # seconds
+
+    # Analytics memoization: stale results are served for up to this long while refreshing
+    ANALYTICS_CACHE_STALE_TTL = int(os.environ.get('ANALYTICS_CACHE_STALE_TTL', '3600'))  # seconds
+    ANALYTICS_REFRESH_WORKERS = int(os.environ.get('ANALYTICS_REFRESH_WORKERS', '2'))
 
     # Performance optimization — pool settings only for non-SQLite
     SQLALCHEMY_ENGINE_OPTIONS = (
@@ -3,8 +3,8 @@ from flask_wtf.csrf import validate_csrf
 from flask_login import login_required, current_user
 from functools import wraps
 from sqlalchemy import func
-from ..models import Card, Service, Product, GalleryItem, Theme, CardView, Category, TicketSystem, TicketType, Ticket
-from .. import db, cache
+from ..models import User, Card, Service, Product, GalleryItem, Theme, CardView, Category, TicketSystem, TicketType, Ticket
+from .. import db, cache, cache_bus
 from . import bp
 from .forms import CardForm, ServiceForm, ProductForm, GalleryUploadForm, AvatarUploadForm, ThemeCustomizationForm, ChangePasswordForm
 from ..utils import save_image, save_avatar, delete_file, generate_styled_qr_code, generate_qr_code, generate_qr_code_with_logo, generate_qr_code_with_logo_themed, qr_to_base64, save_qr_code, admin_required, get_user_card_or_404, cleanup_files
@@ -30,12 +30,14 @@ def handle_category_creation(form, category_type):
     # Otherwise use the selected category
     return form.category.data if form.category.data else None
 from ..analytics import AnalyticsService, get_analytics_summary
+from ..funnel import get_user_funnel
 from ..cache_utils import CacheManager
 from ..timezone_utils import now_utc_for_db, get_date_range_utc, format_local_datetime, now_local, today_start_utc
 from datetime import datetime, timedelta
 import os
 import io
 import re
+import time
 
 
 def parse_duration_to_minutes(duration_str):
@@ -71,7 +73,7 @@ def index():
 
     # Calculate total views for user's cards
     total_views = sum(card.get_total_views() for card in cards)
-    total_unique_views = sum(card.get_unique_views() for card in cards)
+    total_unique_views = sum(Card.unique_views_by_card([card.id for card in cards]).values())
     total_views_today = sum(card.get_views_today() for card in cards)
     total_views_this_month = sum(card.get_views_this_month() for card in cards)
 
@@ -1100,6 +1102,7 @@ def analytics():
     # Format aggregated data for charts
     aggregated_analytics = {
         'total_views': analytics_data['total_views'],
+        'raw_views': analytics_data.get('raw_views', analytics_data['total_views']),
         'period_views': analytics_data['period_views'],
         'views_today': global_views_today,
         'growth_rate': growth_rate,
@@ -1116,17 +1119,22 @@ def analytics():
         'mobile', 'android', 'iphone', 'ipad', 'ipod', 'blackberry', 'windows phone'
     ])
 
+    # Booking funnel from the precomputed daily tables
+    funnel = get_user_funnel(current_user.id, days)
+
     # Use PWA template for mobile devices, traditional template for desktop
     if is_mobile:
         return render_template('dashboard/analytics_pwa.html',
                               global_stats=aggregated_analytics,
                               cards_analytics=analytics_data['cards_analytics'],
-                              device_analytics=device_analytics)
+                              device_analytics=device_analytics,
+                              funnel=funnel)
     else:
         return render_template('dashboard/analytics.html',
                               global_stats=aggregated_analytics,
                               cards_analytics=analytics_data['cards_analytics'],
-                              device_analytics=device_analytics)
+                              device_analytics=device_analytics,
+                              funnel=funnel)
 
 
 @bp.route('/analytics-data')
@@ -1209,6 +1217,65 @@ def analytics_data():
     })
 
 
+@bp.route('/images/status')
+@login_required
+def image_status():
+    """Estado del procesamiento en segundo plano de una imagen subida (?file=)"""
+    from ..image_jobs import status_payload
+    from ..upload_store import job_filename
+
+    filename = job_filename(request.args.get('file', ''))
+    if not filename:
+        abort(400)
+
+    response = jsonify(status_payload(filename, current_user.id))
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+@bp.route('/live')
+@login_required
+def live_viewers():
+    """Visitantes en vivo de las tarjetas del usuario con actividad, sumados entre workers (sin consultas)"""
+    from ..live_viewers import get_live_viewers, shared_store
+    
+    live = get_live_viewers()
+    cards = live.cards(shared_store())
+    
+    response = jsonify({
+        'cards': {str(card_id): {'viewers': data['viewers'], 'hits': data['hits']}
+                  for card_id, data in cards.items() if data['owner_id'] == current_user.id},
+        'window_seconds': live.window_seconds,
+        'poll_interval': current_app.config.get('LIVE_VIEWERS_POLL_INTERVAL', 10),
+    })
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+@bp.route('/cards/<int:card_id>/live')
+@login_required
+def card_live_viewers(card_id):
+    """Visitantes en vivo de una tarjeta con la serie por segundo, desde memoria y el cache compartido"""
+    from ..live_viewers import get_live_viewers, shared_store
+    
+    live = get_live_viewers()
+    data = live.cards(shared_store()).get(card_id)
+    if data is None:
+        # Sin actividad: solo se consulta la tarjeta para comprobar el acceso
+        if not current_user.is_admin():
+            get_user_card_or_404(card_id)
+        elif db.session.get(Card, card_id) is None:
+            abort(404)
+        data = {'viewers': 0, 'hits': 0, 'series': [0] * live.window_seconds}
+    elif data.pop('owner_id') != current_user.id and not current_user.is_admin():
+        abort(404)
+    
+    data.update({'card_id': card_id, 'window_seconds': live.window_seconds, 'timestamp': int(time.time())})
+    response = jsonify(data)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
 @bp.route('/cards/<int:id>/visual-editor')
 @login_required
 def visual_editor(id):
@@ -1322,6 +1389,50 @@ def export_analytics():
     
     return response
 
+@bp.route('/export/views')
+@login_required
+def export_views():
+    """Export raw card views (CSV or NDJSON) as a streamed download"""
+    from datetime import datetime, timedelta
+    from flask import Response, stream_with_context
+    from ..view_export import FORMATS, stream_export
+    from ..timezone_utils import local_to_utc
+    
+    export_format = request.args.get('format', 'csv')
+    if export_format not in FORMATS:
+        abort(400)
+    
+    # Own cards by default; admins may export everything with scope=all
+    if request.args.get('scope') == 'all' and current_user.is_admin():
+        card_ids = None
+    else:
+        card_ids = [card_id for (card_id,) in current_user.cards.with_entities(Card.id)]
+    card_id = request.args.get('card_id', type=int)
+    if card_id:
+        if card_ids is not None and card_id not in card_ids:
+            abort(404)
+        card_ids = [card_id]
+    
+    # start/end are local calendar days (end inclusive); since/after_id resume after the last row received
+    try:
+        start = request.args.get('start')
+        start = local_to_utc(datetime.strptime(start, '%Y-%m-%d')) if start else None
+        end = request.args.get('end')
+        end = local_to_utc(datetime.strptime(end, '%Y-%m-%d') + timedelta(days=1)) if end else None
+        since = request.args.get('since')
+        since = datetime.fromisoformat(since) if since else None
+    except ValueError:
+        abort(400)
+    
+    chunks = stream_export(db.session, export_format, start=start, end=end, since=since,
+                           after_id=request.args.get('after_id', type=int), card_ids=card_ids)
+    response = Response(stream_with_context(chunks), mimetype=FORMATS[export_format])
+    response.headers['Content-Disposition'] = (
+        f'attachment; filename="views_{now_local().strftime("%Y%m%d_%H%M%S")}.{export_format}"'
+    )
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
 @bp.route('/cards/<int:card_id>/products/<int:product_id>/delete', methods=['POST'])
 @login_required
 def delete_product(card_id, product_id):
@@ -1351,12 +1462,16 @@ def admin_performance():
     # Get global analytics
     global_analytics = AnalyticsService.get_global_analytics(30)
     
-    # Get cache stats (if available)
-    cache_stats = {
-        'status': 'active',
-        'backend': 'simple',
-        'hit_rate': 'N/A'  # Would need to implement cache metrics
-    }
+    # Cache stats for this worker (per-tier hit rates with the two-tier backend)
+    from ..cache_backends import cache_backend_stats
+    cache_stats = dict(cache_backend_stats(cache), status='active')
+    
+    # Per-family counters of every worker
+    from ..cache_metrics import summarize
+    cache_metrics = summarize(db.session, days=1)
+    if cache_stats.get('hit_rate') == 'N/A' and cache_metrics['totals']['gets']:
+        cache_stats['hit_rate'] = cache_metrics['totals']['hit_rate']
+        cache_stats['lookups'] = cache_metrics['totals']['gets']
     
     # Get system performance metrics
     import psutil
@@ -1366,10 +1481,35 @@ def admin_performance():
         'disk_percent': psutil.disk_usage('/').percent if psutil.disk_usage('/') else 0
     }
     
+    # Bot/prefetch hits dropped before reaching card_view
+    from ..bot_filter import get_bot_filter
+    bot_stats = get_bot_filter().stats()
+    
+    # Recent popularity from the maintained leaderboard
+    from ..leaderboard import get_top_cards
+    trending = {
+        '7d': get_top_cards('7d', 5),
+        '30d': get_top_cards('30d', 5)
+    }
+    
     return render_template('dashboard/admin_performance.html',
                          analytics=global_analytics,
                          cache_stats=cache_stats,
-                         system_stats=system_stats)
+                         cache_metrics=cache_metrics,
+                         system_stats=system_stats,
+                         bot_stats=bot_stats,
+                         trending=trending)
+
+@bp.route('/admin/cache/metrics')
+@login_required
+@admin_required
+def admin_cache_metrics():
+    """Per-family cache counters as JSON (?days=N, default today)"""
+    from ..cache_backends import cache_backend_stats
+    from ..cache_metrics import summarize
+    
+    days = min(max(request.args.get('days', 1, type=int), 1), 90)
+    return jsonify(dict(summarize(db.session, days=days), backend=cache_backend_stats(cache)))
 
 @bp.route('/admin/cache/clear', methods=['POST'])
 @login_required
@@ -1380,10 +1520,11 @@ def admin_clear_cache():
     
     if cache_type == 'all':
         cache.clear()
+        cache_bus.publish('*')
         flash('Toda la cache ha sido limpiada', 'success')
     elif cache_type == 'analytics':
-        # Clear analytics cache
-        cache.delete_many('analytics_*')
+        # Analytics are memoized per namespace; one version bump makes them all stale
+        AnalyticsService.clear_cache()
         flash('Cache de analytics limpiada', 'success')
     elif cache_type == 'cards':
         # Clear cards cache
@@ -1397,8 +1538,12 @@ def admin_clear_cache():
 @admin_required
 def admin_warm_cache():
     """Admin-only cache warming"""
-    CacheManager.warm_popular_cards(10)
-    flash('Cache precalentada para las tarjetas más populares', 'success')
+    report = CacheManager.warm_popular_cards(10)
+    if report:
+        flash(f"Cache precalentada: {report['cards']} tarjetas y {report['templates']} plantillas "
+              f"en {report['elapsed']}s", 'success' if not report['failed'] else 'warning')
+    else:
+        flash('No se pudo precalentar la cache', 'error')
     return redirect(url_for('dashboard.admin_performance'))
 
 @bp.route('/admin/backup')
@@ -1428,45 +1573,23 @@ def admin_backup():
 @login_required
 @admin_required
 def admin_export_full_backup():
-    """Admin-only full system backup"""
-    import json
-    import io
-    
-    # Export all data
-    backup_data = {
-        'users': [],
-        'cards': [],
-        'views': [],
-        'export_date': now_utc_for_db().isoformat()
-    }
-    
-    # Export users (without passwords)
-    for user in User.query.all():
-        backup_data['users'].append({
-            'id': user.id,
-            'email': user.email,
-            'role': user.role,
-            'is_active': user.is_active,
-            'created_at': user.created_at.isoformat() if user.created_at else None
-        })
-    
-    # Export cards
-    for card in Card.query.all():
-        backup_data['cards'].append({
-            'id': card.id,
-            'name': card.name,
-            'slug': card.slug,
-            'owner_id': card.owner_id,
-            'is_public': card.is_public,
-            'created_at': card.created_at.isoformat() if card.created_at else None
-        })
-    
-    # Create JSON response
-    output = json.dumps(backup_data, indent=2)
-    response = make_response(output)
-    response.headers['Content-Type'] = 'application/json'
-    response.headers['Content-Disposition'] = f'attachment; filename="full_backup_{now_local().strftime("%Y%m%d_%H%M%S")}.json"'
-    
+    """Admin-only full system backup, streamed as gzipped NDJSON without credentials"""
+    from flask import Response, stream_with_context
+    from ..backup import iter_backup_chunks
+
+    since = None
+    if request.args.get('since'):
+        try:
+            since = datetime.fromisoformat(request.args['since'])
+        except ValueError:
+            abort(400)
+
+    kind = 'incremental' if since else 'full'
+    filename = f'{kind}_backup_{now_local().strftime("%Y%m%d_%H%M%S")}.ndjson.gz'
+    chunks = iter_backup_chunks(db.session, since=since, compress=True, redact=True)
+    response = Response(stream_with_context(chunks), mimetype='application/gzip')
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response.headers['X-Accel-Buffering'] = 'no'
     return response
 
 @bp.route('/profile', methods=['GET', 'POST'])
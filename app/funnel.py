@@ -0,0 +1,298 @@
+"""
+Booking funnel: card view -> services page -> booking form -> booking / ticket.
+
+The public booking flow records lightweight events into a per-worker
+buffer, keyed by (card_id, service_id, UTC day, stage). Page opens are
+counted once per visitor inside the view dedup window, the same way card
+views are. The buffer is upserted into ``card_funnel_daily`` every few
+events or seconds. The first funnel step, views, comes from
+``card_view_counter``, so building a funnel only reads two small daily
+tables and never joins ``card_view`` with appointments or tickets.
+"""
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+from datetime import timedelta
+
+from sqlalchemy import func
+
+from .analytics_cache import cached_analytics, invalidate_cards
+from .timezone_utils import now_utc_for_db
+from .write_buffer import WriteBuffer, register_exit_flush, upsert
+
+STAGE_LABELS = {
+    'view': 'Visitas a la tarjeta',
+    'services': 'Página de servicios',
+    'booking_form': 'Formulario de reserva',
+    'booking': 'Citas reservadas',
+    'ticket_form': 'Formulario de turnos',
+    'ticket': 'Turnos tomados',
+}
+
+# Steps of each funnel, in order
+BOOKING_STAGES = ('view', 'services', 'booking_form', 'booking')
+TICKET_STAGES = ('view', 'ticket_form', 'ticket')
+
+# Conversions are counted every time; page opens once per visitor and window
+CONVERSION_STAGES = ('booking', 'ticket')
+
+
+class FunnelRecorder(WriteBuffer):
+    """Per-worker buffer of funnel events waiting to be written"""
+
+    def __init__(self, window_seconds=1800, max_entries=100000, flush_size=20, flush_interval=10):
+        super().__init__(flush_size, flush_interval)  # pending: (card_id, service_id, day, stage) -> events
+        self.window_seconds = window_seconds
+        self.max_entries = max_entries
+        self._seen = OrderedDict()  # (card_id, service_id, stage, visitor) -> first seen
+        self.recorded = 0
+        self.repeats = 0
+
+    def _expire(self, now):
+        cutoff = now - self.window_seconds
+        while self._seen:
+            _, first_seen = next(iter(self._seen.items()))
+            if first_seen >= cutoff and len(self._seen) <= self.max_entries:
+                break
+            self._seen.popitem(last=False)
+
+    def record(self, card_id, stage, service_id=None, visitor=None):
+        """Count one event; returns False for page opens already counted for this visitor"""
+        now = time.time()
+        service_id = service_id or 0
+        with self._lock:
+            if visitor and stage not in CONVERSION_STAGES:
+                self._expire(now)
+                key = (card_id, service_id, stage, visitor)
+                if key in self._seen:
+                    self.repeats += 1
+                    return False
+                self._seen[key] = now
+            self._add((card_id, service_id, now_utc_for_db().date(), stage))
+            self.recorded += 1
+        return True
+
+    def flush(self, session):
+        """Upsert buffered events into card_funnel_daily"""
+        pending = self._take()
+        if not pending:
+            return 0
+
+        try:
+            increment_events(session, pending)
+            session.commit()
+        except Exception:
+            session.rollback()
+            self._put_back(pending)
+            return 0
+
+        try:
+            invalidate_cards(session, {card_id for card_id, _, _, _ in pending})
+        except Exception:
+            pass
+        return sum(pending.values())
+
+    def stats(self):
+        with self._lock:
+            return {
+                'recorded': self.recorded,
+                'repeats': self.repeats,
+                'pending_events': sum(self._pending.values()),
+            }
+
+
+def increment_events(session, increments):
+    """Add {(card_id, service_id, day, stage): events} to card_funnel_daily with one upsert"""
+    from .models import CardFunnelDaily
+
+    table = CardFunnelDaily.__table__
+    rows = [{'card_id': card_id, 'service_id': service_id, 'day': day, 'stage': stage, 'events': events}
+            for (card_id, service_id, day, stage), events in increments.items()]
+    upsert(session, table, rows, key=('card_id', 'service_id', 'day', 'stage'), increments=('events',))
+
+
+def record_funnel_event(card_id, stage, service_id=None):
+    """Record a funnel event for the current request (bots and prefetches are ignored)"""
+    from flask import current_app, request
+    from . import db
+    from .analytics import AnalyticsService
+    from .bot_filter import get_bot_filter
+    from .view_dedup import get_deduplicator
+
+    if not current_app.config.get('FUNNEL_TRACKING_ENABLED', True):
+        return
+    try:
+        ip_address = AnalyticsService.get_client_ip(request)
+        bot_filter = get_bot_filter()
+        if bot_filter.classify(request, ip_address, bot_filter.crawler_ranges):
+            return
+
+        visitor = get_deduplicator().visitor_hash(ip_address, request.headers.get('User-Agent', ''))
+        recorder = get_funnel_recorder()
+        recorder.record(card_id, stage, service_id=service_id, visitor=visitor)
+        if recorder.should_flush():
+            recorder.flush(db.session)
+    except Exception as e:
+        # Never break the booking flow because of analytics
+        print(f"Failed to record funnel event: {e}")
+
+
+def _rate(count, previous):
+    return round(count / previous * 100, 1) if previous else 0
+
+
+def build_funnel(counts, stages):
+    """[{stage, label, count, step_rate, total_rate}] for one funnel from {stage: count}"""
+    steps = []
+    first = counts.get(stages[0], 0)
+    previous = None
+    for stage in stages:
+        count = counts.get(stage, 0)
+        steps.append({
+            'stage': stage,
+            'label': STAGE_LABELS[stage],
+            'count': count,
+            'step_rate': _rate(count, previous) if previous is not None else 100,
+            'total_rate': _rate(count, first),
+        })
+        previous = count
+    return steps
+
+
+def funnel_counts(session, card_ids, days=30):
+    """Views and funnel events per card and per service over the last `days` UTC days"""
+    from .models import CardFunnelDaily, CardViewCounter
+
+    start_day = now_utc_for_db().date() - timedelta(days=days - 1)
+    per_card = defaultdict(Counter)
+    per_service = defaultdict(Counter)
+    if not card_ids:
+        return per_card, per_service
+
+    for card_id, views in session.query(CardViewCounter.card_id, func.sum(CardViewCounter.views)).filter(
+            CardViewCounter.card_id.in_(card_ids),
+            CardViewCounter.day >= start_day).group_by(CardViewCounter.card_id):
+        per_card[card_id]['view'] += int(views or 0)
+
+    for card_id, service_id, stage, events in session.query(
+            CardFunnelDaily.card_id, CardFunnelDaily.service_id, CardFunnelDaily.stage,
+            func.sum(CardFunnelDaily.events)).filter(
+            CardFunnelDaily.card_id.in_(card_ids),
+            CardFunnelDaily.day >= start_day).group_by(
+            CardFunnelDaily.card_id, CardFunnelDaily.service_id, CardFunnelDaily.stage):
+        per_card[card_id][stage] += int(events or 0)
+        if service_id:
+            per_service[service_id][stage] += int(events or 0)
+    return per_card, per_service
+
+
+@cached_analytics('user', timeout=300)
+def get_user_funnel(user_id, days=30):
+    """Booking and ticket funnels for a user's cards, overall, per card and per service"""
+    from . import db
+    from .models import Card, Service
+
+    cards = Card.query.filter_by(owner_id=user_id).with_entities(Card.id, Card.name).all()
+    per_card, per_service = funnel_counts(db.session, [card.id for card in cards], days)
+
+    total = Counter()
+    for counts in per_card.values():
+        total.update(counts)
+
+    services = []
+    if per_service:
+        for service in Service.query.filter(Service.id.in_(list(per_service))).order_by(Service.card_id, Service.order_index):
+            counts = per_service[service.id]
+            services.append({
+                'service_id': service.id,
+                'card_id': service.card_id,
+                'name': service.title,
+                'booking_form': counts['booking_form'],
+                'booking': counts['booking'],
+                'conversion_rate': _rate(counts['booking'], counts['booking_form']),
+            })
+
+    return {
+        'days': days,
+        'booking': build_funnel(total, BOOKING_STAGES),
+        'ticket': build_funnel(total, TICKET_STAGES),
+        'cards': {
+            card.id: {
+                'name': card.name,
+                'booking': build_funnel(per_card[card.id], BOOKING_STAGES),
+                'ticket': build_funnel(per_card[card.id], TICKET_STAGES),
+                'services': [s for s in services if s['card_id'] == card.id],
+            }
+            for card in cards
+        },
+        'services': services,
+    }
+
+
+def backfill_conversions(session, days=None):
+    """Rebuild booking/ticket counts in card_funnel_daily from appointment and ticket rows"""
+    from .models import Appointment, Card, CardFunnelDaily, Ticket, TicketSystem
+
+    start = now_utc_for_db() - timedelta(days=days) if days else None
+    totals = Counter()
+
+    day = func.date(Appointment.created_at)
+    query = session.query(Appointment.card_id, Appointment.service_id, day, func.count(Appointment.id))\
+        .filter(Appointment.created_at.isnot(None))
+    if start is not None:
+        query = query.filter(Appointment.created_at >= start)
+    for card_id, service_id, created_day, count in query.group_by(Appointment.card_id, Appointment.service_id, day):
+        totals[(card_id, service_id, _as_date(created_day), 'booking')] += count
+
+    # Tickets belong to the owner's ticket system; they are credited to the owner's first card
+    first_card = {owner_id: card_id for owner_id, card_id in
+                  session.query(Card.owner_id, func.min(Card.id)).group_by(Card.owner_id)}
+    day = func.date(Ticket.created_at)
+    query = session.query(TicketSystem.user_id, day, func.count(Ticket.id))\
+        .join(TicketSystem, TicketSystem.id == Ticket.ticket_system_id)\
+        .filter(Ticket.created_at.isnot(None))
+    if start is not None:
+        query = query.filter(Ticket.created_at >= start)
+    for user_id, created_day, count in query.group_by(TicketSystem.user_id, day):
+        if user_id in first_card:
+            totals[(first_card[user_id], 0, _as_date(created_day), 'ticket')] += count
+
+    existing = session.query(CardFunnelDaily).filter(CardFunnelDaily.stage.in_(CONVERSION_STAGES))
+    if start is not None:
+        existing = existing.filter(CardFunnelDaily.day >= start.date())
+    existing.delete(synchronize_session=False)
+    if totals:
+        session.execute(CardFunnelDaily.__table__.insert(), [
+            {'card_id': card_id, 'service_id': service_id, 'day': created_day, 'stage': stage, 'events': events}
+            for (card_id, service_id, created_day, stage), events in totals.items()
+        ])
+    session.commit()
+    return sum(totals.values())
+
+
+def _as_date(value):
+    from datetime import datetime
+    if isinstance(value, str):
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    return value
+
+
+_recorder = None
+_recorder_lock = threading.Lock()
+
+
+def get_funnel_recorder():
+    """Process-wide funnel buffer configured from FUNNEL_* settings"""
+    global _recorder
+    if _recorder is None:
+        from flask import current_app
+        with _recorder_lock:
+            if _recorder is None:
+                config = current_app.config
+                _recorder = FunnelRecorder(
+                    window_seconds=config.get('VIEW_DEDUP_WINDOW', 1800),
+                    flush_size=config.get('FUNNEL_FLUSH_SIZE', 20),
+                    flush_interval=config.get('FUNNEL_FLUSH_INTERVAL', 10),
+                )
+                register_exit_flush(current_app._get_current_object(), lambda db: _recorder.flush(db.session))
+    return _recorder
@@ -0,0 +1,266 @@
+"""
+Offline IP geolocation backed by a memory-mapped range table.
+
+The database is a single binary file produced by ``flask import-geoip``.
+Ranges are stored as fixed-width big-endian columns (4 bytes for IPv4,
+16 bytes for IPv6) so a plain byte comparison matches numeric order and
+``bisect`` can search the mapped file directly without loading it.
+
+Layout::
+
+    header   MAGIC + <IIIQQQQ> (v4_count, v6_count, loc_count,
+                                v4_offset, v6_offset, loc_offset, str_offset)
+    v4       starts[n] | ends[n] | loc_index[n] (uint32 LE)
+    v6       starts[n] | ends[n] | loc_index[n] (uint32 LE)
+    loc      (str_offset uint32 LE, length uint16 LE) per location
+    strings  utf-8 "country\\x1fcity" blobs
+"""
+import bisect
+import csv
+import ipaddress
+import mmap
+import os
+import struct
+import threading
+from functools import lru_cache
+
+MAGIC = b'VCGEOIP1'
+HEADER = struct.Struct('<IIIQQQQ')
+LOC_ENTRY = struct.Struct('<IH')
+INDEX = struct.Struct('<I')
+SEPARATOR = '\x1f'
+
+# Column presets for common free CSV dumps (start, end, country, city)
+CSV_FORMATS = {
+    'simple': (0, 1, 2, 3),        # start,end,country,city
+    'dbip': (0, 1, 3, 5),          # DB-IP lite: start,end,continent,country,region,city
+    'ip2location': (0, 1, 3, 5),   # IP2Location lite: from,to,code,country,region,city
+}
+
+
+class _Column:
+    """Read-only sequence view over fixed-width keys inside a mmap."""
+
+    def __init__(self, buf, offset, width, count):
+        self.buf = buf
+        self.offset = offset
+        self.width = width
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        start = self.offset + index * self.width
+        return self.buf[start:start + self.width]
+
+
+class GeoIPDatabase:
+    """Binary-search IP range lookups over a memory-mapped file."""
+
+    def __init__(self, path, cache_size=10000):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mm[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f'{path} is not a GeoIP range database')
+
+        (v4_count, v6_count, self._loc_count,
+         v4_offset, v6_offset, self._loc_offset, self._str_offset) = HEADER.unpack_from(self._mm, len(MAGIC))
+
+        self._tables = {
+            4: self._table(v4_offset, 4, v4_count),
+            6: self._table(v6_offset, 16, v6_count),
+        }
+
+        # Per-IP result cache; misses are cached too so repeated unknown
+        # visitors never hit the binary search twice.
+        self.lookup = lru_cache(maxsize=cache_size)(self._lookup)
+
+    def _table(self, offset, width, count):
+        return {
+            'starts': _Column(self._mm, offset, width, count),
+            'ends': _Column(self._mm, offset + width * count, width, count),
+            'locs': offset + 2 * width * count,
+            'count': count,
+        }
+
+    def _location(self, index):
+        str_offset, length = LOC_ENTRY.unpack_from(self._mm, self._loc_offset + index * LOC_ENTRY.size)
+        start = self._str_offset + str_offset
+        country, _, city = self._mm[start:start + length].decode('utf-8').partition(SEPARATOR)
+        return country or None, city or None
+
+    def _lookup(self, ip_string):
+        """Return (country, city) for an IP string, or (None, None)."""
+        try:
+            ip = ipaddress.ip_address(ip_string.strip())
+        except (ValueError, AttributeError):
+            return None, None
+
+        if ip.version == 6 and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+        if not ip.is_global:
+            return None, None
+
+        table = self._tables[ip.version]
+        if not table['count']:
+            return None, None
+
+        key = ip.packed
+        index = bisect.bisect_right(table['starts'], key) - 1
+        if index < 0 or table['ends'][index] < key:
+            return None, None
+
+        loc_index = INDEX.unpack_from(self._mm, table['locs'] + index * INDEX.size)[0]
+        return self._location(loc_index)
+
+    def stats(self):
+        """Basic information about the loaded database."""
+        info = self.lookup.cache_info()
+        return {
+            'path': self.path,
+            'ipv4_ranges': self._tables[4]['count'],
+            'ipv6_ranges': self._tables[6]['count'],
+            'locations': self._loc_count,
+            'cache_hits': info.hits,
+            'cache_misses': info.misses,
+            'cache_size': info.currsize,
+        }
+
+    def close(self):
+        try:
+            self._mm.close()
+        finally:
+            self._file.close()
+
+
+_database = None
+_database_lock = threading.Lock()
+_database_unavailable = False
+
+
+def get_geoip():
+    """Return the process-wide GeoIP database or None if not configured."""
+    global _database, _database_unavailable
+    if _database is not None or _database_unavailable:
+        return _database
+
+    from flask import current_app
+    path = current_app.config.get('GEOIP_DATABASE')
+
+    with _database_lock:
+        if _database is None and not _database_unavailable:
+            if not path or not os.path.exists(path):
+                _database_unavailable = True
+                return None
+            try:
+                _database = GeoIPDatabase(path, current_app.config.get('GEOIP_CACHE_SIZE', 10000))
+            except (OSError, ValueError) as e:
+                current_app.logger.warning(f'GeoIP database could not be loaded: {e}')
+                _database_unavailable = True
+    return _database
+
+
+def lookup_ip(ip_address):
+    """Resolve an IP to (country, city) using the local database."""
+    if not ip_address:
+        return None, None
+    database = get_geoip()
+    if database is None:
+        return None, None
+    return database.lookup(ip_address)
+
+
+def _parse_ip(value):
+    """Parse a CSV IP column: dotted/colon notation or an integer."""
+    value = value.strip()
+    if value.isdigit():
+        number = int(value)
+        return ipaddress.IPv4Address(number) if number <= 0xFFFFFFFF else ipaddress.IPv6Address(number)
+    return ipaddress.ip_address(value)
+
+
+def build_database(csv_path, output_path, columns=CSV_FORMATS['simple'], skip_header=False):
+    """
+    Convert a CSV range dump into the binary lookup format.
+    Returns a dict with the number of imported and skipped rows.
+    """
+    start_col, end_col, country_col, city_col = columns
+    ranges = {4: [], 6: []}
+    locations = {}
+    skipped = 0
+
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        if skip_header:
+            next(reader, None)
+        for row in reader:
+            try:
+                start = _parse_ip(row[start_col])
+                end = _parse_ip(row[end_col])
+            except (ValueError, IndexError):
+                skipped += 1
+                continue
+
+            # IPv4-mapped IPv6 ranges are stored in the IPv4 table
+            if start.version == 6 and start.ipv4_mapped and end.ipv4_mapped:
+                start, end = start.ipv4_mapped, end.ipv4_mapped
+            if start.version != end.version or start > end:
+                skipped += 1
+                continue
+
+            country = row[country_col].strip() if len(row) > country_col else ''
+            city = row[city_col].strip() if city_col is not None and len(row) > city_col else ''
+            if country in ('', '-'):
+                skipped += 1
+                continue
+            if city == '-':
+                city = ''
+
+            location = f'{country[:100]}{SEPARATOR}{city[:100]}'
+            loc_index = locations.setdefault(location, len(locations))
+            ranges[start.version].append((start.packed, end.packed, loc_index))
+
+    for version in ranges:
+        ranges[version].sort()
+
+    strings = bytearray()
+    loc_entries = bytearray()
+    for location in locations:
+        encoded = location.encode('utf-8')
+        loc_entries += LOC_ENTRY.pack(len(strings), len(encoded))
+        strings += encoded
+
+    def pack_table(records):
+        return (b''.join(r[0] for r in records)
+                + b''.join(r[1] for r in records)
+                + b''.join(INDEX.pack(r[2]) for r in records))
+
+    v4_blob = pack_table(ranges[4])
+    v6_blob = pack_table(ranges[6])
+
+    v4_offset = len(MAGIC) + HEADER.size
+    v6_offset = v4_offset + len(v4_blob)
+    loc_offset = v6_offset + len(v6_blob)
+    str_offset = loc_offset + len(loc_entries)
+
+    tmp_path = f'{output_path}.tmp'
+    with open(tmp_path, 'wb') as out:
+        out.write(MAGIC)
+        out.write(HEADER.pack(len(ranges[4]), len(ranges[6]), len(locations),
+                              v4_offset, v6_offset, loc_offset, str_offset))
+        out.write(v4_blob)
+        out.write(v6_blob)
+        out.write(loc_entries)
+        out.write(strings)
+    os.replace(tmp_path, output_path)
+
+    return {
+        'ipv4_ranges': len(ranges[4]),
+        'ipv6_ranges': len(ranges[6]),
+        'locations': len(locations),
+        'skipped': skipped,
+    }
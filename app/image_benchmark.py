@@ -0,0 +1,133 @@
+"""
+Benchmark of the upload pipeline (``flask benchmark-image-pipeline``).
+
+Compares the single-decode pipeline in utils (validate_file_content +
+process_image) with the path it replaced. The old path opened the image
+twice to validate it, decoded it at full size, copied it through two
+full-size buffers in sanitize_image and only then resized. Inputs are
+synthetic photos (fractal detail, gradients and mild sensor-like
+noise, about the file size of camera JPEGs) and a transparent PNG.
+"""
+import io
+import os
+import tempfile
+import time
+
+from PIL import Image, ImageChops
+
+from .utils import process_image, validate_file_content
+
+SCENARIOS = (
+    ('JPEG 4000x3000', 'JPEG', (4000, 3000)),
+    ('JPEG 2000x1500', 'JPEG', (2000, 1500)),
+    ('JPEG 1024x768', 'JPEG', (1024, 768)),
+    ('PNG RGBA 1600x1200', 'PNG', (1600, 1200)),
+)
+
+
+class _Upload(io.BytesIO):
+    """Enough of a FileStorage for validate_file_content"""
+
+    def __init__(self, data, filename):
+        super().__init__(data)
+        self.filename = filename
+
+    @property
+    def stream(self):
+        return self
+
+
+def make_sample(image_format, size):
+    """Encoded bytes of a photo-like test image"""
+    gradient = Image.linear_gradient('L').resize(size)
+    detail = Image.effect_mandelbrot(size, (-2.0, -1.2, 0.8, 1.2), 64)
+    noise = Image.effect_noise(size, 12)
+    image = Image.merge('RGB', (
+        ImageChops.add(detail, noise, scale=1.2),
+        gradient,
+        ImageChops.blend(detail, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT), 0.5),
+    ))
+    out = io.BytesIO()
+    if image_format == 'PNG':
+        image.putalpha(Image.linear_gradient('L').resize(size))
+        image.save(out, 'PNG')
+    else:
+        image.save(out, 'JPEG', quality=92)
+    return out.getvalue()
+
+
+def _legacy_sanitize(image):
+    if image.mode in ('RGBA', 'LA', 'P'):
+        rgb_image = Image.new('RGB', image.size, (255, 255, 255))
+        if image.mode == 'RGBA':
+            rgb_image.paste(image, mask=image.split()[-1])
+        elif image.mode == 'P' and 'transparency' in image.info:
+            image = image.convert('RGBA')
+            rgb_image.paste(image, mask=image.split()[-1])
+        else:
+            rgb_image.paste(image)
+        image = rgb_image
+    clean_image = Image.new(image.mode, image.size)
+    clean_image.paste(image)
+    return clean_image
+
+
+def legacy_pipeline(upload, file_path, thumbnail_file_path, max_size=(800, 800), thumbnail_size=(150, 150)):
+    """The previous validate + save_image path, kept only for comparison"""
+    upload.seek(0)
+    img = Image.open(upload)
+    img.verify()
+    upload.seek(0)
+    Image.open(upload).format
+    upload.seek(0)
+
+    image = _legacy_sanitize(Image.open(upload))
+    image.thumbnail(max_size, Image.Resampling.LANCZOS)
+    image.save(file_path, 'JPEG', quality=85, optimize=True)
+    thumbnail = image.copy()
+    thumbnail.thumbnail(thumbnail_size, Image.Resampling.LANCZOS)
+    thumbnail.save(thumbnail_file_path, 'JPEG', quality=80, optimize=True)
+
+
+def current_pipeline(upload, file_path, thumbnail_file_path, max_size=(800, 800), thumbnail_size=(150, 150)):
+    is_valid, error = validate_file_content(upload)
+    if not is_valid:
+        raise ValueError(error)
+    process_image(upload, file_path, thumbnail_file_path, max_size, thumbnail_size)
+
+
+def _time(pipeline, data, filename, iterations, workdir):
+    file_path = os.path.join(workdir, 'main.jpg')
+    thumbnail_path = os.path.join(workdir, 'thumb.jpg')
+    timings = []
+    for _ in range(iterations):
+        upload = _Upload(data, filename)
+        started = time.perf_counter()
+        pipeline(upload, file_path, thumbnail_path)
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return {
+        'median_ms': round(timings[len(timings) // 2] * 1000, 1),
+        'best_ms': round(timings[0] * 1000, 1),
+        'main_bytes': os.path.getsize(file_path),
+        'thumb_bytes': os.path.getsize(thumbnail_path),
+    }
+
+
+def run_benchmark(iterations=5, scenarios=SCENARIOS):
+    """Time both pipelines on each scenario; returns one result dict per scenario"""
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for name, image_format, size in scenarios:
+            data = make_sample(image_format, size)
+            filename = 'sample.png' if image_format == 'PNG' else 'sample.jpg'
+            legacy = _time(legacy_pipeline, data, filename, iterations, workdir)
+            current = _time(current_pipeline, data, filename, iterations, workdir)
+            results.append({
+                'scenario': name,
+                'input_bytes': len(data),
+                'legacy': legacy,
+                'current': current,
+                'speedup': round(legacy['median_ms'] / current['median_ms'], 2) if current['median_ms'] else None,
+            })
+    return results
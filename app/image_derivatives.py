@@ -0,0 +1,311 @@
+"""
+Responsive derivatives of uploaded images.
+
+Every gallery item, product image, service image and card avatar gets a
+ladder of widths (IMAGE_DERIVATIVE_WIDTHS) in WebP and JPEG, written to
+``static/derived/<path under uploads without extension>/<width>.<ext>``.
+Widths above the source are skipped and the source width itself is
+always included, so small avatars get a short ladder.
+
+Uploads build their derivatives from the already decoded main image
+(utils.process_image / process_avatar). ``flask build-image-derivatives``
+backfills existing uploads on a process pool. It is incremental: each
+directory has a ``.source`` marker recording the source size, mtime and
+ladder, and up-to-date images are skipped without being decoded.
+
+Templates call ``responsive_image(path, ...)``. It renders a
+``<picture>`` with a WebP ``<source>`` and a JPEG ``srcset``. When an
+image has no derivatives yet, it renders a plain ``<img>``.
+"""
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from markupsafe import Markup, escape
+
+DERIVED_DIR = 'derived'
+MARKER = '.source'
+EXTENSIONS = {'webp': 'webp', 'jpeg': 'jpg'}
+SAVE_FORMATS = {'webp': 'WEBP', 'jpeg': 'JPEG'}
+
+
+def _config(name, default):
+    from flask import current_app
+    return current_app.config.get(name, default)
+
+
+def _parse_list(value):
+    if isinstance(value, str):
+        value = value.split(',')
+    return [str(item).strip().lower() for item in value if str(item).strip()]
+
+
+def ladder():
+    return sorted({int(width) for width in _parse_list(_config('IMAGE_DERIVATIVE_WIDTHS', '160,320,480,640,800'))})
+
+
+def formats():
+    return [fmt for fmt in _parse_list(_config('IMAGE_DERIVATIVE_FORMATS', 'webp,jpeg')) if fmt in EXTENSIONS]
+
+
+def enabled():
+    try:
+        return bool(_config('IMAGE_DERIVATIVES_ENABLED', True))
+    except RuntimeError:
+        return False
+
+
+def static_root():
+    from flask import current_app
+    return os.path.join(current_app.root_path, 'static')
+
+
+def derived_dir(relpath, root=None):
+    """Directory of an upload's derivatives; relpath is relative to static/uploads"""
+    stem = os.path.splitext(os.path.normpath(relpath))[0]
+    return os.path.join(root or static_root(), DERIVED_DIR, stem)
+
+
+def spec_for(source_path):
+    """Everything a pool process needs to build derivatives of an upload, or None"""
+    if not enabled():
+        return None
+    uploads = os.path.join(static_root(), 'uploads')
+    relpath = os.path.relpath(source_path, uploads)
+    if relpath.startswith('..'):
+        return None
+    return {
+        'source': source_path,
+        'out_dir': derived_dir(relpath),
+        'widths': ladder(),
+        'formats': formats(),
+        'quality': {'webp': _config('IMAGE_WEBP_QUALITY', 80), 'jpeg': _config('IMAGE_JPEG_QUALITY', 82)},
+    }
+
+
+def _marker_value(source, widths, fmts):
+    stat = os.stat(source)
+    return f"{stat.st_size}:{stat.st_mtime_ns}:{','.join(map(str, widths))}:{','.join(fmts)}"
+
+
+def is_current(spec):
+    try:
+        with open(os.path.join(spec['out_dir'], MARKER)) as marker:
+            return marker.read() == _marker_value(spec['source'], spec['widths'], spec['formats'])
+    except OSError:
+        return False
+
+
+def _tmp_name(path):
+    # Uploads of the same bytes share a derivative directory
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+def _save(image, path, fmt, quality):
+    tmp_path = _tmp_name(path)
+    try:
+        if fmt == 'webp':
+            image.save(tmp_path, 'WEBP', quality=quality, method=4)
+        else:
+            image.save(tmp_path, 'JPEG', quality=quality, optimize=True, progressive=True)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return os.path.getsize(path)
+
+
+def build_derivatives(spec, image=None, force=False):
+    """Write the ladder for one upload. `image` is the decoded source when the
+    caller already has it. Returns {'status': 'built'|'current'|'missing', 'files', 'bytes'}"""
+    from PIL import Image
+    from .utils import draft_image, fit_image, sanitize_image
+
+    source, out_dir = spec['source'], spec['out_dir']
+    if not os.path.exists(source):
+        return {'status': 'missing', 'files': 0, 'bytes': 0}
+    if not force and image is None and is_current(spec):
+        return {'status': 'current', 'files': 0, 'bytes': 0}
+
+    if image is None:
+        image = Image.open(source)
+        largest = max([w for w in spec['widths'] if w <= image.width] or [image.width])
+        image = sanitize_image(draft_image(image, largest / image.width))
+    widths = [w for w in spec['widths'] if w < image.width] + [image.width]
+
+    os.makedirs(out_dir, exist_ok=True)
+    written, total = set(), 0
+    for width in widths:
+        resized = fit_image(image, (width, image.height))
+        for fmt in spec['formats']:
+            name = f"{width}.{EXTENSIONS[fmt]}"
+            total += _save(resized, os.path.join(out_dir, name), fmt, spec['quality'][fmt])
+            written.add(name)
+
+    # Files from an older ladder (not another writer's temporary files)
+    for entry in os.scandir(out_dir):
+        if (entry.is_file() and entry.name != MARKER and entry.name not in written
+                and not entry.name.endswith('.tmp')):
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    marker_path = os.path.join(out_dir, MARKER)
+    with open(_tmp_name(marker_path), 'w') as marker:
+        marker.write(_marker_value(source, spec['widths'], spec['formats']))
+    os.replace(_tmp_name(marker_path), marker_path)
+    _forget(out_dir)
+    return {'status': 'built', 'files': len(written), 'bytes': total}
+
+
+def remove_derivatives(relpath):
+    shutil.rmtree(derived_dir(relpath), ignore_errors=True)
+    _forget(derived_dir(relpath))
+
+
+# Per-worker memo of which derivatives exist, so rendering does not stat every file
+_listing = {}
+_listing_lock = threading.Lock()
+LISTING_TTL = 60
+LISTING_MAX = 5000
+
+
+def _forget(out_dir):
+    with _listing_lock:
+        _listing.pop(out_dir, None)
+
+
+def available(relpath):
+    """{'webp': [widths], 'jpeg': [widths]} for an upload, empty when not built"""
+    out_dir = derived_dir(relpath)
+    now = time.time()
+    with _listing_lock:
+        entry = _listing.get(out_dir)
+    if entry is not None and now - entry[0] < LISTING_TTL:
+        return entry[1]
+
+    found = {}
+    try:
+        for item in os.scandir(out_dir):
+            width, _, ext = item.name.partition('.')
+            fmt = next((fmt for fmt, extension in EXTENSIONS.items() if extension == ext), None)
+            if fmt and width.isdigit():
+                found.setdefault(fmt, []).append(int(width))
+    except OSError:
+        pass
+    for widths in found.values():
+        widths.sort()
+
+    with _listing_lock:
+        if len(_listing) >= LISTING_MAX:
+            _listing.clear()
+        _listing[out_dir] = (now, found)
+    return found
+
+
+def srcset(relpath, fmt='jpeg'):
+    """srcset attribute value for one format, '' when there are no derivatives"""
+    from flask import url_for
+
+    if not relpath:
+        return ''
+    stem = os.path.splitext(os.path.normpath(relpath))[0].replace(os.sep, '/')
+    return ', '.join(
+        f"{url_for('static', filename=f'{DERIVED_DIR}/{stem}/{width}.{EXTENSIONS[fmt]}')} {width}w"
+        for width in available(relpath).get(fmt, [])
+    )
+
+
+def responsive_image(relpath, src=None, sizes='100vw', alt='', class_=None, **attrs):
+    """<picture> with WebP and JPEG srcsets for an upload (path relative to static/uploads).
+
+    `src` overrides the fallback URL (e.g. a thumbnail or a cache-busted
+    avatar URL). Extra keyword arguments become attributes of the <img>.
+    """
+    from flask import url_for
+
+    if not relpath:
+        return Markup('')
+    if src is None:
+        src = url_for('static', filename=f'uploads/{relpath}')
+    if class_:
+        attrs['class'] = class_
+    extra = ''.join(f' {escape(name.replace("_", "-"))}="{escape(value)}"'
+                    for name, value in attrs.items() if value is not None)
+
+    webp, jpeg = srcset(relpath, 'webp'), srcset(relpath, 'jpeg')
+    if not (webp or jpeg):
+        return Markup(f'<img src="{escape(src)}" alt="{escape(alt)}"{extra}>')
+
+    parts = ['<picture style="display: contents">']
+    if webp:
+        parts.append(f'<source type="image/webp" srcset="{escape(webp)}" sizes="{escape(sizes)}">')
+    img_srcset = f' srcset="{escape(jpeg)}" sizes="{escape(sizes)}"' if jpeg else ''
+    parts.append(f'<img src="{escape(src)}"{img_srcset} alt="{escape(alt)}"{extra}>')
+    parts.append('</picture>')
+    return Markup(''.join(parts))
+
+
+def referenced_uploads(session):
+    """Every upload path (relative to static/uploads) that should have derivatives"""
+    from sqlalchemy import select, union
+    from .models import Card, GalleryItem, Product, Service
+
+    query = union(
+        select(GalleryItem.image_path.label('path')),
+        select(Product.image_path), select(Service.image_path),
+        select(Card.avatar_square_path), select(Card.avatar_rect_path), select(Card.avatar_path),
+    )
+    for (path,) in session.execute(query.execution_options(yield_per=1000)):
+        if path:
+            yield path
+
+
+def _build_one(spec, force):
+    try:
+        return spec['source'], build_derivatives(spec, force=force), None
+    except Exception as e:
+        return spec['source'], None, str(e)
+
+
+def backfill(session, workers=None, force=False, progress=None):
+    """Build missing or outdated derivatives of every referenced upload on a process pool"""
+    if not enabled():
+        return None
+    uploads = os.path.join(static_root(), 'uploads')
+    report = {'images': 0, 'built': 0, 'current': 0, 'missing': 0, 'failed': [], 'files': 0, 'bytes': 0}
+    started = time.time()
+
+    specs = []
+    for relpath in referenced_uploads(session):
+        report['images'] += 1
+        spec = spec_for(os.path.join(uploads, relpath))
+        if spec is None or not os.path.exists(spec['source']):
+            report['missing'] += 1
+        elif not force and is_current(spec):
+            report['current'] += 1  # checked here so the pool only gets real work
+        else:
+            specs.append(spec)
+
+    if specs:
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+            futures = [pool.submit(_build_one, spec, force) for spec in specs]
+            for done, future in enumerate(as_completed(futures), 1):
+                source, result, error = future.result()
+                if error:
+                    report['failed'].append(f'{source}: {error}')
+                else:
+                    report[result['status']] += 1
+                    report['files'] += result['files']
+                    report['bytes'] += result['bytes']
+                if progress:
+                    progress(done, len(specs))
+
+    with _listing_lock:
+        _listing.clear()
+    report['elapsed'] = round(time.time() - started, 2)
+    return report
@@ -0,0 +1,417 @@
+"""
+Background processing of uploaded images.
+
+With IMAGE_JOBS_ENABLED, ``save_image`` and ``save_avatar`` no longer
+decode and resize during the request. They validate the upload, store
+the original under IMAGE_JOB_STAGING_DIR, record an ``image_job`` row
+and hand the work to this worker's process pool. The filenames they
+return are final: the resized files appear under those names once the
+job is done. Until then, clients can poll the job status by filename
+(dashboard and mobile API endpoints).
+
+- The pool has IMAGE_JOB_WORKERS processes. At most IMAGE_QUEUE_MAX jobs
+  are in flight per worker; past that, uploads are processed inline, as
+  before, instead of queueing without bound.
+- A failed job is retried with backoff up to IMAGE_JOB_MAX_ATTEMPTS.
+- Jobs are claimed with a conditional UPDATE, so a job is only run by
+  one process.
+- Jobs left pending, or in 'running' for more than IMAGE_JOB_STALE_AFTER
+  seconds, belonged to a worker that died. Each worker reclaims them in
+  the background the first time it uses its pool. A job abandoned while
+  every worker stays up is only picked up by ``flask process-image-jobs``,
+  so run it on a schedule (cron, every few minutes).
+"""
+import json
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+
+from sqlalchemy import select, update
+
+from .timezone_utils import now_utc_for_db
+
+RETRY_BACKOFF = 2  # seconds, doubled on every attempt
+
+
+def _config(name, default):
+    from flask import current_app
+    return current_app.config.get(name, default)
+
+
+def enabled():
+    try:
+        return bool(_config('IMAGE_JOBS_ENABLED', False))
+    except RuntimeError:
+        return False
+
+
+def run_job(kind, staging_path, params):
+    """Runs in the pool process: write every output of one job"""
+    from .utils import process_image, process_avatar
+
+    outputs = params['outputs']
+    if kind == 'avatar':
+        process_avatar(staging_path, outputs[0], outputs[1],
+                       tuple(params['square_size']), tuple(params['rect_size']), params.get('derivatives'))
+    else:
+        process_image(staging_path, outputs[0], outputs[1],
+                      tuple(params['max_size']), tuple(params['thumbnail_size']), params.get('derivatives'))
+    return outputs
+
+
+class ImagePool:
+    """Per-worker process pool with a bounded number of jobs in flight"""
+
+    def __init__(self, workers=2, max_queue=16, max_attempts=3):
+        self.workers = max(workers, 1)
+        self.max_queue = max_queue
+        self.max_attempts = max_attempts
+        self._executor = None
+        self._inflight = 0
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        if self._executor is None:
+            # spawn: forking a process that holds DB connections and threads is unsafe
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    def _reset_executor(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def reserve(self):
+        """Take a slot in the queue; False when it is full"""
+        with self._lock:
+            if self._inflight >= self.max_queue:
+                return False
+            self._inflight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self._inflight = max(self._inflight - 1, 0)
+
+    @property
+    def inflight(self):
+        with self._lock:
+            return self._inflight
+
+    def submit(self, engine, job):
+        """Run a claimed job in the pool; the slot must already be reserved"""
+        try:
+            with self._lock:
+                executor = self._get_executor()
+            future = executor.submit(run_job, job['kind'], job['staging_path'], job['params'])
+        except Exception as e:
+            self._reset_executor()
+            self._finish(engine, job, e)
+            return
+        future.add_done_callback(lambda f: self._finish(engine, job, f.exception()))
+
+    def _finish(self, engine, job, error):
+        try:
+            if isinstance(error, BrokenProcessPool):
+                self._reset_executor()
+            if error is None:
+                mark_done(engine, job)
+            elif job['attempts'] < self.max_attempts:
+                # Back to pending: the timer below or the drain command claims it again
+                mark_pending(engine, job, error)
+                delay = RETRY_BACKOFF * 2 ** (job['attempts'] - 1)
+                timer = threading.Timer(delay, self._retry, args=(engine, job['id']))
+                timer.daemon = True
+                timer.start()
+                return
+            else:
+                mark_failed(engine, job, error)
+        except Exception as e:
+            print(f"Image job {job['id']} bookkeeping failed: {e}")
+        self.release()
+
+    def _retry(self, engine, job_id):
+        try:
+            job = claim(engine, job_id)
+        except Exception as e:
+            print(f"Image job {job_id} retry failed: {e}")
+            job = None
+        if job is None:
+            self.release()  # another process took it
+            return
+        self.submit(engine, job)
+
+    def recover(self, engine, stale_after=600, limit=100):
+        """Resubmit jobs abandoned by dead workers, as far as the queue allows; returns how many"""
+        rows, stale_before = abandoned_jobs(engine, stale_after, limit)
+        resubmitted = 0
+        for job_id, status in rows:
+            if not self.reserve():
+                break
+            job = claim(engine, job_id, status, stale_before if status == 'running' else None)
+            if job is None:
+                self.release()  # another process took it
+                continue
+            self.submit(engine, job)
+            resubmitted += 1
+        return resubmitted
+
+    def shutdown(self):
+        self._reset_executor()
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_image_pool():
+    """This worker's pool; a forked worker gets its own and reclaims abandoned jobs with it"""
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool = ImagePool(
+                    workers=_config('IMAGE_JOB_WORKERS', 2),
+                    max_queue=_config('IMAGE_QUEUE_MAX', 16),
+                    max_attempts=_config('IMAGE_JOB_MAX_ATTEMPTS', 3),
+                )
+                _pool_pid = os.getpid()
+                _start_recovery(_pool)
+    return _pool
+
+
+def _start_recovery(pool):
+    from . import db
+
+    engine = db.engine
+    stale_after = _config('IMAGE_JOB_STALE_AFTER', 600)
+
+    def recover():
+        try:
+            pool.recover(engine, stale_after)
+        except Exception as e:
+            print(f"Image job recovery failed: {e}")
+
+    threading.Thread(target=recover, name='image-job-recovery', daemon=True).start()
+
+
+def _table():
+    from .models import ImageJob
+    return ImageJob.__table__
+
+
+def _job_dict(row):
+    return {
+        'id': row.id,
+        'kind': row.kind,
+        'filename': row.filename,
+        'staging_path': row.staging_path,
+        'params': json.loads(row.params),
+        'attempts': row.attempts,
+    }
+
+
+def claim(engine, job_id, status='pending', started_before=None):
+    """Move a job to 'running' if it is still in `status`; returns it or None"""
+    table = _table()
+    conditions = [table.c.id == job_id, table.c.status == status]
+    if started_before is not None:
+        conditions.append(table.c.started_at < started_before)
+    with engine.begin() as connection:
+        claimed = connection.execute(
+            update(table).where(*conditions)
+            .values(status='running', attempts=table.c.attempts + 1, started_at=now_utc_for_db())
+        ).rowcount
+        if not claimed:
+            return None
+        row = connection.execute(select(table).where(table.c.id == job_id)).one()
+    return _job_dict(row)
+
+
+def _remove_staging(job):
+    try:
+        os.remove(job['staging_path'])
+    except OSError:
+        pass
+
+
+def mark_done(engine, job):
+    with engine.begin() as connection:
+        connection.execute(update(_table()).where(_table().c.id == job['id'])
+                           .values(status='done', error=None, finished_at=now_utc_for_db()))
+    _remove_staging(job)
+
+
+def mark_pending(engine, job, error):
+    with engine.begin() as connection:
+        connection.execute(update(_table()).where(_table().c.id == job['id'])
+                           .values(status='pending', error=str(error)[:1000]))
+
+
+def mark_failed(engine, job, error):
+    from . import upload_store
+
+    print(f"Image job {job['id']} ({job['filename']}) failed: {error}")
+    with engine.begin() as connection:
+        connection.execute(update(_table()).where(_table().c.id == job['id'])
+                           .values(status='failed', error=str(error)[:1000], finished_at=now_utc_for_db()))
+    if not upload_store.is_content_addressed(job['filename']):
+        # A content-addressed output may be another upload's
+        for path in job['params']['outputs']:
+            if os.path.exists(path):
+                os.remove(path)
+    _remove_staging(job)
+
+
+def _stage(file, filename):
+    staging_dir = _config('IMAGE_JOB_STAGING_DIR', None)
+    os.makedirs(staging_dir, exist_ok=True)
+    # Content-addressed names contain directories; staging stays flat
+    staging_path = os.path.join(staging_dir, f"{filename.replace('/', '_')}.orig")
+    tmp_path = f"{staging_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    file.stream.seek(0)
+    with open(tmp_path, 'wb') as out:
+        while True:
+            chunk = file.stream.read(1024 * 1024)
+            if not chunk:
+                break
+            out.write(chunk)
+    os.replace(tmp_path, staging_path)
+    return staging_path
+
+
+def _current_user_id():
+    try:
+        from flask_login import current_user
+        return current_user.id if current_user.is_authenticated else None
+    except Exception:
+        return None
+
+
+def enqueue(kind, file, filename, outputs, options, user_id=None):
+    """Stage the upload and start its job; processes inline when the queue is full"""
+    from . import db
+    from .utils import process_image, process_avatar
+
+    pool = get_image_pool()
+    if not pool.reserve():
+        if kind == 'avatar':
+            process_avatar(file.stream, outputs[0], outputs[1], options['square_size'], options['rect_size'],
+                           options.get('derivatives'))
+        else:
+            process_image(file.stream, outputs[0], outputs[1], options['max_size'], options['thumbnail_size'],
+                          options.get('derivatives'))
+        return None
+
+    try:
+        staging_path = _stage(file, filename)
+        params = dict(options, outputs=outputs)
+        engine = db.engine
+        # Own transaction: the pool must see the row whatever the request does with its session
+        with engine.begin() as connection:
+            job_id = connection.execute(_table().insert().values(
+                user_id=user_id if user_id is not None else _current_user_id(),
+                kind=kind,
+                filename=filename,
+                staging_path=staging_path,
+                params=json.dumps(params),
+                status='running',
+                attempts=1,
+                created_at=now_utc_for_db(),
+                started_at=now_utc_for_db(),
+            )).inserted_primary_key[0]
+    except Exception:
+        pool.release()
+        raise
+
+    job = {'id': job_id, 'kind': kind, 'filename': filename,
+           'staging_path': staging_path, 'params': json.loads(json.dumps(params)), 'attempts': 1}
+    pool.submit(engine, job)
+    return job_id
+
+
+def job_for(filename, user_id=None):
+    """Latest job that writes `filename` (main image or avatar name), or None"""
+    from .models import ImageJob
+
+    query = ImageJob.query.filter_by(filename=filename)
+    if user_id is not None:
+        query = query.filter_by(user_id=user_id)
+    return query.order_by(ImageJob.id.desc()).first()
+
+
+def status_of(filename, user_id=None):
+    """'pending', 'running', 'done' or 'failed'; files without a job are 'done'"""
+    job = job_for(filename, user_id)
+    return job.status if job else 'done'
+
+
+def status_payload(filename, user_id):
+    from . import upload_store
+
+    job = job_for(filename, user_id)
+    if job is None and upload_store.is_content_addressed(filename):
+        # Same bytes as an upload already queued by someone else: that job writes the file
+        job = job_for(filename)
+    if job is None:
+        return {'filename': filename, 'status': 'done', 'ready': True}
+    return dict(job.to_dict(), ready=job.status == 'done')
+
+
+def abandoned_jobs(engine, stale_after=600, limit=100):
+    """([(id, status)] of pending jobs and jobs stuck in 'running', the 'running' cutoff)"""
+    from datetime import timedelta
+
+    table = _table()
+    stale_before = now_utc_for_db() - timedelta(seconds=stale_after)
+    with engine.connect() as connection:
+        rows = connection.execute(
+            select(table.c.id, table.c.status)
+            .where((table.c.status == 'pending') |
+                   ((table.c.status == 'running') & (table.c.started_at < stale_before)))
+            .order_by(table.c.id).limit(limit)
+        ).all()
+    return rows, stale_before
+
+
+def process_pending(engine, stale_after=600, limit=100):
+    """Run pending jobs and jobs stuck in 'running' here, one at a time; returns counts"""
+    max_attempts = _config('IMAGE_JOB_MAX_ATTEMPTS', 3)
+    report = {'done': 0, 'retried': 0, 'failed': 0, 'skipped': 0}
+    rows, stale_before = abandoned_jobs(engine, stale_after, limit)
+
+    for job_id, status in rows:
+        job = claim(engine, job_id, status, stale_before if status == 'running' else None)
+        if job is None:
+            report['skipped'] += 1
+            continue
+        try:
+            run_job(job['kind'], job['staging_path'], job['params'])
+        except Exception as e:
+            if job['attempts'] < max_attempts:
+                mark_pending(engine, job, e)
+                report['retried'] += 1
+            else:
+                mark_failed(engine, job, e)
+                report['failed'] += 1
+            continue
+        mark_done(engine, job)
+        report['done'] += 1
+    return report
+
+
+def purge_finished(engine, older_than_days=7):
+    """Delete done/failed jobs older than the given days"""
+    from datetime import timedelta
+
+    table = _table()
+    cutoff = now_utc_for_db() - timedelta(days=older_than_days)
+    with engine.begin() as connection:
+        return connection.execute(
+            table.delete().where(table.c.status.in_(('done', 'failed')), table.c.finished_at < cutoff)
+        ).rowcount
@@ -0,0 +1,265 @@
+"""
+Bulk recompression of stored uploads (``flask optimize-images``).
+
+Files under static/uploads and static/thumbs are re-encoded on a
+process pool, one process per CPU by default. Each file keeps its own
+format and is shrunk to IMAGE_OPTIMIZE_MAX_DIM with its metadata
+stripped, after applying the EXIF orientation. A JPEG becomes an
+optimized, progressive JPEG at IMAGE_JPEG_QUALITY. A result is only used
+when it is at least IMAGE_OPTIMIZE_MIN_SAVING smaller.
+
+Uploads are never rewritten in place. Their URLs, and the /img variants
+built from them, are cached as immutable. An optimized upload is
+written under a new content-addressed name next to the original, with
+its thumbnail and responsive derivatives. Once the pool is done the rows
+are repointed and reference counts recounted. The original stays on
+disk, unreferenced, until ``flask gc-uploads`` quarantines it. Uploads
+no row refers to are skipped. Thumbnails are derived files served
+without immutable caching, so they are replaced atomically in place.
+
+The manifest (IMAGE_OPTIMIZE_MANIFEST) records the size, mtime and
+SHA-256 of every file after it was processed:
+
+- A rerun skips files whose size and mtime still match, without reading
+  them.
+- A file that was only touched is hashed, found unchanged and skipped.
+- Only new or rewritten files are decoded.
+
+Content-addressed files (cas/) are left alone: their URLs are served as
+immutable, and the current pipeline already writes them optimized.
+"""
+import hashlib
+import io
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from .upload_store import CAS_DIR, link_or_copy, stored_relpath
+
+AREAS = ('uploads', 'thumbs')
+EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+MANIFEST_SAVE_EVERY = 200  # results between manifest checkpoints
+
+
+def _config(name, default):
+    from flask import current_app
+    return current_app.config.get(name, default)
+
+
+def load_manifest(path):
+    try:
+        with open(path) as manifest:
+            return json.load(manifest)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(path, manifest):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", 'w') as out:
+        json.dump(manifest, out, separators=(',', ':'), sort_keys=True)
+    os.replace(f"{path}.tmp", path)
+
+
+def _iter_images(root):
+    """(relpath, DirEntry) of every image under root, without descending into cas/"""
+    stack = ['']
+    while stack:
+        relpath = stack.pop()
+        try:
+            items = os.scandir(os.path.join(root, relpath) if relpath else root)
+        except OSError:
+            continue
+        with items:
+            for item in items:
+                child = f'{relpath}/{item.name}' if relpath else item.name
+                if item.is_dir(follow_symlinks=False):
+                    if item.name != CAS_DIR:
+                        stack.append(child)
+                elif item.is_file(follow_symlinks=False) and item.name.lower().endswith(EXTENSIONS):
+                    yield child, item
+
+
+def _entry(path, digest):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns, digest]
+
+
+def _encode(image, fmt, quality):
+    out = io.BytesIO()
+    if fmt == 'JPEG':
+        image.save(out, 'JPEG', quality=quality['jpeg'], optimize=True, progressive=True)
+    elif fmt == 'WEBP':
+        image.save(out, 'WEBP', quality=quality['webp'], method=6)
+    else:
+        image.save(out, 'PNG', optimize=True)
+    return out.getvalue()
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as out:
+        out.write(data)
+    os.replace(tmp_path, path)
+
+
+def optimize_file(path, options, known_hash=None, derivatives=None, upload=None):
+    """Runs in the pool: recompress one file when worth it; returns a result dict.
+    `upload` ({'root', 'relpath'}) writes an upload under a new name instead of in place"""
+    from PIL import Image, ImageOps
+    from .image_derivatives import build_derivatives, derived_dir
+    from .utils import draft_image, fit_image, fit_ratio, sanitize_image
+
+    with open(path, 'rb') as source:
+        data = source.read()
+    digest = hashlib.sha256(data).hexdigest()
+    result = {'before': len(data), 'after': len(data)}
+    if digest == known_hash:
+        return dict(result, status='unchanged', entry=_entry(path, digest))
+
+    image = Image.open(io.BytesIO(data))
+    fmt = image.format
+    if fmt not in ('JPEG', 'PNG', 'WEBP'):
+        return dict(result, status='skipped', entry=_entry(path, digest))
+
+    max_dim = options['max_dim']
+    image = draft_image(image, fit_ratio(image.size, (max_dim, max_dim)))
+    image = ImageOps.exif_transpose(image)  # the orientation tag is about to be dropped
+    if fmt == 'JPEG':
+        image = sanitize_image(image)
+    else:
+        image.load()
+        if image.mode == 'P' and fit_ratio(image.size, (max_dim, max_dim)) < 1:
+            image = image.convert('RGBA')  # palette images only resize with NEAREST
+        image.info = {key: value for key, value in image.info.items() if key == 'transparency'}
+    image = fit_image(image, (max_dim, max_dim))
+
+    encoded = _encode(image, fmt, options['quality'])
+    if len(encoded) > len(data) * (1 - options['min_saving']):
+        return dict(result, status='kept', entry=_entry(path, digest))
+
+    if upload is None:
+        _write(path, encoded)
+        result = dict(result, status='optimized', after=len(encoded),
+                      entry=_entry(path, hashlib.sha256(encoded).hexdigest()))
+    else:
+        root, relpath = upload['root'], upload['relpath']
+        new_relpath = stored_relpath(relpath, io.BytesIO(encoded))
+        new_path = os.path.join(root, 'uploads', new_relpath)
+        if not os.path.exists(new_path):
+            _write(new_path, encoded)
+        thumbnail = os.path.join(root, 'thumbs', relpath)
+        if os.path.isfile(thumbnail):
+            link_or_copy(thumbnail, os.path.join(root, 'thumbs', new_relpath))
+        # The original is left as it is; the manifest keeps its entry so reruns skip it
+        result = dict(result, status='optimized', after=len(encoded), relpath=new_relpath,
+                      entry=_entry(path, digest))
+        if derivatives:
+            derivatives = dict(derivatives, source=new_path, out_dir=derived_dir(new_relpath, root))
+
+    if derivatives:
+        try:
+            build_derivatives(derivatives, image=sanitize_image(image))
+        except Exception as e:
+            result['error'] = f'derivatives: {e}'
+    return result
+
+
+def _run(path, options, known_hash, derivatives, upload):
+    try:
+        return path, optimize_file(path, options, known_hash, derivatives, upload)
+    except Exception as e:
+        return path, {'status': 'failed', 'error': str(e)}
+
+
+def optimize_uploads(workers=None, force=False, max_dim=None, progress=None):
+    """Recompress new or changed uploads and thumbnails on a process pool; returns a report"""
+    from . import db
+    from .image_derivatives import spec_for, static_root
+    from .upload_store import referenced_paths, repoint
+
+    root = static_root()
+    manifest_path = _config('IMAGE_OPTIMIZE_MANIFEST', None)
+    manifest = {} if force else load_manifest(manifest_path)
+    options = {
+        'max_dim': max_dim or _config('IMAGE_OPTIMIZE_MAX_DIM', 1920),
+        'min_saving': _config('IMAGE_OPTIMIZE_MIN_SAVING', 0.05),
+        'quality': {'jpeg': _config('IMAGE_JPEG_QUALITY', 82), 'webp': _config('IMAGE_WEBP_QUALITY', 80)},
+    }
+    report = {'files': 0, 'current': 0, 'optimized': 0, 'kept': 0, 'unchanged': 0, 'skipped': 0,
+              'unreferenced': 0, 'rows': 0, 'failed': [], 'bytes_in': 0, 'bytes_before': 0, 'bytes_after': 0}
+    started = time.time()
+
+    # Orphans are left to the garbage collector
+    referenced = {path for _, _, path in referenced_paths(db.session, content_addressed=False)}
+    db.session.rollback()  # do not hold a transaction open during the run
+
+    # Stat only: files whose size and mtime match the manifest are not read at all
+    seen, todo = {}, []
+    for area in AREAS:
+        for relpath, entry in _iter_images(os.path.join(root, area)):
+            key = f'{area}/{relpath}'
+            report['files'] += 1
+            stat = entry.stat()
+            known = manifest.get(key)
+            if known and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+                report['current'] += 1
+                seen[key] = known
+                continue
+            if area == 'uploads':
+                if relpath not in referenced:
+                    report['unreferenced'] += 1
+                    continue
+                todo.append((key, entry.path, known[2] if known else None, spec_for(entry.path),
+                             {'root': root, 'relpath': relpath}))
+            else:
+                todo.append((key, entry.path, known[2] if known else None, None, None))
+    # Files that are gone drop out of the manifest
+    manifest = seen
+    keys = {path: key for key, path, _, _, _ in todo}
+    renamed = {}
+
+    if todo:
+        in_flight_max = (workers or os.cpu_count() or 1) * 4
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+            pending, queue, done = set(), iter(todo), 0
+            while True:
+                for _, path, known_hash, derivatives, upload in queue:
+                    pending.add(pool.submit(_run, path, options, known_hash, derivatives, upload))
+                    if len(pending) >= in_flight_max:
+                        break
+                if not pending:
+                    break
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    path, result = future.result()
+                    done += 1
+                    if result['status'] == 'failed':
+                        report['failed'].append(f'{keys[path]}: {result["error"]}')
+                        continue
+                    report[result['status']] += 1
+                    report['bytes_in'] += result['before']
+                    if result['status'] == 'optimized':
+                        report['bytes_before'] += result['before']
+                        report['bytes_after'] += result['after']
+                        if result.get('relpath'):
+                            renamed[keys[path][len('uploads/'):]] = result['relpath']
+                    if result.get('error'):
+                        report['failed'].append(f'{keys[path]}: {result["error"]}')
+                    manifest[keys[path]] = result['entry']
+                    if done % MANIFEST_SAVE_EVERY == 0:
+                        save_manifest(manifest_path, manifest)  # an interrupted run keeps its progress
+                    if progress:
+                        progress(done, len(todo))
+
+    save_manifest(manifest_path, manifest)
+    if renamed:
+        report['rows'] = repoint(db.session, renamed)
+    elapsed = max(time.time() - started, 1e-6)
+    report['elapsed'] = round(elapsed, 2)
+    report['files_per_second'] = round(len(todo) / elapsed, 1)
+    report['mb_per_second'] = round(report['bytes_in'] / 1024 / 1024 / elapsed, 1)
+    report['bytes_saved'] = report['bytes_before'] - report['bytes_after']
+    return report
@@ -0,0 +1,371 @@
+"""
+On-demand image variants: ``/img/<size>/<format>/<path under uploads>``.
+
+``size`` is ``WIDTHxHEIGHT``. A 0 leaves that side free, and a trailing
+``c`` crops to exactly that box (``320x320c``). ``format`` is ``webp``,
+``jpeg`` or ``auto`` (WebP when the browser accepts it). Variants are
+never larger than the source: a size is first reduced to the one that
+renders the same pixels with no side above the source (a free side
+where it does not bind, sides clamped to the source). A request for any
+other form of that size is redirected to it, so ``1999x0`` and
+``1998x0`` of an 800px upload are both ``800x0`` and rendered once.
+
+The first request renders the variant and stores it in a disk cache
+(IMAGE_RESIZE_CACHE_DIR). The cache is keyed by a hash of the source's
+content plus the variant parameters, so identical uploads share their
+variants. Every later request is a file send with
+``Cache-Control: immutable``. Uploads are named after their content
+(or randomly, for legacy ones) and never rewritten, so a URL always
+refers to the same bytes.
+
+- Coalescing: concurrent first hits for a variant render it once. One
+  thread per worker renders while the others wait (single_flight), and
+  a lock file does the same between workers.
+- Eviction: files are touched when served, at most once per
+  TOUCH_INTERVAL. When a worker has written enough since its last scan,
+  the least recently used files are removed until the cache is below
+  90% of IMAGE_RESIZE_CACHE_MAX_BYTES. ``flask prune-image-cache`` does
+  the same by hand.
+- Abuse: sides are capped at IMAGE_RESIZE_MAX_DIM, and only the sizes in
+  IMAGE_RESIZE_SIZES (by default the derivative ladder and the thumbnail
+  and avatar crops) or their reduced forms are served.
+"""
+import hashlib
+import os
+import re
+import threading
+import time
+
+from flask import Blueprint, abort, current_app, redirect, request, send_file, url_for
+from werkzeug.security import safe_join
+
+from .cache_stampede import single_flight
+
+bp = Blueprint('image_resize', __name__, url_prefix='/img')
+
+SIZE_PATTERN = re.compile(r'^(\d{1,4})x(\d{1,4})(c?)$')
+FORMATS = {'webp': ('WEBP', 'image/webp', 'webp'), 'jpeg': ('JPEG', 'image/jpeg', 'jpg')}
+TOUCH_INTERVAL = 3600  # seconds between LRU touches of a cached file
+LOCK_STALE = 60  # seconds after which another worker's render lock is ignored
+EVICT_TARGET = 0.9  # evict down to this share of the cap
+
+
+def _config(name, default):
+    return current_app.config.get(name, default)
+
+
+def cache_dir():
+    return _config('IMAGE_RESIZE_CACHE_DIR', os.path.join(current_app.instance_path, 'image_cache'))
+
+
+def parse_size(size):
+    """(width, height, crop) or None; 0 means 'free' for that side"""
+    match = SIZE_PATTERN.match(size or '')
+    if not match:
+        return None
+    width, height, crop = int(match.group(1)), int(match.group(2)), bool(match.group(3))
+    max_dim = _config('IMAGE_RESIZE_MAX_DIM', 2000)
+    if not (width or height) or width > max_dim or height > max_dim or (crop and not (width and height)):
+        return None
+    return width, height, crop
+
+
+def format_size(width, height, crop):
+    return f"{width}x{height}{'c' if crop else ''}"
+
+
+def canonical_size(width, height, crop, source):
+    """The size that renders the same variant of a source of this (width, height), no side above it"""
+    src_w, src_h = source
+    if not crop and width and height:
+        # Only the side that binds matters
+        if width / src_w <= height / src_h:
+            height = 0
+        else:
+            width = 0
+    return min(width, src_w), min(height, src_h), crop
+
+
+def is_allowed(size, source):
+    """An IMAGE_RESIZE_SIZES size, or one of them reduced for this source (empty setting: any size)"""
+    allowed = [s.strip() for s in _config('IMAGE_RESIZE_SIZES', '').split(',') if s.strip()]
+    if not allowed or size in allowed:
+        return True
+    return any(format_size(*canonical_size(*dims, source)) == size
+               for dims in map(parse_size, allowed) if dims)
+
+
+# Content hashes of sources, by (path, size, mtime), so a hit does not reread the source
+_source_hashes = {}
+_source_hashes_lock = threading.Lock()
+SOURCE_HASHES_MAX = 10000
+
+
+def source_hash(path):
+    stat = os.stat(path)
+    memo_key = (path, stat.st_size, stat.st_mtime_ns)
+    with _source_hashes_lock:
+        digest = _source_hashes.get(memo_key)
+    if digest is None:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as source:
+            for chunk in iter(lambda: source.read(1024 * 1024), b''):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        with _source_hashes_lock:
+            if len(_source_hashes) >= SOURCE_HASHES_MAX:
+                _source_hashes.clear()
+            _source_hashes[memo_key] = digest
+    return digest
+
+
+_source_sizes = {}
+
+
+def source_size(path):
+    """(width, height) of a source, from its header"""
+    from PIL import Image
+
+    stat = os.stat(path)
+    memo_key = (path, stat.st_size, stat.st_mtime_ns)
+    with _source_hashes_lock:
+        size = _source_sizes.get(memo_key)
+    if size is None:
+        with Image.open(path) as image:
+            size = image.size
+        with _source_hashes_lock:
+            if len(_source_sizes) >= SOURCE_HASHES_MAX:
+                _source_sizes.clear()
+            _source_sizes[memo_key] = size
+    return size
+
+
+def variant_key(content_hash, width, height, crop, fmt, quality):
+    params = f"{content_hash}:{width}x{height}{'c' if crop else ''}:{fmt}:{quality}"
+    return hashlib.sha256(params.encode()).hexdigest()
+
+
+def variant_path(key, fmt, root=None):
+    """Sharded location of a variant in the cache"""
+    return os.path.join(root or cache_dir(), key[:2], key[2:4], f"{key}.{FORMATS[fmt][2]}")
+
+
+def render_variant(source_path, target_path, width, height, crop, fmt, quality):
+    """Decode once (draft for JPEGs), resize and write the variant atomically"""
+    from PIL import Image
+    from .utils import draft_image, fit_image, fit_ratio, sanitize_image
+
+    image = Image.open(source_path)
+    src_w, src_h = image.size
+    if crop:
+        scale = min(max(width / src_w, height / src_h), 1)
+    else:
+        scale = fit_ratio(image.size, (width or src_w, height or src_h))
+    image = sanitize_image(draft_image(image, scale))
+
+    if crop:
+        # Cover the box, then center-crop (through resize's box argument)
+        box_w, box_h = min(width, image.width), min(height, image.height)
+        ratio = max(box_w / image.width, box_h / image.height)
+        crop_w, crop_h = round(box_w / ratio), round(box_h / ratio)
+        left, top = (image.width - crop_w) // 2, (image.height - crop_h) // 2
+        variant = image.resize((box_w, box_h), Image.Resampling.LANCZOS,
+                               box=(left, top, left + crop_w, top + crop_h), reducing_gap=2.0)
+    else:
+        variant = fit_image(image, (width or image.width, height or image.height))
+
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    tmp_path = f"{target_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    if fmt == 'webp':
+        variant.save(tmp_path, 'WEBP', quality=quality, method=4)
+    else:
+        variant.save(tmp_path, 'JPEG', quality=quality, optimize=True, progressive=True)
+    os.replace(tmp_path, target_path)
+    return os.path.getsize(target_path)
+
+
+def _acquire_render_lock(lock_path):
+    """Cross-worker lock: a lock file created exclusively; stale ones are taken over"""
+    try:
+        os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return True
+    except FileExistsError:
+        try:
+            if time.time() - os.path.getmtime(lock_path) > LOCK_STALE:
+                os.remove(lock_path)
+                return _acquire_render_lock(lock_path)
+        except OSError:
+            pass
+        return False
+    except OSError:
+        return True  # cannot lock (read-only dir?): just render
+
+
+def _wait_for(path, wait):
+    deadline = time.time() + wait
+    while time.time() < deadline:
+        if os.path.exists(path):
+            return True
+        time.sleep(0.05)
+    return False
+
+
+class CacheSizeTracker:
+    """Bytes this worker wrote since it last measured the cache"""
+
+    def __init__(self):
+        self.written = 0
+        self.lock = threading.Lock()
+
+    def add(self, nbytes, cap):
+        """True when it is time to measure (and maybe evict)"""
+        with self.lock:
+            self.written += nbytes
+            if self.written >= max(cap * 0.05, 1):
+                self.written = 0
+                return True
+            return False
+
+
+_tracker = CacheSizeTracker()
+
+
+def prune(root, max_bytes, target=EVICT_TARGET):
+    """Remove least recently used variants until the cache is under target * max_bytes"""
+    lock_path = os.path.join(root, '.evict.lock')
+    if not os.path.isdir(root) or not _acquire_render_lock(lock_path):
+        return {'files': 0, 'bytes': 0, 'removed': 0, 'freed': 0}
+    try:
+        entries, total = [], 0
+        stack = [root]
+        while stack:
+            with os.scandir(stack.pop()) as items:
+                for item in items:
+                    if item.is_dir(follow_symlinks=False):
+                        stack.append(item.path)
+                    elif item.name.endswith(('.webp', '.jpg')):
+                        stat = item.stat()
+                        entries.append((stat.st_mtime, stat.st_size, item.path))
+                        total += stat.st_size
+                    elif item.name.endswith(('.tmp', '.lock')) and item.path != lock_path:
+                        # Left behind by a render that crashed
+                        if time.time() - item.stat().st_mtime > LOCK_STALE:
+                            os.remove(item.path)
+        report = {'files': len(entries), 'bytes': total, 'removed': 0, 'freed': 0}
+        if total <= max_bytes:
+            return report
+        entries.sort()
+        goal = max_bytes * target
+        for _, size, path in entries:
+            if total <= goal:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            report['removed'] += 1
+            report['freed'] += size
+        return report
+    finally:
+        try:
+            os.remove(lock_path)
+        except OSError:
+            pass
+
+
+def _touch(path):
+    try:
+        if time.time() - os.path.getmtime(path) > TOUCH_INTERVAL:
+            os.utime(path)
+    except OSError:
+        pass
+
+
+def get_variant(source_path, width, height, crop, fmt):
+    """Path of the cached variant, rendering it (once) when missing"""
+    quality = _config('IMAGE_WEBP_QUALITY', 80) if fmt == 'webp' else _config('IMAGE_JPEG_QUALITY', 82)
+    key = variant_key(source_hash(source_path), width, height, crop, fmt, quality)
+    root = cache_dir()
+    path = variant_path(key, fmt, root)
+    if os.path.exists(path):
+        _touch(path)
+        return key, path
+
+    wait = _config('IMAGE_RESIZE_LOCK_WAIT', 10)
+
+    def render():
+        if os.path.exists(path):
+            return 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        lock_path = f"{path}.lock"
+        if not _acquire_render_lock(lock_path):
+            if _wait_for(path, wait):
+                return 0
+        try:
+            return render_variant(source_path, path, width, height, crop, fmt, quality)
+        finally:
+            try:
+                os.remove(lock_path)
+            except OSError:
+                pass
+
+    leader, written = single_flight(f'img:{key}', render, wait)
+    if leader and written:
+        cap = _config('IMAGE_RESIZE_CACHE_MAX_BYTES', 512 * 1024 * 1024)
+        if _tracker.add(written, cap):
+            prune(root, cap)
+    if not os.path.exists(path):
+        # The leader failed; try once here so the error surfaces in this request
+        render_variant(source_path, path, width, height, crop, fmt, quality)
+    return key, path
+
+
+def _negotiate(fmt):
+    if fmt == 'auto':
+        return 'webp' if 'image/webp' in request.headers.get('Accept', '') else 'jpeg'
+    return fmt if fmt in FORMATS else None
+
+
+@bp.route('/<size>/<fmt>/<path:filename>')
+def resized(size, fmt, filename):
+    """Variant of an upload at the requested size and format"""
+    dims = parse_size(size)
+    out_format = _negotiate(fmt)
+    if dims is None or out_format is None:
+        abort(404)
+
+    uploads = os.path.join(current_app.root_path, 'static', 'uploads')
+    source_path = safe_join(uploads, filename)
+    if source_path is None or not os.path.isfile(source_path):
+        abort(404)
+
+    try:
+        source = source_size(source_path)
+    except Exception:
+        abort(404)  # not an image
+    canonical = canonical_size(*dims, source)
+    if not is_allowed(size, source):
+        abort(404)
+    if canonical != dims:
+        return redirect(url_for('image_resize.resized', size=format_size(*canonical), fmt=fmt, filename=filename), 301)
+
+    try:
+        key, path = get_variant(source_path, *dims, out_format)
+    except Exception as e:
+        print(f"Image variant {size}/{fmt}/{filename} failed: {e}")
+        abort(404)
+
+    response = send_file(path, mimetype=FORMATS[out_format][1], etag=key, conditional=True,
+                         max_age=31536000)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    if fmt == 'auto':
+        response.headers['Vary'] = 'Accept'
+    return response
+
+
+def resized_url(filename, width, height=0, fmt='auto', crop=False):
+    """URL of an on-demand variant of an upload (path relative to static/uploads)"""
+    if not filename:
+        return ''
+    return url_for('image_resize.resized', size=format_size(width, height, crop), fmt=fmt, filename=filename)
@@ -0,0 +1,105 @@
+"""
+Maintained top-K leaderboard of popular cards.
+
+The leaderboard keeps the top ``LEADERBOARD_SIZE`` cards for each window
+(all-time, 30 days, 7 days) in the shared cache. Counter flushes merge the
+fresh counts of the cards they touched, so readers get the ranking with a
+single cache read. Window counts come from the small ``card_view_counter``
+table, never from ``card_view``; the board is rebuilt from it on a cache
+miss and once per UTC day so expired days drop out of the windows.
+"""
+from sqlalchemy import func
+
+from . import cache
+from .timezone_utils import now_utc_for_db
+
+CACHE_KEY = 'leaderboard_top_cards'
+WINDOWS = {'all': None, '30d': 30, '7d': 7}
+
+
+def _config(name, default):
+    from flask import current_app
+    return current_app.config.get(name, default)
+
+
+def window_counts(session, days=None, card_ids=None, limit=None):
+    """[(card_id, views)] from card_view_counter, highest first"""
+    from .models import CardViewCounter
+
+    views = func.sum(CardViewCounter.views)
+    query = session.query(CardViewCounter.card_id, views)
+    if days is not None:
+        query = query.filter(CardViewCounter.day >= _window_start(days))
+    if card_ids is not None:
+        query = query.filter(CardViewCounter.card_id.in_(card_ids))
+    query = query.group_by(CardViewCounter.card_id).order_by(views.desc(), CardViewCounter.card_id)
+    if limit:
+        query = query.limit(limit)
+    return [(card_id, int(count)) for card_id, count in query]
+
+
+def _window_start(days):
+    from datetime import timedelta
+    return now_utc_for_db().date() - timedelta(days=days - 1)
+
+
+def _store(board):
+    cache.set(CACHE_KEY, board, timeout=_config('LEADERBOARD_CACHE_TIMEOUT', 86400))
+
+
+def rebuild_leaderboard(session):
+    """Recompute every window from the counters and store it"""
+    size = _config('LEADERBOARD_SIZE', 50)
+    board = {
+        'day': now_utc_for_db().date().isoformat(),
+        'windows': {name: window_counts(session, days, limit=size) for name, days in WINDOWS.items()},
+    }
+    _store(board)
+    return board
+
+
+def get_leaderboard(session=None):
+    """Current board; rebuilt from the counters when missing or from a previous day"""
+    board = cache.get(CACHE_KEY)
+    if board is None or board.get('day') != now_utc_for_db().date().isoformat():
+        if session is None:
+            from . import db
+            session = db.session
+        board = rebuild_leaderboard(session)
+    return board
+
+
+def update_leaderboard(session, card_ids):
+    """Merge the latest counts for card_ids into each window's top-K"""
+    if not card_ids:
+        return
+    board = cache.get(CACHE_KEY)
+    if board is None or board.get('day') != now_utc_for_db().date().isoformat():
+        rebuild_leaderboard(session)
+        return
+
+    size = _config('LEADERBOARD_SIZE', 50)
+    for name, days in WINDOWS.items():
+        entries = dict(board['windows'].get(name, []))
+        entries.update(window_counts(session, days, card_ids=list(card_ids)))
+        board['windows'][name] = sorted(entries.items(), key=lambda item: (-item[1], item[0]))[:size]
+    _store(board)
+
+
+def get_top_card_ids(window='all', limit=10):
+    """[(card_id, views)] for a window, read from the maintained board"""
+    return get_leaderboard()['windows'].get(window, [])[:limit]
+
+
+def get_top_cards(window='all', limit=10):
+    """Top cards with name and slug, as used by analytics and the admin pages"""
+    from .models import Card
+
+    top = get_top_card_ids(window, limit)
+    if not top:
+        return []
+    cards = {card.id: card for card in Card.query.filter(Card.id.in_([card_id for card_id, _ in top]))}
+    return [
+        {'id': card_id, 'name': cards[card_id].name, 'slug': cards[card_id].slug, 'views': views}
+        for card_id, views in top if card_id in cards
+    ]
@@ -0,0 +1,196 @@
+"""
+In-memory "live viewers" per card, summed over every worker.
+
+Each card gets a ring buffer of per-second hit buckets plus a small map of
+visitor -> last seen, both fed by the view ingestion path. Nothing here
+reads or writes the database.
+
+A worker only sees the hits it served. At most every
+LIVE_VIEWERS_PUBLISH_INTERVAL seconds, and only after new hits, a worker
+writes its windows to the shared cache under its own key and lists that
+key in a small registry. Reads merge this worker's windows, taken from
+memory, with the other workers' from the cache in one get_many. Hits are
+added per second and visitor maps are united, then everything older than
+LIVE_VIEWERS_WINDOW is dropped. The per-worker tier of TwoTierCache is
+bypassed, so other workers' numbers are at most one publish interval
+old. With a per-process backend (the default 'simple') each worker shows
+only its own visitors.
+"""
+import os
+import socket
+import threading
+import time
+from collections import Counter, OrderedDict
+
+KEY_PREFIX = 'live_viewers:'
+REGISTRY_KEY = 'live_viewers:workers'
+
+
+class CardActivity:
+    """Sliding window for one card: per-second ring buffer and recent visitors"""
+
+    __slots__ = ('owner_id', 'buckets', 'seconds', 'visitors')
+
+    def __init__(self, owner_id, window_seconds):
+        self.owner_id = owner_id
+        self.buckets = [0] * window_seconds
+        self.seconds = [0] * window_seconds  # epoch second each bucket belongs to
+        self.visitors = OrderedDict()  # visitor -> last seen (epoch seconds)
+
+    def add(self, second, visitor, max_visitors):
+        slot = second % len(self.buckets)
+        if self.seconds[slot] != second:
+            self.seconds[slot] = second
+            self.buckets[slot] = 0
+        self.buckets[slot] += 1
+
+        if visitor:
+            self.visitors.pop(visitor, None)
+            self.visitors[visitor] = second
+            while len(self.visitors) > max_visitors:
+                self.visitors.popitem(last=False)
+
+    def window(self, cutoff):
+        """{'owner_id', 'hits': {second: hits}, 'visitors': {visitor: last seen}} after cutoff"""
+        while self.visitors:
+            visitor, last_seen = next(iter(self.visitors.items()))
+            if last_seen > cutoff:
+                break
+            self.visitors.popitem(last=False)
+        hits = {second: n for second, n in zip(self.seconds, self.buckets) if second > cutoff and n}
+        return {'owner_id': self.owner_id, 'hits': hits, 'visitors': dict(self.visitors)}
+
+
+class LiveViewers:
+    """Per-worker registry of CardActivity windows"""
+
+    def __init__(self, window_seconds=60, max_visitors=1000, max_cards=10000, publish_interval=2):
+        self.window_seconds = window_seconds
+        self.max_visitors = max_visitors
+        self.max_cards = max_cards
+        self.publish_interval = publish_interval
+        self._cards = OrderedDict()
+        self._changed = False
+        self._published_at = 0
+        self._lock = threading.Lock()
+
+    def record(self, card_id, owner_id, visitor=None, now=None):
+        second = int(now or time.time())
+        with self._lock:
+            activity = self._cards.get(card_id)
+            if activity is None:
+                activity = self._cards[card_id] = CardActivity(owner_id, self.window_seconds)
+                while len(self._cards) > self.max_cards:
+                    self._cards.popitem(last=False)
+            else:
+                self._cards.move_to_end(card_id)
+            activity.add(second, visitor[:16] if visitor else None, self.max_visitors)
+            self._changed = True
+
+    def windows(self, now=None):
+        """This worker's windows of the cards with activity in the last window_seconds"""
+        cutoff = int(now or time.time()) - self.window_seconds
+        with self._lock:
+            windows = {card_id: activity.window(cutoff) for card_id, activity in self._cards.items()}
+        return {card_id: window for card_id, window in windows.items() if window['hits'] or window['visitors']}
+
+    def should_publish(self):
+        with self._lock:
+            return self._changed and time.time() - self._published_at >= self.publish_interval
+
+    def publish(self, store, now=None):
+        """Write this worker's windows to the shared cache and list it in the registry"""
+        now = int(now or time.time())
+        with self._lock:
+            self._changed = False
+            self._published_at = time.time()
+        token = _worker_token()
+        timeout = self.window_seconds + self.publish_interval
+        try:
+            store.set(KEY_PREFIX + token, self.windows(now), timeout=timeout)
+            registry = store.get(REGISTRY_KEY) or {}
+            if registry.get(token, 0) < now - self.publish_interval:
+                # Lost concurrent updates heal on the worker's next publish
+                registry = {worker: seen for worker, seen in registry.items() if seen > now - timeout}
+                registry[token] = now
+                store.set(REGISTRY_KEY, registry, timeout=timeout * 2)
+        except Exception as e:
+            print(f"Live viewers publish failed: {e}")
+
+    def cards(self, store=None, now=None):
+        """{card_id: {'owner_id', 'viewers', 'hits', 'series'}} summed over workers; series oldest first"""
+        now = int(now or time.time())
+        cutoff = now - self.window_seconds
+        sources = [self.windows(now)]
+        if store is not None:
+            try:
+                token = _worker_token()
+                others = [worker for worker in store.get(REGISTRY_KEY) or {} if worker != token]
+                if others:
+                    sources += [windows for windows in store.get_many(*[KEY_PREFIX + worker for worker in others])
+                                if windows]
+            except Exception as e:
+                print(f"Live viewers read failed: {e}")
+
+        merged = {}
+        for windows in sources:
+            for card_id, window in windows.items():
+                card = merged.setdefault(card_id, {'owner_id': window['owner_id'], 'hits': Counter(), 'visitors': {}})
+                card['hits'].update(window['hits'])
+                for visitor, last_seen in window['visitors'].items():
+                    if last_seen > card['visitors'].get(visitor, 0):
+                        card['visitors'][visitor] = last_seen
+
+        result = {}
+        for card_id, card in merged.items():
+            series = [card['hits'].get(second, 0) for second in range(cutoff + 1, now + 1)]
+            viewers = sum(1 for last_seen in card['visitors'].values() if last_seen > cutoff)
+            if viewers or any(series):
+                result[card_id] = {'owner_id': card['owner_id'], 'viewers': viewers,
+                                   'hits': sum(series), 'series': series}
+        return result
+
+
+def _worker_token():
+    # Read on every call: workers forked after the registry was created get their own
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def shared_store():
+    """The cache store every worker sees (tier 2 of TwoTierCache, without metering)"""
+    from . import cache
+    from .cache_metrics import unwrap
+
+    backend = unwrap(cache.cache)
+    return getattr(backend, 'shared', backend)
+
+
+_live_viewers = None
+_live_viewers_lock = threading.Lock()
+
+
+def get_live_viewers():
+    """Process-wide registry configured from LIVE_VIEWERS_* settings"""
+    global _live_viewers
+    if _live_viewers is None:
+        from flask import current_app
+        with _live_viewers_lock:
+            if _live_viewers is None:
+                config = current_app.config
+                _live_viewers = LiveViewers(
+                    window_seconds=config.get('LIVE_VIEWERS_WINDOW', 60),
+                    max_visitors=config.get('LIVE_VIEWERS_MAX_VISITORS', 1000),
+                    publish_interval=config.get('LIVE_VIEWERS_PUBLISH_INTERVAL', 2),
+                )
+    return _live_viewers
+
+
+def init_app(app):
+    """Publish each worker's windows to the shared cache after requests"""
+
+    @app.after_request
+    def publish_live_viewers(response):
+        live = _live_viewers
+        if live is not None and live.should_publish():
+            live.publish(shared_store())
+        return response
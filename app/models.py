@@ -2,8 +2,9 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from datetime import datetime, timedelta
 from .security import hash_password, verify_password
-from .timezone_utils import now_utc_for_db, today_start_utc, get_date_range_utc, get_month_range_utc
+from .timezone_utils import now_utc_for_db, now_local, today_start_utc, get_date_range_utc, get_month_range_utc
 from sqlalchemy import Enum
+from sqlalchemy.orm import column_property
 import string
 import secrets
 from itsdangerous import URLSafeTimedSerializer
@@ -25,7 +26,7 @@ class User(UserMixin, db.Model):
     suspended_by_id = db.Column(db.Integer)
     max_cards = db.Column(db.Integer, default=1, nullable=False)
     last_login = db.Column(db.DateTime)
-    total_views = db.Column(db.Integer, default=0)
+    total_views = db.Column(db.Integer, default=0)  # roll-up of the cards' views_total
     email_verified = db.Column(db.Boolean, default=False)
     email_verified_at = db.Column(db.DateTime)
     reset_token = db.Column(db.String(255))
@@ -124,9 +125,8 @@ class User(UserMixin, db.Model):
         self.email_verified_at = now_utc_for_db()
     
     def get_total_card_views(self):
-        """Get total views across all user's cards"""
-        from .models import CardView
-        return CardView.query.join(Card).filter(Card.owner_id == self.id).count()
+        """Get total views across all user's cards (maintained roll-up)"""
+        return self.total_views or 0
     
     def get_active_cards_count(self):
         """Get count of public cards"""
@@ -234,6 +234,12 @@ class Card(db.Model):
     # Social network display preferences (JSON list of network field names to show as primary)
     primary_social_networks = db.Column(db.Text)
     
+    # Maintained view counters (batched from ingestion, reconciled by `flask reconcile-view-counters`)
+    views_total = db.Column(db.Integer, default=0, nullable=False, server_default='0')
+    views_today = db.Column(db.Integer, default=0, nullable=False, server_default='0')
+    views_month = db.Column(db.Integer, default=0, nullable=False, server_default='0')
+    views_counted_on = db.Column(db.Date)  # local day views_today/views_month refer to
+    
     # Relationships
     services = db.relationship('Service', backref='card', lazy='dynamic', cascade='all, delete-orphan')
     products = db.relationship('Product', backref='card', lazy='dynamic', cascade='all, delete-orphan')
@@ -503,29 +509,41 @@ class Card(db.Model):
         return self.get_social_networks_by_preference(is_primary=False)
     
     def get_total_views(self):
-        """Get total number of views for this card"""
-        return self.views.count()
+        """Get total number of views for this card (maintained counter)"""
+        return self.views_total or 0
     
     def get_unique_views(self):
-        """Get number of unique IP addresses that viewed this card"""
+        """Get number of unique IP addresses that viewed this card (archived days add their daily uniques)"""
+        return Card.unique_views_by_card([self.id]).get(self.id, 0)
+    
+    @staticmethod
+    def unique_views_by_card(card_ids):
+        """{card_id: unique visitors} for many cards with one grouped query per table"""
         from sqlalchemy import func
-        return db.session.query(func.count(func.distinct(CardView.ip_address))).filter_by(card_id=self.id).scalar() or 0
+        card_ids = list(card_ids)
+        if not card_ids:
+            return {}
+        totals = dict.fromkeys(card_ids, 0)
+        raw = db.session.query(CardView.card_id, func.count(func.distinct(CardView.ip_address))) \
+            .filter(CardView.card_id.in_(card_ids)).group_by(CardView.card_id)
+        archived = db.session.query(CardViewDaily.card_id, func.coalesce(func.sum(CardViewDaily.unique_visitors), 0)) \
+            .filter(CardViewDaily.card_id.in_(card_ids)).group_by(CardViewDaily.card_id)
+        for card_id, count in list(raw) + list(archived):
+            totals[card_id] += int(count or 0)
+        return totals
     
     def get_views_today(self):
-        """Get views for today"""
-        start_utc, end_utc = get_date_range_utc(days=1)
-        return self.views.filter(
-            CardView.viewed_at >= start_utc,
-            CardView.viewed_at <= end_utc
-        ).count()
+        """Get views for today (maintained counter, 0 if nothing was counted today)"""
+        if self.views_counted_on != now_local().date():
+            return 0
+        return self.views_today or 0
     
     def get_views_this_month(self):
-        """Get views for current month"""
-        start_utc, end_utc = get_month_range_utc()
-        return self.views.filter(
-            CardView.viewed_at >= start_utc,
-            CardView.viewed_at <= end_utc
-        ).count()
+        """Get views for current month (maintained counter)"""
+        today = now_local().date()
+        if not self.views_counted_on or self.views_counted_on < today.replace(day=1):
+            return 0
+        return self.views_month or 0
     
     def get_avatar_path(self):
         """Get the appropriate avatar path based on theme shape"""
@@ -545,10 +563,16 @@ class Card(db.Model):
         from flask import url_for
         import time
         
+        from .upload_store import is_content_addressed
+        
         avatar_path = self.get_avatar_path()
         if not avatar_path:
             return None
         
+        # Content-addressed names change with the bytes: no parameter needed
+        if is_content_addressed(avatar_path):
+            return url_for('static', filename=f'uploads/{avatar_path}')
+        
         # Use updated_at timestamp as cache busting parameter
         timestamp = int(self.updated_at.timestamp()) if self.updated_at else int(time.time())
         return url_for('static', filename=f'uploads/{avatar_path}', v=timestamp)
@@ -708,18 +732,55 @@ class GalleryItem(db.Model):
     def __repr__(self):
         return f'<GalleryItem {self.image_path}>'
 
+class ViewDimension(db.Model):
+    """Interned strings referenced by card_view (user agent, referrer host, browser, platform)"""
+    __tablename__ = 'view_dimension'
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # user_agent, referrer_host, browser, platform
+    value_hash = db.Column(db.String(40), nullable=False)  # sha1 of value, keeps the unique index short
+    value = db.Column(db.String(500), nullable=False)
+
+    __table_args__ = (db.UniqueConstraint('kind', 'value_hash', name='uq_view_dimension_kind_hash'),)
+
+    def __repr__(self):
+        return f'<ViewDimension {self.kind}={self.value[:30]}>'
+
+
+def _dimension_value(id_column, legacy_column):
+    """Interned string for a card_view row, falling back to the legacy column"""
+    value = db.select(ViewDimension.value).where(ViewDimension.id == id_column).scalar_subquery()
+    return db.func.coalesce(value, legacy_column)
+
+
 class CardView(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     card_id = db.Column(db.Integer, db.ForeignKey('card.id'), nullable=False)
-    ip_address = db.Column(db.String(45))  # IPv4 or IPv6
-    user_agent = db.Column(db.String(500))
-    referrer = db.Column(db.String(500))
+    ip_hash = db.Column(db.LargeBinary(16))  # keyed BLAKE2b digest of the visitor IP
+    user_agent_id = db.Column(db.Integer, db.ForeignKey('view_dimension.id'))
+    referrer_host_id = db.Column(db.Integer, db.ForeignKey('view_dimension.id'))
+    browser_id = db.Column(db.Integer, db.ForeignKey('view_dimension.id'))
+    platform_id = db.Column(db.Integer, db.ForeignKey('view_dimension.id'))
     device_type = db.Column(db.String(20))  # mobile, tablet, desktop
-    browser = db.Column(db.String(50))  # Chrome, Firefox, Safari, etc.
-    platform = db.Column(db.String(50))  # windows, macos, linux, android, ios
     country = db.Column(db.String(100))  # User's country
     city = db.Column(db.String(100))  # User's city
-    session_id = db.Column(db.String(100))  # Session tracking
+    session_id = db.Column(db.String(100))  # Hashed visitor (IP + User-Agent) for dedup windows
+    hits = db.Column(db.Integer, default=1, nullable=False, server_default='1')  # Raw hits folded into this view
+
+    # Pre-compaction string columns, emptied by `flask compact-card-views`
+    legacy_ip_address = db.Column('ip_address', db.String(45))
+    legacy_user_agent = db.Column('user_agent', db.String(500))
+    legacy_referrer = db.Column('referrer', db.String(500))
+    legacy_browser = db.Column('browser', db.String(50))
+    legacy_platform = db.Column('platform', db.String(50))
+
+    # Read-only string views so existing queries and templates keep working
+    user_agent = column_property(_dimension_value(user_agent_id, legacy_user_agent), deferred=True, group='dimensions')
+    referrer = column_property(_dimension_value(referrer_host_id, legacy_referrer), deferred=True, group='dimensions')
+    browser = column_property(_dimension_value(browser_id, legacy_browser), deferred=True, group='dimensions')
+    platform = column_property(_dimension_value(platform_id, legacy_platform), deferred=True, group='dimensions')
+    ip_address = column_property(db.func.coalesce(legacy_ip_address, db.func.nullif(db.func.lower(db.func.hex(ip_hash)), '')),
+                                 deferred=True, group='dimensions')  # raw IP or hash hex, for distinct counts
     viewed_at = db.Column(db.DateTime, default=now_utc_for_db, index=True)
 
     # Relationship
@@ -728,6 +789,79 @@ class CardView(db.Model):
     def __repr__(self):
         return f'<CardView {self.card_id} at {self.viewed_at}>'
 
+class CardViewDaily(db.Model):
+    """Per-card daily aggregates kept after raw card_view rows pass the retention window"""
+    __tablename__ = 'card_view_daily'
+
+    id = db.Column(db.Integer, primary_key=True)
+    card_id = db.Column(db.Integer, db.ForeignKey('card.id'), nullable=False)
+    day = db.Column(db.Date, nullable=False, index=True)  # UTC day
+    views = db.Column(db.Integer, default=0, nullable=False)
+    hits = db.Column(db.Integer, default=0, nullable=False)
+    unique_visitors = db.Column(db.Integer, default=0, nullable=False)
+    mobile_views = db.Column(db.Integer, default=0, nullable=False)
+    tablet_views = db.Column(db.Integer, default=0, nullable=False)
+    desktop_views = db.Column(db.Integer, default=0, nullable=False)
+
+    card = db.relationship('Card', backref=db.backref('daily_views', lazy='dynamic', cascade='all, delete-orphan'))
+
+    __table_args__ = (db.UniqueConstraint('card_id', 'day', name='uq_card_view_daily_card_day'),)
+
+    @staticmethod
+    def archived_totals(card_ids=None, since=None):
+        """(views, hits, unique_visitors) summed over archived days"""
+        from sqlalchemy import func
+        query = db.session.query(
+            func.coalesce(func.sum(CardViewDaily.views), 0),
+            func.coalesce(func.sum(CardViewDaily.hits), 0),
+            func.coalesce(func.sum(CardViewDaily.unique_visitors), 0)
+        )
+        if card_ids is not None:
+            query = query.filter(CardViewDaily.card_id.in_(card_ids))
+        if since is not None:
+            query = query.filter(CardViewDaily.day >= since.date())
+        views, hits, unique_visitors = query.one()
+        return int(views), int(hits), int(unique_visitors)
+
+    def __repr__(self):
+        return f'<CardViewDaily {self.card_id} {self.day}: {self.views}>'
+
+class CardViewCounter(db.Model):
+    """Per-card daily view counters maintained in batches by the ingestion path"""
+    __tablename__ = 'card_view_counter'
+
+    id = db.Column(db.Integer, primary_key=True)
+    card_id = db.Column(db.Integer, db.ForeignKey('card.id'), nullable=False)
+    day = db.Column(db.Date, nullable=False, index=True)  # UTC day
+    views = db.Column(db.Integer, default=0, nullable=False)
+
+    card = db.relationship('Card', backref=db.backref('view_counters', lazy='dynamic', cascade='all, delete-orphan'))
+
+    __table_args__ = (db.UniqueConstraint('card_id', 'day', name='uq_card_view_counter_card_day'),)
+
+    def __repr__(self):
+        return f'<CardViewCounter {self.card_id} {self.day}: {self.views}>'
+
+class CardFunnelDaily(db.Model):
+    """Per-card (and per-service) daily counts of booking funnel events"""
+    __tablename__ = 'card_funnel_daily'
+
+    id = db.Column(db.Integer, primary_key=True)
+    card_id = db.Column(db.Integer, db.ForeignKey('card.id'), nullable=False)
+    service_id = db.Column(db.Integer, default=0, nullable=False)  # 0 = not tied to a service
+    day = db.Column(db.Date, nullable=False, index=True)  # UTC day
+    stage = db.Column(db.String(20), nullable=False)  # services, booking_form, booking, ticket_form, ticket
+    events = db.Column(db.Integer, default=0, nullable=False)
+
+    card = db.relationship('Card', backref=db.backref('funnel_days', lazy='dynamic', cascade='all, delete-orphan'))
+
+    __table_args__ = (
+        db.UniqueConstraint('card_id', 'service_id', 'day', 'stage', name='uq_card_funnel_daily_key'),
+    )
+
+    def __repr__(self):
+        return f'<CardFunnelDaily {self.card_id}/{self.service_id} {self.day} {self.stage}: {self.events}>'
+
 class TicketSystem(db.Model):
     """Sistema de turnos/tickets para consultorios - Un sistema por usuario"""
     __tablename__ = 'ticket_system'
@@ -1408,4 +1542,81 @@ class SSOToken(db.Model):
         """Verifica si el token no ha expirado y no ha sido usado"""
         if self.is_used:
             return False
-        return now_utc_for_db() <= self.expires_at
\ No newline at end of file
+        return now_utc_for_db() <= self.expires_at
+
+class CacheInvalidation(db.Model):
+    """Change-sequence of cache keys to evict from every worker's local cache"""
+    __tablename__ = 'cache_invalidation'
+
+    id = db.Column(db.Integer, primary_key=True)  # sequence number read by the workers
+    key = db.Column(db.String(255), nullable=False)  # '*' evicts everything
+    origin = db.Column(db.String(32))  # publishing process, which skips its own rows
+    created_at = db.Column(db.DateTime, default=now_utc_for_db, nullable=False, index=True)
+
+    def __repr__(self):
+        return f'<CacheInvalidation {self.id} {self.key}>'
+
+class CacheMetricDaily(db.Model):
+    """Daily cache counters per key family, summed over every worker"""
+    __tablename__ = 'cache_metric_daily'
+
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False, index=True)  # UTC day
+    family = db.Column(db.String(64), nullable=False)  # card_data_, analytics:get_card_analytics, ...
+    gets = db.Column(db.BigInteger, default=0, nullable=False)
+    hits = db.Column(db.BigInteger, default=0, nullable=False)
+    misses = db.Column(db.BigInteger, default=0, nullable=False)
+    sets = db.Column(db.BigInteger, default=0, nullable=False)
+    deletes = db.Column(db.BigInteger, default=0, nullable=False)
+    bytes_set = db.Column(db.BigInteger, default=0, nullable=False)  # pickled size of values written
+    evictions = db.Column(db.BigInteger, default=0, nullable=False)
+
+    __table_args__ = (db.UniqueConstraint('family', 'day', name='uq_cache_metric_daily_family_day'),)
+
+    def __repr__(self):
+        return f'<CacheMetricDaily {self.family} {self.day}: {self.hits}/{self.gets}>'
+
+class ImageJob(db.Model):
+    """Background resize of an uploaded image (app.image_jobs)"""
+    __tablename__ = 'image_job'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), index=True)
+    kind = db.Column(db.String(20), nullable=False)  # 'image' or 'avatar'
+    filename = db.Column(db.String(255), nullable=False, index=True)  # name returned to the caller
+    staging_path = db.Column(db.String(500), nullable=False)  # original as uploaded
+    params = db.Column(db.Text, nullable=False)  # JSON: output paths and sizes
+    status = db.Column(db.String(20), default='pending', nullable=False, index=True)  # pending, running, done, failed
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=now_utc_for_db, nullable=False)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'filename': self.filename,
+            'kind': self.kind,
+            'status': self.status,
+            'attempts': self.attempts,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+    def __repr__(self):
+        return f'<ImageJob {self.id} {self.filename} {self.status}>'
+
+class UploadRef(db.Model):
+    """Reference count of a content-addressed upload (app.upload_store)"""
+    __tablename__ = 'upload_ref'
+
+    id = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.String(255), unique=True, nullable=False)  # relative to static/uploads
+    refcount = db.Column(db.Integer, default=0, nullable=False)  # rows/columns pointing at it
+    created_at = db.Column(db.DateTime, default=now_utc_for_db, nullable=False)
+    updated_at = db.Column(db.DateTime, default=now_utc_for_db, nullable=False)
+
+    def __repr__(self):
+        return f'<UploadRef {self.path} x{self.refcount}>'
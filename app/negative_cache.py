@@ -0,0 +1,289 @@
+"""
+Negative lookups for public URLs.
+
+Scanners and old printed QR codes keep requesting card slugs and
+/turnos handles that do not exist. Two layers answer those 404s without
+querying the database:
+
+- A miss cache. Each unknown slug or handle is remembered in the cache
+  for NEGATIVE_CACHE_TTL seconds.
+- A per-worker Bloom filter of every card slug. If the filter says a
+  slug is absent, it is absent, so the 404 costs no cache lookup either.
+
+Both stay correct as cards change. ORM events note slugs that were
+created, renamed or deleted. After the commit, those slugs are added to
+the filter, their miss entries are dropped, and the change is announced
+on the invalidation bus (cache_bus) so every worker updates its filter.
+The filter is only used while the bus is enabled, and it is rebuilt
+every NEGATIVE_BLOOM_REBUILD seconds.
+
+Handles are matched by substring of the owner's email, so a filter
+cannot rule them out. Their miss entries are dropped all at once,
+through a generation counter, whenever a user is created or an email
+changes.
+"""
+import hashlib
+import math
+import threading
+import time
+
+from sqlalchemy import event, inspect, select
+
+from . import cache, cache_bus
+
+KEY_PREFIX = 'negative'
+HANDLE_GENERATION_KEY = f'{KEY_PREFIX}:handle_gen'
+
+
+def _config(name, default):
+    from flask import current_app
+    return current_app.config.get(name, default)
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings (double hashing on one blake2b digest)"""
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(int(capacity), 1)
+        self.capacity = capacity
+        self.size = max(int(-capacity * math.log(error_rate) / (math.log(2) ** 2)), 8)
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    @property
+    def full(self):
+        return self.count >= self.capacity
+
+
+class SlugFilter:
+    """Per-worker Bloom filter of card slugs, kept current through the bus"""
+
+    def __init__(self, error_rate=0.01, rebuild_interval=3600):
+        self.error_rate = error_rate
+        self.rebuild_interval = rebuild_interval
+        self._bloom = None
+        self._built_at = 0.0
+        self._lock = threading.Lock()
+        self._building = False
+        self._added_during_build = []
+
+    def build(self, engine):
+        """Load every slug; leaves room for as many new cards as exist today"""
+        from .models import Card
+
+        with engine.connect() as connection:
+            slugs = connection.execute(
+                select(Card.slug).execution_options(stream_results=True, yield_per=5000)
+            ).scalars().all()
+        bloom = BloomFilter(max(len(slugs) * 2, 1000), self.error_rate)
+        for slug in slugs:
+            bloom.add(slug)
+        return bloom
+
+    def current(self, engine):
+        """The filter, or None while it is unavailable or being rebuilt"""
+        bloom = self._bloom
+        stale = bloom is None or bloom.full or time.time() - self._built_at > self.rebuild_interval
+        if not stale:
+            return bloom
+        with self._lock:
+            if self._building:
+                return self._bloom if self._bloom is not None and not self._bloom.full else None
+            self._building = True
+            self._added_during_build = []
+        try:
+            fresh = self.build(engine)
+            with self._lock:
+                # Slugs committed while the snapshot was being read
+                for slug in self._added_during_build:
+                    fresh.add(slug)
+                self._bloom, self._built_at = fresh, time.time()
+            return fresh
+        except Exception as e:
+            print(f"Slug filter build failed: {e}")
+            return None
+        finally:
+            with self._lock:
+                self._building = False
+                self._added_during_build = []
+
+    def add(self, slug):
+        with self._lock:
+            if self._building:
+                self._added_during_build.append(slug)
+            if self._bloom is not None:
+                self._bloom.add(slug)
+
+    def reset(self):
+        with self._lock:
+            self._bloom = None
+
+    def on_invalidation(self, key):
+        """Bus listener: another worker created a slug or lost track of changes"""
+        if key == '*':
+            self.reset()
+        elif key.startswith(f'{KEY_PREFIX}:slug:'):
+            self.add(key[len(f'{KEY_PREFIX}:slug:'):])
+
+
+_slug_filter = None
+_slug_filter_lock = threading.Lock()
+
+
+def get_slug_filter():
+    """Process-wide slug filter, subscribed to the invalidation bus"""
+    global _slug_filter
+    if _slug_filter is None:
+        with _slug_filter_lock:
+            if _slug_filter is None:
+                slug_filter = SlugFilter(
+                    error_rate=_config('NEGATIVE_BLOOM_ERROR_RATE', 0.01),
+                    rebuild_interval=_config('NEGATIVE_BLOOM_REBUILD', 3600),
+                )
+                # Subscribe before the first build so no creation slips between them
+                cache_bus.add_listener(slug_filter.on_invalidation)
+                _slug_filter = slug_filter
+    return _slug_filter
+
+
+def _bloom_enabled():
+    return _config('NEGATIVE_BLOOM_ENABLED', True) and _config('CACHE_BUS_ENABLED', True)
+
+
+def _miss_key(kind, name):
+    if kind == 'handle':
+        generation = cache.get(HANDLE_GENERATION_KEY) or 0
+        return f'{KEY_PREFIX}:handle:{generation}:{name}'
+    return f'{KEY_PREFIX}:{kind}:{name}'
+
+
+def slug_may_exist(slug):
+    """False only when the slug is certainly not a card (Bloom filter)"""
+    if not _bloom_enabled():
+        return True
+    try:
+        from . import db
+        bloom = get_slug_filter().current(db.engine)
+    except Exception:
+        return True
+    return bloom is None or slug in bloom
+
+
+def is_missing(kind, name):
+    """Was this slug/handle looked up recently and not found?"""
+    try:
+        return cache.get(_miss_key(kind, name)) is not None
+    except Exception:
+        return False
+
+
+def remember_missing(kind, name):
+    try:
+        cache.set(_miss_key(kind, name), 1, timeout=_config('NEGATIVE_CACHE_TTL', 60))
+    except Exception:
+        pass
+
+
+def _changes(session):
+    return session.info.setdefault('negative_cache', {'created': set(), 'removed': set(), 'handles': False})
+
+
+def _card_inserted(mapper, connection, target):
+    from sqlalchemy.orm import object_session
+    session = object_session(target)
+    if session is not None and target.slug:
+        _changes(session)['created'].add(target.slug)
+
+
+def _card_updated(mapper, connection, target):
+    from sqlalchemy.orm import object_session
+    session = object_session(target)
+    history = inspect(target).attrs.slug.history
+    if session is None or not history.has_changes():
+        return
+    changes = _changes(session)
+    changes['removed'].update(slug for slug in history.deleted if slug)
+    changes['created'].update(slug for slug in history.added if slug)
+
+
+def _card_deleted(mapper, connection, target):
+    from sqlalchemy.orm import object_session
+    session = object_session(target)
+    if session is not None and target.slug:
+        _changes(session)['removed'].add(target.slug)
+
+
+def _user_inserted(mapper, connection, target):
+    from sqlalchemy.orm import object_session
+    session = object_session(target)
+    if session is not None:
+        _changes(session)['handles'] = True
+
+
+def _user_updated(mapper, connection, target):
+    from sqlalchemy.orm import object_session
+    session = object_session(target)
+    if session is not None and inspect(target).attrs.email.history.has_changes():
+        _changes(session)['handles'] = True
+
+
+def _apply_changes(session):
+    """After commit: negative entries for removed slugs, filter and miss cache for new ones"""
+    changes = session.info.pop('negative_cache', None)
+    if not changes:
+        return
+    try:
+        keys = []
+        for slug in changes['removed'] - changes['created']:
+            remember_missing('slug', slug)
+            # Positive entries under the old slug must not outlive it either
+            stale = [f'card_data_{slug}', f'card_view_{slug}']
+            cache.delete_many(*stale)
+            keys.extend(stale)
+        for slug in changes['created']:
+            if _bloom_enabled():
+                get_slug_filter().add(slug)
+            key = _miss_key('slug', slug)
+            cache.delete(key)
+            keys.append(key)  # other workers evict it and add the slug to their filter
+        if changes['handles']:
+            cache.set(HANDLE_GENERATION_KEY, time.time_ns(), timeout=0)
+            keys.append(HANDLE_GENERATION_KEY)
+        cache_bus.publish(*keys)
+    except Exception as e:
+        print(f"Negative cache update failed: {e}")
+
+
+def _drop_changes(session):
+    session.info.pop('negative_cache', None)
+
+
+def init_app(app):
+    """Track slug and email changes on every session"""
+    from sqlalchemy.orm import Session
+    from .models import Card, User
+
+    if event.contains(Card, 'after_insert', _card_inserted):
+        return
+    event.listen(Card, 'after_insert', _card_inserted)
+    event.listen(Card, 'after_update', _card_updated)
+    event.listen(Card, 'after_delete', _card_deleted)
+    event.listen(User, 'after_insert', _user_inserted)
+    event.listen(User, 'after_update', _user_updated)
+    event.listen(Session, 'after_commit', _apply_changes)
+    event.listen(Session, 'after_rollback', _drop_changes)
@@ -120,41 +120,21 @@ class DatabaseOptimizer:
     
     @staticmethod
     def optimize_images():
-        """Optimize image storage and delivery"""
-        import os
-        from PIL import Image
-        from flask import current_app
+        """Recompress new or changed uploads, then build missing responsive derivatives"""
+        from .image_derivatives import backfill
+        from .image_optimizer import optimize_uploads
         
         try:
-            upload_folder = current_app.config.get('UPLOAD_FOLDER', 'app/static/uploads')
-            
-            if not os.path.exists(upload_folder):
-                return
-                
-            optimized_count = 0
-            
-            for filename in os.listdir(upload_folder):
-                if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-                    filepath = os.path.join(upload_folder, filename)
-                    
-                    try:
-                        with Image.open(filepath) as img:
-                            # Convert to WebP if not already
-                            if not filename.lower().endswith('.webp'):
-                                webp_path = os.path.splitext(filepath)[0] + '.webp'
-                                img.save(webp_path, 'WebP', quality=85, optimize=True)
-                                optimized_count += 1
-                                
-                            # Optimize existing images
-                            if img.size[0] > 1920 or img.size[1] > 1920:
-                                img.thumbnail((1920, 1920), Image.Resampling.LANCZOS)
-                                img.save(filepath, optimize=True, quality=85)
-                                optimized_count += 1
-                                
-                    except Exception as e:
-                        print(f"Error optimizing {filename}: {e}")
-                        
-            print(f"Optimized {optimized_count} images")
+            optimized = optimize_uploads()
+            print(f"Uploads: {optimized['optimized']} recompressed "
+                  f"({optimized['bytes_saved'] / 1024 / 1024:.1f} MB saved), {optimized['current']} unchanged, "
+                  f"{len(optimized['failed'])} failed")
+            report = backfill(db.session)
+            if report is None:
+                return optimized
+            print(f"Image derivatives: {report['built']} built, {report['current']} up to date, "
+                  f"{report['missing']} missing sources, {len(report['failed'])} failed")
+            return report
             
         except Exception as e:
             print(f"Image optimization failed: {e}")
@@ -338,34 +318,15 @@ def optimize_static_assets():
 
 
 # Cache warming utilities
-def warm_cache_on_startup():
-    """Warm up cache with frequently accessed data"""
+def warm_cache_on_startup(app=None):
+    """Warm up cache with frequently accessed data (see cache_warmup)"""
     try:
-        from .cache_utils import CacheManager
-        from .models import Theme, Card
-        from . import cache
-    except ImportError:
-        # Handle case where imports fail
-        try:
-            from app.cache_utils import CacheManager
-            from app.models import Theme, Card
-            from app import cache
-        except ImportError:
-            return
-        
-        # Warm popular cards cache
-        CacheManager.warm_popular_cards()
-        
-        # Cache frequently used themes
-        themes = Theme.query.filter_by(is_active=True).all()
-        for theme in themes:
-            cache.set(f'theme_{theme.id}', theme, timeout=3600)
-            
-        # Cache public cards count for dashboard
-        public_cards_count = Card.query.filter_by(is_public=True).count()
-        cache.set('public_cards_count', public_cards_count, timeout=1800)
+        from flask import current_app
+        from .cache_warmup import warm_cache
         
-        print(f"Cache warmed: {len(themes)} themes, popular cards, and stats")
+        report = warm_cache(app or current_app._get_current_object())
+        print(f"Cache warmed: {report['cards']} cards, {report['templates']} templates in {report['elapsed']}s")
+        return report
         
     except Exception as e:
         print(f"Cache warming failed: {e}")
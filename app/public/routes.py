@@ -1,29 +1,52 @@
 from flask import render_template, abort, request, redirect, url_for, flash, jsonify
 from ..models import Card, Product, CardView
-from .. import db, cache
+from .. import db
 from . import bp
 from ..analytics import AnalyticsService
+from ..bot_filter import should_skip_view
+from ..view_dedup import get_deduplicator
+from ..view_counters import get_view_counters
+from ..live_viewers import get_live_viewers
+from ..funnel import record_funnel_event
+from ..cache_stampede import get_or_set
+from .. import negative_cache
 
 def record_view(card):
     """Record a view for the given card with enhanced analytics"""
-    view = AnalyticsService.track_card_view(card, request)
-    db.session.add(view)
-    try:
-        db.session.commit()
-    except Exception:
-        db.session.rollback()
+    ip_address = AnalyticsService.get_client_ip(request)
+    
+    # Bots, link previews and prefetches are counted in memory, never stored
+    if should_skip_view(request, card.id, ip_address):
+        return
+    
+    # Repeats inside the session window only bump the existing row's hit counter
+    dedup = get_deduplicator()
+    counters = get_view_counters()
+    visitor = dedup.visitor_hash(ip_address, request.headers.get('User-Agent', ''))
+    get_live_viewers().record(card.id, card.owner_id, visitor)
+    if not dedup.register_repeat(card.id, visitor):
+        # Building the row looks up dimensions; a database error loses this view, not the page
+        try:
+            view = AnalyticsService.track_card_view(card, request, session_id=visitor)
+            db.session.add(view)
+            db.session.commit()
+            dedup.remember(card.id, visitor, view.id)
+            counters.record(card.id)
+        except Exception:
+            db.session.rollback()
+    
+    if dedup.should_flush():
+        dedup.flush(db.session)
+    if counters.should_flush():
+        counters.flush(db.session)
 
 @bp.route('/c/<slug>')
-@cache.cached(timeout=300, key_prefix='card_view_%s')
 def card_view(slug):
-    # Use cached query for better performance
-    cache_key = f'card_data_{slug}'
-    card = cache.get(cache_key)
+    # Unknown slugs (scanners, old QR codes) are answered without a query
+    if not negative_cache.slug_may_exist(slug):
+        abort(404)
     
-    if not card:
-        card = Card.query.filter_by(slug=slug).first()
-        if card and card.is_public and not card.owner.is_suspended:
-            cache.set(cache_key, card, timeout=300)  # Cache for 5 minutes
+    card = get_cached_card(slug)
     
     if not card:
         abort(404)
@@ -37,33 +60,60 @@ def card_view(slug):
     if not card.is_public:
         abort(404)
     
-    # Record the view (don't cache this part)
+    # Record every hit; bot filtering and dedup keep this cheap
     record_view(card)
     
+    # Rendered page is cached separately so cache hits are still counted
+    return get_cached_card_page(card)
+
+def get_cached_card(slug):
+    """Card for a slug; cached while public, a single caller refreshes it when it expires"""
+    return get_or_set(
+        f'card_data_{slug}',
+        lambda: _find_card(slug),
+        timeout=300,  # Cache for 5 minutes
+        cacheable=lambda card: card.is_public and not card.owner.is_suspended
+    )
+
+def get_cached_card_page(card):
+    """Rendered public page of a card (needs a request context)"""
+    # A card from the cache is detached; re-attach it (no query) so the
+    # related lookups can lazy-load.
+    return get_or_set(f'card_view_{card.slug}',
+                      lambda: _render_card_page(db.session.merge(card, load=False)),
+                      timeout=300)
+
+def _find_card(slug):
+    if negative_cache.is_missing('slug', slug):
+        return None
+    card = Card.query.filter_by(slug=slug).first()
+    if card is None:
+        negative_cache.remember_missing('slug', slug)
+    return card
+
+def _render_card_page(card):
+    """Render the public card page with its related data"""
     # Cache queries for related data
-    services_key = f'card_services_{card.id}'
-    services = cache.get(services_key)
-    if not services:
-        services = card.services.filter_by(is_visible=True).order_by('order_index').all()
-        cache.set(services_key, services, timeout=600)
-    
-    products_key = f'card_products_{card.id}'
-    products = cache.get(products_key)
-    if not products:
-        products = card.products.filter_by(is_visible=True).order_by('order_index').all()
-        cache.set(products_key, products, timeout=600)
-    
-    gallery_key = f'card_gallery_{card.id}'
-    gallery_items = cache.get(gallery_key)
-    if not gallery_items:
-        gallery_items = card.gallery_items.filter_by(is_visible=True).order_by('order_index').all()
-        cache.set(gallery_key, gallery_items, timeout=600)
-    
-    featured_key = f'card_featured_{card.id}'
-    featured_image = cache.get(featured_key)
-    if featured_image is None:  # Use None check because False is valid
-        featured_image = card.gallery_items.filter_by(is_featured=True, is_visible=True).first()
-        cache.set(featured_key, featured_image, timeout=600)
+    services = get_or_set(
+        f'card_services_{card.id}',
+        lambda: card.services.filter_by(is_visible=True).order_by('order_index').all(),
+        timeout=600
+    )
+    products = get_or_set(
+        f'card_products_{card.id}',
+        lambda: card.products.filter_by(is_visible=True).order_by('order_index').all(),
+        timeout=600
+    )
+    gallery_items = get_or_set(
+        f'card_gallery_{card.id}',
+        lambda: card.gallery_items.filter_by(is_visible=True).order_by('order_index').all(),
+        timeout=600
+    )
+    featured_image = get_or_set(
+        f'card_featured_{card.id}',
+        lambda: card.gallery_items.filter_by(is_featured=True, is_visible=True).first(),
+        timeout=600
+    )
     
     # Get social networks for the card
     social_links = card.get_primary_social_networks()
@@ -106,6 +156,7 @@ def card_services(slug):
         abort(404)
     
     services = card.services.filter_by(is_visible=True).order_by('order_index').all()
+    record_funnel_event(card.id, 'services')
     
     return render_template('public/services.html', 
                          card=card, 
@@ -208,6 +259,24 @@ def pwa_test():
 # SISTEMA DE TURNOS - Rutas Públicas para Pacientes
 # ============================================================================
 
+def _find_ticket_owner(username):
+    """Usuario dueño de /turnos/<username>; los handles inexistentes se recuerdan un rato"""
+    from ..models import User
+
+    handle = username.lower()
+    if negative_cache.is_missing('handle', handle):
+        return None
+    # username puede ser el email o parte de él
+    user = User.query.filter(
+        db.or_(
+            User.email == handle,
+            User.email.contains(handle)
+        )
+    ).first()
+    if user is None:
+        negative_cache.remember_missing('handle', handle)
+    return user
+
 @bp.route('/turnos/<username>', methods=['GET', 'POST'])
 def tickets_public(username):
     """Página pública para que pacientes tomen turnos"""
@@ -217,12 +286,7 @@ def tickets_public(username):
     import json
 
     # Buscar usuario por email (username puede ser el email o slug)
-    user = User.query.filter(
-        db.or_(
-            User.email == username.lower(),
-            User.email.contains(username.lower())
-        )
-    ).first()
+    user = _find_ticket_owner(username)
 
     if not user:
         abort(404)
@@ -344,6 +408,11 @@ def tickets_public(username):
         db.session.add(ticket)
         db.session.commit()
 
+        # Turnos are credited to the owner's first card in the booking funnel
+        funnel_card = user.cards.order_by(Card.id).first()
+        if funnel_card:
+            record_funnel_event(funnel_card.id, 'ticket')
+
         # Send push notification to the user (clinic owner)
         try:
             from ..push_notifications import send_ticket_notification
@@ -390,6 +459,10 @@ def tickets_public(username):
             pass
 
     card = user.cards.first()
+    if request.method == 'GET':
+        funnel_card = user.cards.order_by(Card.id).first()
+        if funnel_card:
+            record_funnel_event(funnel_card.id, 'ticket_form')
     return render_template('public/tickets/take_ticket.html',
                          system=ticket_system,
                          form=form,
@@ -405,12 +478,7 @@ def my_tickets(username):
     from ..models import User, TicketSystem, Ticket
 
     # Buscar usuario
-    user = User.query.filter(
-        db.or_(
-            User.email == username.lower(),
-            User.email.contains(username.lower())
-        )
-    ).first()
+    user = _find_ticket_owner(username)
 
     if not user or not user.ticket_system or not user.ticket_system.is_enabled:
         abort(404)
@@ -478,12 +546,7 @@ def tickets_queue(username):
     from ..models import User
 
     # Buscar usuario
-    user = User.query.filter(
-        db.or_(
-            User.email == username.lower(),
-            User.email.contains(username.lower())
-        )
-    ).first()
+    user = _find_ticket_owner(username)
 
     if not user or not user.ticket_system or not user.ticket_system.is_enabled:
         abort(404)
@@ -511,12 +574,7 @@ def tickets_queue_json(username):
     """API JSON para actualización en tiempo real de la cola"""
     from ..models import User, Ticket
 
-    user = User.query.filter(
-        db.or_(
-            User.email == username.lower(),
-            User.email.contains(username.lower())
-        )
-    ).first()
+    user = _find_ticket_owner(username)
 
     if not user or not user.ticket_system or not user.ticket_system.is_enabled:
         return jsonify({'error': 'No encontrado'}), 404
@@ -559,12 +617,7 @@ def ticket_status(username, ticket_number):
     """Ver estado de un turno específico"""
     from ..models import User, Ticket
 
-    user = User.query.filter(
-        db.or_(
-            User.email == username.lower(),
-            User.email.contains(username.lower())
-        )
-    ).first()
+    user = _find_ticket_owner(username)
 
     if not user or not user.ticket_system or not user.ticket_system.is_enabled:
         abort(404)
@@ -598,12 +651,7 @@ def ticket_status_json(username, ticket_number):
     """API JSON para estado del turno (para auto-actualización)"""
     from ..models import User, Ticket
 
-    user = User.query.filter(
-        db.or_(
-            User.email == username.lower(),
-            User.email.contains(username.lower())
-        )
-    ).first()
+    user = _find_ticket_owner(username)
 
     if not user or not user.ticket_system or not user.ticket_system.is_enabled:
         return jsonify({'error': 'No encontrado'}), 404
@@ -629,12 +677,7 @@ def cancel_ticket_public(username, ticket_number, token):
     """Cancelar turno públicamente con token de seguridad"""
     from ..models import User, Ticket
 
-    user = User.query.filter(
-        db.or_(
-            User.email == username.lower(),
-            User.email.contains(username.lower())
-        )
-    ).first()
+    user = _find_ticket_owner(username)
 
     if not user or not user.ticket_system or not user.ticket_system.is_enabled:
         abort(404)
@@ -676,12 +719,7 @@ def check_in_ticket(username, ticket_number):
     """Registrar llegada del paciente al consultorio"""
     from ..models import User, Ticket
 
-    user = User.query.filter(
-        db.or_(
-            User.email == username.lower(),
-            User.email.contains(username.lower())
-        )
-    ).first()
+    user = _find_ticket_owner(username)
 
     if not user or not user.ticket_system or not user.ticket_system.is_enabled:
         return jsonify({'success': False, 'message': 'Sistema no encontrado'}), 404
@@ -752,6 +790,9 @@ def book_appointment(slug, service_id):
         require_address=card.require_customer_address
     )
 
+    if request.method == 'GET':
+        record_funnel_event(card.id, 'booking_form', service_id=service.id)
+
     if form.validate_on_submit():
         # Convertir fecha de string a date
         try:
@@ -782,6 +823,7 @@ def book_appointment(slug, service_id):
         )
         db.session.add(appointment)
         db.session.commit()
+        record_funnel_event(card.id, 'booking', service_id=service.id)
 
         # Enviar notificación push al dueño del negocio
         try:
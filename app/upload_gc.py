@@ -0,0 +1,225 @@
+"""
+Garbage collection of uploads no row refers to.
+
+``flask gc-uploads`` does this in three steps:
+
+1. Every path that can refer to a file is streamed from the database
+   into a set of 64-bit fingerprints, a few dozen bytes per path however
+   long it is.
+2. static/uploads, static/thumbs and static/derived are walked with
+   os.scandir, one directory at a time. A file is an orphan when neither
+   its path nor, for derivatives, its upload matches a fingerprint and
+   it has not been modified for UPLOAD_GC_GRACE_HOURS. Orphans are
+   handled as they are found, so memory does not grow with the number of
+   files.
+3. Orphans are moved into a dated batch under UPLOAD_GC_QUARANTINE_DIR
+   rather than deleted. Batches older than UPLOAD_GC_QUARANTINE_DAYS are
+   deleted on later runs. A file that is referenced again by then (a row
+   restored from a backup) is moved back instead.
+
+A fingerprint collision can only keep an orphan, never remove a file in
+use. With ``--dry-run`` nothing is moved; the report shows what would be.
+"""
+import hashlib
+import os
+import shutil
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+
+AREAS = ('uploads', 'thumbs', 'derived')
+BATCH_FORMAT = '%Y%m%d-%H%M%S'
+REF_DELETE_BATCH = 500
+
+
+def _config(name, default):
+    from flask import current_app
+    return current_app.config.get(name, default)
+
+
+def _reference_columns():
+    from .models import Card, GalleryItem, Product, Service, Theme
+    return [
+        Card.avatar_path, Card.avatar_square_path, Card.avatar_rect_path,
+        GalleryItem.image_path, GalleryItem.thumbnail_path,
+        Product.image_path, Service.image_path,
+        Theme.bg_image_path, Theme.preview_image,
+    ]
+
+
+def fingerprint(value):
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+
+def _variants(path):
+    """A stored path as written and relative to static/uploads (mobile services store 'uploads/<f>')"""
+    path = path.replace('\\', '/').lstrip('/')
+    yield path
+    for prefix in ('static/uploads/', 'uploads/', 'static/'):
+        if path.startswith(prefix):
+            yield path[len(prefix):]
+
+
+class ReferenceSet:
+    """Fingerprints of referenced upload paths and of their derivative directories"""
+
+    def __init__(self):
+        self.paths = set()
+        self.stems = set()
+        self.rows = 0
+
+    def add(self, path):
+        self.rows += 1
+        for variant in _variants(path):
+            self.paths.add(fingerprint(variant))
+            self.stems.add(fingerprint(os.path.splitext(os.path.normpath(variant))[0].replace(os.sep, '/')))
+
+    def __contains__(self, relpath):
+        return fingerprint(relpath) in self.paths
+
+    def has_stem(self, stem):
+        return fingerprint(stem) in self.stems
+
+
+def collect_references(session):
+    references = ReferenceSet()
+    for column in _reference_columns():
+        rows = session.execute(
+            select(column).where(column.isnot(None), column != '').execution_options(yield_per=1000)
+        ).scalars()
+        for path in rows:
+            references.add(path)
+    return references
+
+
+def _walk(root, grace_before, prune_dirs, relpath=''):
+    """Yield (relpath, entry) for every file under root; empty old directories are removed on the way out"""
+    try:
+        items = os.scandir(os.path.join(root, relpath) if relpath else root)
+    except OSError:
+        return
+    with items:
+        for item in items:
+            child = f'{relpath}/{item.name}' if relpath else item.name
+            if item.is_dir(follow_symlinks=False):
+                yield from _walk(root, grace_before, prune_dirs, child)
+                if prune_dirs:
+                    try:
+                        if item.stat().st_mtime < grace_before:
+                            os.rmdir(item.path)
+                    except OSError:
+                        pass  # not empty
+            elif item.is_file(follow_symlinks=False):
+                yield child, item
+
+
+def _is_referenced(area, relpath, references):
+    if area == 'derived':
+        # static/derived/<upload stem>/<width>.<ext> and its .source marker
+        return references.has_stem(os.path.dirname(relpath))
+    return relpath in references
+
+
+def _move(source, target):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.replace(source, target)
+    except OSError:
+        shutil.move(source, target)  # quarantine on another filesystem
+
+
+def _forget_refs(engine, paths):
+    """upload_ref rows of quarantined content-addressed uploads"""
+    from .models import UploadRef
+
+    table = UploadRef.__table__
+    with engine.begin() as connection:
+        connection.execute(table.delete().where(table.c.path.in_(paths), table.c.refcount <= 0))
+
+
+def purge_quarantine(quarantine_dir, static_root, references, older_than_days, dry_run=False):
+    """Delete quarantine batches past their retention; files referenced again are restored"""
+    report = {'batches': 0, 'purged': 0, 'purged_bytes': 0, 'restored': 0}
+    cutoff = datetime.now() - timedelta(days=older_than_days)
+    try:
+        batches = sorted(entry.name for entry in os.scandir(quarantine_dir) if entry.is_dir())
+    except OSError:
+        return report
+
+    for batch in batches:
+        try:
+            if datetime.strptime(batch, BATCH_FORMAT) > cutoff:
+                continue
+        except ValueError:
+            continue  # not ours
+        report['batches'] += 1
+        batch_root = os.path.join(quarantine_dir, batch)
+        for area in AREAS:
+            for relpath, entry in _walk(os.path.join(batch_root, area), 0, False):
+                original = os.path.join(static_root, area, relpath)
+                if _is_referenced(area, relpath, references) and not os.path.exists(original):
+                    report['restored'] += 1
+                    if not dry_run:
+                        _move(entry.path, original)
+                    continue
+                report['purged'] += 1
+                report['purged_bytes'] += entry.stat().st_size
+        if not dry_run:
+            shutil.rmtree(batch_root, ignore_errors=True)
+    return report
+
+
+def collect_garbage(session, engine, grace_hours=None, purge_days=None, dry_run=False, on_orphan=None):
+    """Quarantine unreferenced uploads, thumbnails and derivatives; purge old quarantine batches"""
+    from .image_derivatives import static_root
+    from .upload_store import is_content_addressed
+
+    grace_hours = _config('UPLOAD_GC_GRACE_HOURS', 24) if grace_hours is None else grace_hours
+    purge_days = _config('UPLOAD_GC_QUARANTINE_DAYS', 7) if purge_days is None else purge_days
+    quarantine_dir = _config('UPLOAD_GC_QUARANTINE_DIR', None)
+    root = static_root()
+    started = time.time()
+    grace_before = started - grace_hours * 3600
+    batch_root = os.path.join(quarantine_dir, datetime.now().strftime(BATCH_FORMAT))
+
+    references = collect_references(session)
+    session.rollback()  # do not hold a transaction open during the walk
+    report = {'references': references.rows, 'dry_run': dry_run, 'batch': None if dry_run else batch_root}
+
+    for area in AREAS:
+        stats = report[area] = {'scanned': 0, 'orphans': 0, 'bytes': 0, 'recent': 0}
+        released = []
+        for relpath, entry in _walk(os.path.join(root, area), grace_before, not dry_run):
+            stats['scanned'] += 1
+            if _is_referenced(area, relpath, references):
+                continue
+            try:
+                stat = os.stat(entry.path)  # not the scan-time stat: a reused upload is touched
+                if stat.st_mtime >= grace_before:
+                    stats['recent'] += 1  # may be an upload whose row is not committed yet
+                    continue
+            except OSError:
+                continue  # removed meanwhile
+            stats['orphans'] += 1
+            stats['bytes'] += stat.st_size
+            if on_orphan:
+                on_orphan(area, relpath, stat.st_size)
+            if dry_run:
+                continue
+            try:
+                _move(entry.path, os.path.join(batch_root, area, relpath))
+            except OSError as e:
+                print(f"Could not quarantine {area}/{relpath}: {e}")
+                continue
+            if area == 'uploads' and is_content_addressed(relpath):
+                released.append(relpath)
+                if len(released) >= REF_DELETE_BATCH:
+                    _forget_refs(engine, released)
+                    released = []
+        if released:
+            _forget_refs(engine, released)
+
+    report['quarantine'] = purge_quarantine(quarantine_dir, root, references, purge_days, dry_run)
+    report['elapsed'] = round(time.time() - started, 2)
+    return report
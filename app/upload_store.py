@@ -0,0 +1,416 @@
+"""
+Content-addressed upload storage.
+
+With UPLOAD_CONTENT_ADDRESSED (the default), an upload's name is derived
+from its bytes. It is a SHA-256 of the uploaded file plus the processing
+parameters, stored in a sharded layout under the upload folder:
+``cas/ab/cd/<hash>.jpg``. Thumbnails and derivatives mirror that path.
+
+- The same logo uploaded to five cards is processed and stored once.
+  Later uploads find the files already there and only add a reference.
+- Names are known before processing, so background image jobs keep
+  returning final names.
+- URLs only change when the bytes do, so /static/.../cas/ responses are
+  sent as immutable and avatar URLs no longer carry ``?v=updated_at``.
+
+``upload_ref`` counts the references (row and column) to each
+content-addressed path from Card avatars, GalleryItem, Product and
+Service. ORM events adjust it in the same transaction as the row
+change. After commit, files whose count dropped to zero are deleted
+once they are older than UPLOAD_RELEASE_GRACE; a fresh upload of the
+same bytes touches them first. Files that are still too new are left to
+the orphan collector. Legacy random names are handled as before by
+cleanup_files.
+
+``flask migrate-uploads`` converts existing files to this layout and
+``flask rebuild-upload-refs`` recounts references after bulk edits.
+"""
+import hashlib
+import os
+import shutil
+import time
+from collections import Counter
+
+from sqlalchemy import event, inspect, or_, select, update
+
+from .timezone_utils import now_utc_for_db
+from .write_buffer import upsert
+
+CAS_DIR = 'cas'
+KEY_LENGTH = 40  # hex characters kept in file names
+
+# Stored path prefixes in front of the name under static/uploads
+UPLOAD_PREFIXES = ('static/uploads/', 'uploads/')
+
+# Columns holding paths relative to static/uploads (Service rows from the mobile API: 'uploads/<name>')
+TRACKED_COLUMNS = {
+    'Card': ('avatar_path', 'avatar_square_path', 'avatar_rect_path'),
+    'GalleryItem': ('image_path',),
+    'Product': ('image_path',),
+    'Service': ('image_path',),
+}
+
+
+# Columns rewritten when an upload is renamed (gallery thumbnails mirror the upload's name)
+RENAMED_COLUMNS = dict(TRACKED_COLUMNS, GalleryItem=('image_path', 'thumbnail_path'))
+
+
+def _config(name, default):
+    from flask import current_app
+    return current_app.config.get(name, default)
+
+
+def enabled():
+    try:
+        return bool(_config('UPLOAD_CONTENT_ADDRESSED', True))
+    except RuntimeError:
+        return False
+
+
+def upload_relpath(path):
+    """A stored path relative to static/uploads, the form reference counts are kept under"""
+    path = (path or '').replace('\\', '/').lstrip('/')
+    for prefix in UPLOAD_PREFIXES:
+        if path.startswith(prefix):
+            return path[len(prefix):]
+    return path
+
+
+def is_content_addressed(relpath):
+    return bool(relpath) and f'/{CAS_DIR}/' in f"/{relpath.replace(os.sep, '/')}"
+
+
+def content_key(stream, params=''):
+    """SHA-256 of a file-like object's bytes plus the processing parameters; rewinds the stream"""
+    sha = hashlib.sha256()
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(1024 * 1024), b''):
+        sha.update(chunk)
+    stream.seek(0)
+    sha.update(f'|{params}'.encode())
+    return sha.hexdigest()[:KEY_LENGTH]
+
+
+def content_relpath(key, suffix):
+    """Sharded name for a content key: cas/ab/cd/<key><suffix>"""
+    return f'{CAS_DIR}/{key[:2]}/{key[2:4]}/{key}{suffix}'
+
+
+def stored_relpath(relpath, stream):
+    """Content-addressed name for an already processed file, kept in relpath's folder"""
+    key = content_key(stream, 'stored')
+    ext = os.path.splitext(relpath)[1].lower()
+    return '/'.join(filter(None, [os.path.dirname(relpath), content_relpath(key, ext)]))
+
+
+def job_filename(value):
+    """Name an image job is recorded under, from a returned name, stored path or URL ('' if unusable)"""
+    value = (value or '').split('?', 1)[0].replace('\\', '/')
+    parts = [part for part in value.split('/') if part]
+    if '..' in parts:
+        return ''
+    if CAS_DIR in parts:
+        return '/'.join(parts[parts.index(CAS_DIR):])
+    return parts[-1] if parts else ''
+
+
+def reuse_existing(paths):
+    """True when every output is already stored; touches them so a pending release keeps them"""
+    if not all(os.path.exists(path) for path in paths):
+        return False
+    for path in paths:
+        try:
+            os.utime(path)
+        except OSError:
+            return False
+    return True
+
+
+def _uploads_root():
+    from flask import current_app
+    return os.path.join(current_app.root_path, 'static')
+
+
+def remove_files(relpath, root=None, grace=0):
+    """Delete an upload, its thumbnail and its derivatives; False when it is newer than grace"""
+    from .image_derivatives import derived_dir
+
+    root = root or _uploads_root()
+    relpath = upload_relpath(relpath)
+    main = os.path.join(root, 'uploads', relpath)
+    try:
+        if grace and time.time() - os.path.getmtime(main) < grace:
+            return False
+    except OSError:
+        pass
+    for path in (main, os.path.join(root, 'thumbs', relpath)):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    shutil.rmtree(derived_dir(relpath, root), ignore_errors=True)
+    return True
+
+
+def adjust_refcounts(connection, deltas):
+    """Add {path: delta} to upload_ref with a single upsert"""
+    from .models import UploadRef
+
+    table = UploadRef.__table__
+    now = now_utc_for_db()
+    values = [{'path': path, 'refcount': delta, 'created_at': now, 'updated_at': now}
+              for path, delta in deltas.items() if delta]
+    upsert(connection, table, values, key=('path',), increments=('refcount',), replace=('updated_at',))
+
+
+def _record(connection, target, deltas):
+    from sqlalchemy.orm import object_session
+
+    # 'uploads/cas/..' and 'cas/..' are the same file
+    normalized = Counter()
+    for path, delta in deltas.items():
+        if delta and is_content_addressed(path):
+            normalized[upload_relpath(path)] += delta
+    deltas = {path: delta for path, delta in normalized.items() if delta}
+    if not deltas:
+        return
+    adjust_refcounts(connection, deltas)
+    session = object_session(target)
+    released = [path for path, delta in deltas.items() if delta < 0]
+    if session is not None and released:
+        session.info.setdefault('upload_store_released', set()).update(released)
+
+
+def _columns(target):
+    return TRACKED_COLUMNS.get(type(target).__name__, ())
+
+
+def _inserted(mapper, connection, target):
+    _record(connection, target, Counter(getattr(target, column) for column in _columns(target)))
+
+
+def _updated(mapper, connection, target):
+    deltas = Counter()
+    state = inspect(target)
+    for column in _columns(target):
+        history = state.attrs[column].history
+        if not history.has_changes():
+            continue
+        for path in history.deleted:
+            deltas[path] -= 1
+        for path in history.added:
+            deltas[path] += 1
+    _record(connection, target, deltas)
+
+
+def _deleting(mapper, connection, target):
+    # Before the DELETE, so expired columns can still be loaded
+    state = inspect(target)
+    deltas = Counter()
+    for column in _columns(target):
+        history = state.attrs[column].load_history()
+        # The stored value, even if it was changed before the delete
+        for path in (history.deleted or history.unchanged):
+            deltas[path] -= 1
+    _record(connection, target, deltas)
+
+
+def _keep_old_value(target, value, oldvalue, initiator):
+    """Registered with active_history, so a replaced path is known even if it was never read"""
+
+
+def release_unreferenced(engine, paths, grace=None, root=None):
+    """Delete the files of paths whose count is zero; returns the paths removed"""
+    from .models import UploadRef
+
+    table = UploadRef.__table__
+    grace = _config('UPLOAD_RELEASE_GRACE', 300) if grace is None else grace
+    removed = []
+    with engine.connect() as connection:
+        unreferenced = connection.execute(
+            select(table.c.path).where(table.c.path.in_(list(paths)), table.c.refcount <= 0)
+        ).scalars().all()
+    for path in unreferenced:
+        if remove_files(path, root, grace):
+            removed.append(path)
+    if removed:
+        with engine.begin() as connection:
+            connection.execute(table.delete().where(table.c.path.in_(removed), table.c.refcount <= 0))
+    return removed
+
+
+def _after_commit(session):
+    paths = session.info.pop('upload_store_released', None)
+    if not paths:
+        return
+    try:
+        from . import db
+        release_unreferenced(db.engine, paths)
+    except Exception as e:
+        print(f"Upload release failed: {e}")
+
+
+def _after_rollback(session):
+    session.info.pop('upload_store_released', None)
+
+
+def _models():
+    from .models import Card, GalleryItem, Product, Service
+    return {'Card': Card, 'GalleryItem': GalleryItem, 'Product': Product, 'Service': Service}
+
+
+def referenced_paths(session, content_addressed=None, raw=False):
+    """Stream (model name, column, path) for every tracked non-empty path, relative to
+    static/uploads unless `raw` asks for the stored value"""
+    for name, model in _models().items():
+        for column in TRACKED_COLUMNS[name]:
+            attribute = getattr(model, column)
+            rows = session.execute(
+                select(attribute).where(attribute.isnot(None), attribute != '')
+                .execution_options(yield_per=1000)
+            ).scalars()
+            for path in rows:
+                if content_addressed is None or is_content_addressed(path) == content_addressed:
+                    yield name, column, path if raw else upload_relpath(path)
+
+
+def rebuild_refcounts(session):
+    """Recount every content-addressed reference from scratch; returns (paths, references)"""
+    from .models import UploadRef
+
+    counts = Counter(path for _, _, path in referenced_paths(session, content_addressed=True))
+    table = UploadRef.__table__
+    connection = session.connection()
+    connection.execute(update(table).values(refcount=0))
+    # Rows counted under a prefixed path by older code
+    connection.execute(table.delete().where(
+        or_(*[table.c.path.startswith(prefix) for prefix in UPLOAD_PREFIXES])))
+    adjust_refcounts(connection, {path: count for path, count in counts.items()})
+    session.commit()
+    return len(counts), sum(counts.values())
+
+
+def link_or_copy(source, target):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if os.path.exists(target):
+        return False
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+    return True
+
+
+def migrate_legacy(session, dry_run=False, progress=None):
+    """Move files with random names into the content-addressed layout and repoint every row"""
+    from .image_derivatives import derived_dir
+
+    root = _uploads_root()
+    report = {'paths': 0, 'missing': 0, 'duplicates': 0, 'rows': 0,
+              'bytes_before': 0, 'bytes_after': 0, 'dry_run': dry_run}
+    legacy = sorted({path for _, _, path in referenced_paths(session, content_addressed=False)})
+
+    mapping, stored = {}, set()
+    for done, relpath in enumerate(legacy, 1):
+        source = os.path.join(root, 'uploads', relpath)
+        if not os.path.isfile(source):
+            report['missing'] += 1
+            continue
+        report['paths'] += 1
+        size = os.path.getsize(source)
+        report['bytes_before'] += size
+        with open(source, 'rb') as stream:
+            new_relpath = stored_relpath(relpath, stream)
+        mapping[relpath] = new_relpath
+        if new_relpath in stored:
+            report['duplicates'] += 1
+        else:
+            stored.add(new_relpath)
+            report['bytes_after'] += size
+        if not dry_run:
+            link_or_copy(source, os.path.join(root, 'uploads', new_relpath))
+            thumbnail = os.path.join(root, 'thumbs', relpath)
+            if os.path.isfile(thumbnail):
+                link_or_copy(thumbnail, os.path.join(root, 'thumbs', new_relpath))
+        if progress and done % 500 == 0:
+            progress(done, len(legacy))
+
+    if dry_run or not mapping:
+        return report
+
+    report['rows'] = repoint(session, mapping)
+
+    # Old names are no longer referenced
+    for old, new in mapping.items():
+        old_derived, new_derived = derived_dir(old, root), derived_dir(new, root)
+        if os.path.isdir(old_derived):
+            if os.path.exists(new_derived):
+                shutil.rmtree(old_derived, ignore_errors=True)
+            else:
+                os.makedirs(os.path.dirname(new_derived), exist_ok=True)
+                os.replace(old_derived, new_derived)
+        for folder in ('uploads', 'thumbs'):
+            try:
+                os.remove(os.path.join(root, folder, old))
+            except OSError:
+                pass
+    return report
+
+
+def repoint(session, mapping):
+    """Point rows at new upload names ({old relpath: new relpath}); returns rows updated.
+    Reference counts are recounted and cached pages dropped"""
+    from .models import Card
+
+    rows = 0
+    for name, model in _models().items():
+        table = model.__table__
+        for column in RENAMED_COLUMNS[name]:
+            for old, new in mapping.items():
+                # Rows keep the prefix they were stored with; Card.updated_at is
+                # pinned so cards do not look edited
+                for prefix in ('',) + UPLOAD_PREFIXES:
+                    statement = update(table).where(table.c[column] == prefix + old).values({column: prefix + new})
+                    if model is Card:
+                        statement = statement.values(updated_at=table.c.updated_at)
+                    rows += session.execute(statement).rowcount
+    session.commit()
+    rebuild_refcounts(session)
+    _clear_page_caches()
+    return rows
+
+
+def _clear_page_caches():
+    """Cached card pages still point at the old names"""
+    from . import cache, cache_bus
+    try:
+        cache.clear()
+        cache_bus.publish('*')
+    except Exception as e:
+        print(f"Cache clear after upload migration failed: {e}")
+
+
+def init_app(app):
+    """Reference counting on the upload columns and immutable headers for content-addressed files"""
+    from sqlalchemy.orm import Session
+
+    models = _models()
+    if not event.contains(models['Card'], 'after_insert', _inserted):
+        for name, model in models.items():
+            event.listen(model, 'after_insert', _inserted)
+            event.listen(model, 'after_update', _updated)
+            event.listen(model, 'before_delete', _deleting)
+            for column in TRACKED_COLUMNS[name]:
+                event.listen(getattr(model, column), 'set', _keep_old_value, active_history=True)
+        event.listen(Session, 'after_commit', _after_commit)
+        event.listen(Session, 'after_rollback', _after_rollback)
+
+    static_prefix = (app.static_url_path or '/static') + '/'
+
+    @app.after_request
+    def immutable_uploads(response):
+        from flask import request
+        if response.status_code in (200, 304) and request.path.startswith(static_prefix) \
+                and f'/{CAS_DIR}/' in request.path:
+            response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return response
@@ -1,7 +1,9 @@
 import os
 import secrets
 import io
+import math
 import base64
+import threading
 from PIL import Image
 from flask import current_app
 from werkzeug.utils import secure_filename
@@ -43,25 +45,21 @@ def validate_file_content(file):
     if size == 0:
         return False, "El archivo está vacío"
     
-    # Try to open with PIL to ensure it's a valid image
+    # Open once: format and extension come from the header, verify() checks the data
     try:
         img = Image.open(file)
+        image_format = img.format
         
         # Check if detected format is allowed
-        if img.format not in ALLOWED_PIL_FORMATS:
-            return False, f"Formato de imagen no permitido. Se detectó: {img.format}"
-        
-        # Verify it's a valid image
-        img.verify()
-        file.seek(0)  # Reset after verify
-        
-        # Re-open for format check (verify() closes the image)
-        img = Image.open(file)
+        if image_format not in ALLOWED_PIL_FORMATS:
+            return False, f"Formato de imagen no permitido. Se detectó: {image_format}"
         
         # Additional security check: ensure image format matches extension
-        if not filename_extension_matches_format(file.filename, img.format):
+        if not filename_extension_matches_format(file.filename, image_format):
             return False, "La extensión del archivo no coincide con el formato de imagen"
         
+        # Verify it's a valid image (this consumes the stream, so it goes last)
+        img.verify()
         file.seek(0)  # Reset to beginning
             
     except Exception as e:
@@ -87,34 +85,145 @@ def filename_extension_matches_format(filename, image_format):
 def sanitize_image(image):
     """
     Remove potentially malicious metadata from image
-    and convert to safe format
+    and convert to safe format (RGB or grayscale, no transparency).
+    Works on the decoded buffer: at most one converted copy is made.
     """
     try:
-        # Convert to RGB if needed (removes transparency and metadata)
-        if image.mode in ('RGBA', 'LA', 'P'):
-            rgb_image = Image.new('RGB', image.size, (255, 255, 255))
-            if image.mode == 'RGBA':
-                rgb_image.paste(image, mask=image.split()[-1])
-            elif image.mode == 'P' and 'transparency' in image.info:
-                image = image.convert('RGBA')
-                rgb_image.paste(image, mask=image.split()[-1])
-            else:
-                rgb_image.paste(image)
-            image = rgb_image
-        
-        # Create new image without metadata
-        clean_image = Image.new(image.mode, image.size)
-        clean_image.paste(image)
+        if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+            # Flatten transparency onto white
+            rgba = image.convert('RGBA')
+            clean_image = Image.new('RGB', image.size, (255, 255, 255))
+            clean_image.paste(rgba, mask=rgba.getchannel('A'))
+        elif image.mode not in ('RGB', 'L'):
+            clean_image = image.convert('RGB')
+        else:
+            image.load()
+            clean_image = image
         
+        # Drop EXIF, ICC, comments, etc.
+        clean_image.info = {}
         return clean_image
     except Exception:
         return image  # Return original if sanitization fails
 
-def save_image(file, folder, max_size=(800, 800), thumbnail_size=(150, 150)):
+# JPEGs are decoded at a reduced scale (draft mode) of at least this many times the largest output
+DRAFT_REDUCING_GAP = 2.0
+
+def fit_ratio(size, box):
+    """Scale at which an image of size fits inside box (never above 1)"""
+    return min(box[0] / size[0], box[1] / size[1], 1)
+
+def draft_image(image, scale):
+    """
+    Let the JPEG decoder scale by 1/2, 1/4 or 1/8 while decoding when the
+    image will be shrunk to `scale` anyway. The decoded image keeps at
+    least DRAFT_REDUCING_GAP times the final size for the LANCZOS resize.
+    No-op for other formats and for images already loaded.
+    """
+    if image.format == 'JPEG' and scale * DRAFT_REDUCING_GAP < 1:
+        width, height = image.size
+        image.draft('RGB', (math.ceil(width * scale * DRAFT_REDUCING_GAP),
+                            math.ceil(height * scale * DRAFT_REDUCING_GAP)))
+    return image
+
+def fit_image(image, size):
+    """Resized copy that fits inside size, keeping aspect ratio and never upscaling"""
+    ratio = fit_ratio(image.size, size)
+    target = (max(round(image.width * ratio), 1), max(round(image.height * ratio), 1))
+    return image.resize(target, Image.Resampling.LANCZOS, reducing_gap=DRAFT_REDUCING_GAP)
+
+def _save_jpeg(image, path, quality):
+    """Write to a temporary name first so a half-written file is never served.
+    The name is per process and thread: concurrent uploads of the same bytes
+    write the same content-addressed path"""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        image.save(tmp_path, 'JPEG', quality=quality, optimize=True)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _build_derivatives(spec, image):
+    """Responsive widths of a freshly written image; a failure here never fails the upload"""
+    from .image_derivatives import build_derivatives
+    try:
+        build_derivatives(spec, image=image)
+    except Exception as e:
+        print(f"Error building derivatives of {spec['source']}: {e}")
+
+def process_image(source, file_path, thumbnail_file_path, max_size=(800, 800), thumbnail_size=(150, 150), derivatives=None):
+    """Decode once, then write the main image, its thumbnail (taken from the main image)
+    and, given a spec from image_derivatives.spec_for, its responsive widths"""
+    image = Image.open(source)
+    image = sanitize_image(draft_image(image, fit_ratio(image.size, max_size)))
+    
+    main_image = fit_image(image, max_size)
+    _save_jpeg(main_image, file_path, 85)
+    
+    thumbnail = fit_image(main_image, thumbnail_size)
+    _save_jpeg(thumbnail, thumbnail_file_path, 80)
+    
+    if derivatives:
+        _build_derivatives(derivatives, main_image)
+
+def process_avatar(source, square_path, rect_path, square_size=(300, 300), rect_size=(600, 400), derivatives=None):
+    """Write the square and rectangular versions of an avatar from one decode.
+    `derivatives` is a (square spec, rect spec) pair from image_derivatives.spec_for"""
+    original_image = Image.open(source)
+    # Decode large enough for both versions, including a center crop of the shorter side
+    scale = max(fit_ratio(original_image.size, rect_size),
+                min(max(square_size) / min(original_image.size), 1))
+    original_image = sanitize_image(draft_image(original_image, scale))
+    
+    # Create SQUARE version (for circle, rounded, square avatars)
+    width, height = original_image.size
+    
+    # Smart square fitting: if image is already roughly square, just resize
+    aspect_ratio = width / height
+    if 0.8 <= aspect_ratio <= 1.2:  # Almost square (within 20%)
+        # Just resize maintaining aspect ratio
+        square_image = fit_image(original_image, square_size)
+        
+        # If needed, pad to make it perfectly square
+        w, h = square_image.size
+        if w != h:
+            size = max(w, h)
+            square_bg = Image.new('RGB', (size, size), (255, 255, 255))
+            offset = ((size - w) // 2, (size - h) // 2)
+            square_bg.paste(square_image, offset)
+            square_image = square_bg
+    else:
+        # For very rectangular images, crop to square from center (done by resize's box)
+        size = min(width, height)
+        left = (width - size) // 2
+        top = (height - size) // 2
+        square_image = original_image.resize(square_size, Image.Resampling.LANCZOS,
+                                             box=(left, top, left + size, top + size),
+                                             reducing_gap=DRAFT_REDUCING_GAP)
+    
+    # Create RECTANGULAR version (preserves original aspect ratio)
+    rect_image = fit_image(original_image, rect_size)
+    
+    # Save both versions
+    _save_jpeg(square_image, square_path, 90)
+    _save_jpeg(rect_image, rect_path, 90)
+    
+    if derivatives:
+        for spec, image in zip(derivatives, (square_image, rect_image)):
+            if spec:
+                _build_derivatives(spec, image)
+
+def save_image(file, folder, max_size=(800, 800), thumbnail_size=(150, 150), user_id=None):
     """
-    Save an uploaded image with resizing and thumbnail generation
+    Save an uploaded image with resizing and thumbnail generation.
+    With IMAGE_JOBS_ENABLED the resize runs in the background image pool and
+    the returned names are filled in a moment later (see image_jobs).
     Returns: (filename, thumbnail_filename) or (None, None) if error
     """
+    from . import image_jobs, image_derivatives, upload_store
+    
     if not file or not allowed_file(file.filename):
         return None, None
     
@@ -127,47 +236,53 @@ def save_image(file, folder, max_size=(800, 800), thumbnail_size=(150, 150)):
     # Generate secure filename
     filename = secure_filename(file.filename)
     name, ext = os.path.splitext(filename)
-    filename = f"{secrets.token_hex(16)}{ext}"
+    content_addressed = upload_store.enabled()
+    if content_addressed:
+        # Same bytes and sizes -> same name (the output is always JPEG)
+        key = upload_store.content_key(file.stream, f"image:{max_size}:{thumbnail_size}")
+        filename = upload_store.content_relpath(key, '.jpg')
+    else:
+        filename = f"{secrets.token_hex(16)}{ext}"
     
     # Create paths
     upload_path = os.path.join(current_app.root_path, folder)
     thumbnail_folder = folder.replace('uploads', 'thumbs')
     thumbnail_path = os.path.join(current_app.root_path, thumbnail_folder)
     
-    # Ensure directories exist
-    os.makedirs(upload_path, exist_ok=True)
-    os.makedirs(thumbnail_path, exist_ok=True)
-    
     file_path = os.path.join(upload_path, filename)
     thumbnail_file_path = os.path.join(thumbnail_path, filename)
     
+    # Ensure directories exist
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    os.makedirs(os.path.dirname(thumbnail_file_path), exist_ok=True)
+    
+    if content_addressed and (upload_store.reuse_existing([file_path, thumbnail_file_path])
+                              or image_jobs.status_of(filename) in ('pending', 'running')):
+        return filename, filename
+    
+    derivatives = image_derivatives.spec_for(file_path)
+    
     try:
-        # Open and process the image
-        image = Image.open(file.stream)
-        
-        # Sanitize image (remove metadata and potential threats)
-        image = sanitize_image(image)
-        
-        # Resize main image
-        image.thumbnail(max_size, Image.Resampling.LANCZOS)
-        image.save(file_path, 'JPEG', quality=85, optimize=True)
-        
-        # Create thumbnail
-        thumbnail = image.copy()
-        thumbnail.thumbnail(thumbnail_size, Image.Resampling.LANCZOS)
-        thumbnail.save(thumbnail_file_path, 'JPEG', quality=80, optimize=True)
+        if image_jobs.enabled():
+            image_jobs.enqueue('image', file, filename, [file_path, thumbnail_file_path],
+                               {'max_size': max_size, 'thumbnail_size': thumbnail_size,
+                                'derivatives': derivatives}, user_id)
+        else:
+            process_image(file.stream, file_path, thumbnail_file_path, max_size, thumbnail_size, derivatives)
         
         return filename, filename
     
     except Exception as e:
         print(f"Error saving image: {e}")
-        # Clean up any created files on error
-        for path in [file_path, thumbnail_file_path]:
-            if os.path.exists(path):
-                os.remove(path)
+        # Clean up any created files on error; a content-addressed file may
+        # have been written by a concurrent upload of the same bytes
+        if not content_addressed:
+            for path in [file_path, thumbnail_file_path]:
+                if os.path.exists(path):
+                    os.remove(path)
         return None, None
 
-def save_avatar(file, square_size=(300, 300), rect_size=(600, 400)):
+def save_avatar(file, square_size=(300, 300), rect_size=(600, 400), user_id=None):
     """
     Save avatar image creating two optimized versions:
     1. Square version: Intelligently fitted for circular/square avatars
@@ -177,10 +292,13 @@ def save_avatar(file, square_size=(300, 300), rect_size=(600, 400)):
         file: The uploaded file
         square_size: Maximum dimensions for square version
         rect_size: Maximum dimensions for rectangular version
+        user_id: Owner of the background job (defaults to the logged-in user)
     
     Returns:
         tuple: (square_filename, rect_filename) or (None, None) if error
     """
+    from . import image_jobs, image_derivatives, upload_store
+    
     if not file or not allowed_file(file.filename):
         return None, None
     
@@ -192,66 +310,45 @@ def save_avatar(file, square_size=(300, 300), rect_size=(600, 400)):
     
     filename = secure_filename(file.filename)
     name, ext = os.path.splitext(filename)
-    base_name = f"avatar_{secrets.token_hex(16)}"
+    content_addressed = upload_store.enabled()
+    if content_addressed:
+        key = upload_store.content_key(file.stream, f"avatar:{square_size}:{rect_size}")
+        base_name = upload_store.content_relpath(key, '')
+    else:
+        base_name = f"avatar_{secrets.token_hex(16)}"
     
     square_filename = f"{base_name}_square.jpg"
     rect_filename = f"{base_name}_rect.jpg"
     
     upload_path = os.path.join(current_app.root_path, 'static', 'uploads')
-    os.makedirs(upload_path, exist_ok=True)
     
     square_path = os.path.join(upload_path, square_filename)
     rect_path = os.path.join(upload_path, rect_filename)
+    os.makedirs(os.path.dirname(square_path), exist_ok=True)
+    
+    if content_addressed and (upload_store.reuse_existing([square_path, rect_path])
+                              or image_jobs.status_of(square_filename) in ('pending', 'running')):
+        return square_filename, rect_filename
+    
+    derivatives = [image_derivatives.spec_for(square_path), image_derivatives.spec_for(rect_path)]
     
     try:
-        # Open and prepare the original image
-        original_image = Image.open(file.stream)
-        
-        # Sanitize image (remove metadata and potential threats)
-        original_image = sanitize_image(original_image)
-        
-        # Create SQUARE version (for circle, rounded, square avatars)
-        square_image = original_image.copy()
-        width, height = square_image.size
-        
-        # Smart square fitting: if image is already roughly square, just resize
-        aspect_ratio = width / height
-        if 0.8 <= aspect_ratio <= 1.2:  # Almost square (within 20%)
-            # Just resize maintaining aspect ratio
-            square_image.thumbnail(square_size, Image.Resampling.LANCZOS)
-            
-            # If needed, pad to make it perfectly square
-            w, h = square_image.size
-            if w != h:
-                size = max(w, h)
-                square_bg = Image.new('RGB', (size, size), (255, 255, 255))
-                offset = ((size - w) // 2, (size - h) // 2)
-                square_bg.paste(square_image, offset)
-                square_image = square_bg
+        if image_jobs.enabled():
+            image_jobs.enqueue('avatar', file, square_filename, [square_path, rect_path],
+                               {'square_size': square_size, 'rect_size': rect_size,
+                                'derivatives': derivatives}, user_id)
         else:
-            # For very rectangular images, crop to square from center
-            size = min(width, height)
-            left = (width - size) // 2
-            top = (height - size) // 2
-            square_image = square_image.crop((left, top, left + size, top + size))
-            square_image = square_image.resize(square_size, Image.Resampling.LANCZOS)
-        
-        # Create RECTANGULAR version (preserves original aspect ratio)
-        rect_image = original_image.copy()
-        rect_image.thumbnail(rect_size, Image.Resampling.LANCZOS)
-        
-        # Save both versions
-        square_image.save(square_path, 'JPEG', quality=90, optimize=True)
-        rect_image.save(rect_path, 'JPEG', quality=90, optimize=True)
+            process_avatar(file.stream, square_path, rect_path, square_size, rect_size, derivatives)
         
         return square_filename, rect_filename
     
     except Exception as e:
         print(f"Error saving avatar: {e}")
-        # Clean up any created files on error
-        for path in [square_path, rect_path]:
-            if os.path.exists(path):
-                os.remove(path)
+        # Clean up any created files on error (see save_image)
+        if not content_addressed:
+            for path in [square_path, rect_path]:
+                if os.path.exists(path):
+                    os.remove(path)
         return None, None
 
 def delete_file(file_path):
@@ -297,8 +394,13 @@ def cleanup_files(file_paths):
     for file_path in file_paths:
         if file_path:
             try:
+                from .image_derivatives import remove_derivatives
+                from .upload_store import is_content_addressed
+                if is_content_addressed(file_path):
+                    continue  # Shared: deleted by upload_store once no row refers to it
                 full_path = os.path.join(current_app.root_path, 'static', 'uploads', file_path)
                 delete_file(full_path)
+                remove_derivatives(file_path)
             except Exception:
                 pass  # Ignore cleanup errors
 
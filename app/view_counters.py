@@ -0,0 +1,224 @@
+"""
+Batched per-card view counters.
+
+Every stored card view is counted in a per-worker buffer keyed by
+(card_id, UTC day). Every few views or seconds the buffer is written in one
+transaction: an upsert into ``card_view_counter`` plus batched increments of
+``Card.views_total/views_today/views_month`` and ``User.total_views``. The
+flush then updates the popular-cards leaderboard for the cards it touched,
+so counters and rankings never need to scan ``card_view``.
+"""
+import threading
+from collections import Counter
+from datetime import datetime
+
+from sqlalchemy import bindparam, case, func, select, update
+
+from .analytics_cache import invalidate_cards
+from .timezone_utils import now_local, now_utc_for_db, get_month_range_utc, get_today_range_utc
+from .write_buffer import WriteBuffer, register_exit_flush, upsert
+
+
+class ViewCounterBuffer(WriteBuffer):
+    """Per-worker buffer of view increments waiting to be written"""
+
+    def __init__(self, flush_size=20, flush_interval=10):
+        super().__init__(flush_size, flush_interval)  # pending: (card_id, day) -> views
+        self.flushes = 0
+        self.flushed_views = 0
+
+    def record(self, card_id, views=1):
+        with self._lock:
+            self._add((card_id, now_utc_for_db().date()), views)
+
+    def flush(self, session):
+        """Upsert buffered increments and refresh the leaderboard for touched cards"""
+        pending = self._take()
+        if not pending:
+            return 0
+
+        per_card = Counter()
+        for (card_id, _), views in pending.items():
+            per_card[card_id] += views
+
+        try:
+            increment_counters(session, pending)
+            increment_card_totals(session, per_card)
+            session.commit()
+        except Exception:
+            session.rollback()
+            self._put_back(pending)
+            return 0
+
+        with self._lock:
+            self.flushes += 1
+            self.flushed_views += sum(pending.values())
+
+        from .leaderboard import update_leaderboard
+        try:
+            update_leaderboard(session, set(per_card))
+        except Exception:
+            # Rankings are rebuilt from the counters on the next miss
+            pass
+        try:
+            invalidate_cards(session, set(per_card))
+        except Exception:
+            pass
+        return sum(pending.values())
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending_views': sum(self._pending.values()),
+                'flushes': self.flushes,
+                'flushed_views': self.flushed_views,
+            }
+
+
+def increment_counters(session, increments):
+    """Add {(card_id, day): views} to card_view_counter with a single upsert"""
+    from .models import CardViewCounter
+
+    table = CardViewCounter.__table__
+    rows = [{'card_id': card_id, 'day': day, 'views': views}
+            for (card_id, day), views in increments.items()]
+    upsert(session, table, rows, key=('card_id', 'day'), increments=('views',))
+
+
+def increment_card_totals(session, per_card):
+    """Add {card_id: views} to the Card counters and their owners' User.total_views"""
+    from .models import Card, User
+
+    card = Card.__table__
+    user = User.__table__
+    today = now_local().date()
+    params = [{'card': card_id, 'n': views, 'today': today, 'month_start': today.replace(day=1)}
+              for card_id, views in per_card.items()]
+
+    # views_counted_on goes last: MySQL evaluates SET assignments left to right.
+    # updated_at is pinned so counting views never looks like a card edit.
+    session.execute(
+        update(card).where(card.c.id == bindparam('card')).ordered_values(
+            (card.c.views_total, card.c.views_total + bindparam('n')),
+            (card.c.views_today, case((card.c.views_counted_on == bindparam('today'),
+                                       card.c.views_today + bindparam('n')), else_=bindparam('n'))),
+            (card.c.views_month, case((card.c.views_counted_on >= bindparam('month_start'),
+                                       card.c.views_month + bindparam('n')), else_=bindparam('n'))),
+            (card.c.views_counted_on, bindparam('today')),
+            (card.c.updated_at, card.c.updated_at),
+        ),
+        params
+    )
+    owner = select(card.c.owner_id).where(card.c.id == bindparam('card')).scalar_subquery()
+    session.execute(
+        update(user).where(user.c.id == owner).values(
+            total_views=func.coalesce(user.c.total_views, 0) + bindparam('n'),
+            updated_at=user.c.updated_at
+        ),
+        params
+    )
+
+
+def reconcile_card_totals(session):
+    """Reset Card and User counters to the values derived from the raw table and archives"""
+    from .models import Card, CardView, CardViewDaily, User
+
+    def per_card(query):
+        return Counter({card_id: int(views) for card_id, views in query})
+
+    today_start, today_end = get_today_range_utc()
+    month_start, month_end = get_month_range_utc()
+
+    totals = per_card(session.query(CardView.card_id, func.count(CardView.id)).group_by(CardView.card_id))
+    totals.update(per_card(session.query(CardViewDaily.card_id, func.sum(CardViewDaily.views))
+                           .group_by(CardViewDaily.card_id)))
+    today = per_card(session.query(CardView.card_id, func.count(CardView.id)).filter(
+        CardView.viewed_at >= today_start, CardView.viewed_at <= today_end).group_by(CardView.card_id))
+    month = per_card(session.query(CardView.card_id, func.count(CardView.id)).filter(
+        CardView.viewed_at >= month_start, CardView.viewed_at <= month_end).group_by(CardView.card_id))
+    month.update(per_card(session.query(CardViewDaily.card_id, func.sum(CardViewDaily.views)).filter(
+        CardViewDaily.day >= month_start.date()).group_by(CardViewDaily.card_id)))
+
+    local_today = now_local().date()
+    card_updates = []
+    owner_totals = Counter()
+    for card in session.query(Card.id, Card.owner_id, Card.views_total, Card.views_today,
+                              Card.views_month, Card.views_counted_on):
+        owner_totals[card.owner_id] += totals[card.id]
+        counted_today = card.views_counted_on == local_today
+        counted_month = bool(card.views_counted_on) and card.views_counted_on >= local_today.replace(day=1)
+        current = (card.views_total or 0,
+                   card.views_today if counted_today else 0,
+                   card.views_month if counted_month else 0)
+        if current != (totals[card.id], today[card.id], month[card.id]):
+            card_updates.append({'card': card.id, 'total': totals[card.id], 'today_views': today[card.id],
+                                 'month_views': month[card.id], 'day': local_today})
+
+    table = Card.__table__
+    if card_updates:
+        session.execute(
+            update(table).where(table.c.id == bindparam('card')).values(
+                views_total=bindparam('total'), views_today=bindparam('today_views'),
+                views_month=bindparam('month_views'), views_counted_on=bindparam('day'),
+                updated_at=table.c.updated_at
+            ),
+            card_updates
+        )
+
+    users = User.__table__
+    user_updates = [{'user': user_id, 'total': owner_totals[user_id]}
+                    for user_id, current in session.query(User.id, User.total_views)
+                    if (current or 0) != owner_totals[user_id]]
+    if user_updates:
+        session.execute(
+            update(users).where(users.c.id == bindparam('user')).values(
+                total_views=bindparam('total'), updated_at=users.c.updated_at
+            ),
+            user_updates
+        )
+    session.commit()
+    return {'cards_corrected': len(card_updates), 'users_corrected': len(user_updates)}
+
+
+def rebuild_counters(session):
+    """Recompute card_view_counter from raw views and archived daily aggregates"""
+    from .models import CardView, CardViewCounter, CardViewDaily
+
+    totals = Counter()
+    day = func.date(CardView.viewed_at)
+    for card_id, view_day, views in session.query(CardView.card_id, day, func.count(CardView.id))\
+            .filter(CardView.viewed_at.isnot(None)).group_by(CardView.card_id, day):
+        if isinstance(view_day, str):
+            view_day = datetime.strptime(view_day, '%Y-%m-%d').date()
+        totals[(card_id, view_day)] += views
+    for card_id, archived_day, views in session.query(CardViewDaily.card_id, CardViewDaily.day, CardViewDaily.views):
+        totals[(card_id, archived_day)] += views
+
+    session.query(CardViewCounter).delete(synchronize_session=False)
+    if totals:
+        session.execute(CardViewCounter.__table__.insert(), [
+            {'card_id': card_id, 'day': view_day, 'views': views}
+            for (card_id, view_day), views in totals.items()
+        ])
+    session.commit()
+    return len(totals)
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_view_counters():
+    """Process-wide counter buffer configured from VIEW_COUNTER_* settings"""
+    global _buffer
+    if _buffer is None:
+        from flask import current_app
+        with _buffer_lock:
+            if _buffer is None:
+                config = current_app.config
+                _buffer = ViewCounterBuffer(
+                    flush_size=config.get('VIEW_COUNTER_FLUSH_SIZE', 20),
+                    flush_interval=config.get('VIEW_COUNTER_FLUSH_INTERVAL', 10),
+                )
+                register_exit_flush(current_app._get_current_object(), lambda db: _buffer.flush(db.session))
+    return _buffer
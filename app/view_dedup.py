@@ -0,0 +1,117 @@
+"""
+Session-window deduplication for card views.
+
+A visitor is identified by a hash of (IP, User-Agent). The first hit on a
+card inside the window inserts a CardView row; repeats inside the window
+only bump that row's ``hits`` counter. Increments are buffered per worker
+and written in one batched UPDATE, so reload storms cost no new rows and
+very few writes.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import text
+
+from .write_buffer import WriteBuffer, register_exit_flush
+
+
+class ViewDeduplicator(WriteBuffer):
+    """Per-worker TTL map of (card_id, visitor) -> view id"""
+
+    def __init__(self, window_seconds=1800, max_entries=100000,
+                 flush_size=50, flush_interval=30, secret=''):
+        super().__init__(flush_size, flush_interval)  # pending: view_id -> extra hits not yet written
+        self.window_seconds = window_seconds
+        self.max_entries = max_entries
+        self._secret = secret.encode('utf-8')
+        self._seen = OrderedDict()  # key -> (view_id, first_seen)
+        self.repeats = 0
+        self.inserts = 0
+
+    def visitor_hash(self, ip_address, user_agent):
+        """Stable, non-reversible visitor id stored in CardView.session_id"""
+        digest = hashlib.sha256(self._secret)
+        digest.update(f'{ip_address or ""}|{user_agent or ""}'.encode('utf-8'))
+        return digest.hexdigest()[:32]
+
+    def _expire(self, now):
+        cutoff = now - self.window_seconds
+        while self._seen:
+            key, (_, first_seen) = next(iter(self._seen.items()))
+            if first_seen >= cutoff and len(self._seen) <= self.max_entries:
+                break
+            self._seen.popitem(last=False)
+
+    def register_repeat(self, card_id, visitor):
+        """If the visitor was seen recently, count the hit and return True"""
+        now = time.time()
+        key = (card_id, visitor)
+        with self._lock:
+            self._expire(now)
+            entry = self._seen.get(key)
+            if entry is None:
+                return False
+            self._add(entry[0])
+            self.repeats += 1
+            return True
+
+    def remember(self, card_id, visitor, view_id):
+        """Open a dedup window for a freshly inserted view"""
+        with self._lock:
+            self._seen[(card_id, visitor)] = (view_id, time.time())
+            self.inserts += 1
+
+    def flush(self, session):
+        """Write buffered repeat hits with a single batched UPDATE"""
+        pending = self._take()
+        if not pending:
+            return 0
+
+        try:
+            session.execute(
+                text('UPDATE card_view SET hits = hits + :extra WHERE id = :view_id'),
+                [{'extra': extra, 'view_id': view_id} for view_id, extra in pending.items()]
+            )
+            session.commit()
+        except Exception:
+            session.rollback()
+            self._put_back(pending)
+            return 0
+        return sum(pending.values())
+
+    def stats(self):
+        with self._lock:
+            total = self.repeats + self.inserts
+            return {
+                'window_seconds': self.window_seconds,
+                'tracked_visitors': len(self._seen),
+                'inserts': self.inserts,
+                'repeats': self.repeats,
+                'pending_hits': sum(self._pending.values()),
+                'dedup_ratio': round(self.repeats / total * 100, 1) if total else 0,
+            }
+
+
+_deduplicator = None
+_deduplicator_lock = threading.Lock()
+
+
+def get_deduplicator():
+    """Process-wide deduplicator configured from VIEW_DEDUP_* settings"""
+    global _deduplicator
+    if _deduplicator is None:
+        from flask import current_app
+        with _deduplicator_lock:
+            if _deduplicator is None:
+                config = current_app.config
+                _deduplicator = ViewDeduplicator(
+                    window_seconds=config.get('VIEW_DEDUP_WINDOW', 1800),
+                    max_entries=config.get('VIEW_DEDUP_MAX_ENTRIES', 100000),
+                    flush_size=config.get('VIEW_DEDUP_FLUSH_SIZE', 50),
+                    flush_interval=config.get('VIEW_DEDUP_FLUSH_INTERVAL', 30),
+                    secret=config.get('SECRET_KEY', ''),
+                )
+                register_exit_flush(current_app._get_current_object(), lambda db: _deduplicator.flush(db.session))
+    return _deduplicator
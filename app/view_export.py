@@ -0,0 +1,134 @@
+"""
+Streaming export of raw card_view rows.
+
+Rows are read in ``viewed_at, id`` order through a server-side cursor
+(``stream_results`` + ``yield_per``) and written as CSV or NDJSON chunks by
+generators, so memory use does not depend on the size of the export. An
+export can be resumed from the last row received by passing its
+``viewed_at`` and ``id`` back as ``since`` / ``after_id``.
+
+Visitors are exported as the hex of the keyed IP hash only. Rows that
+still hold a raw IP (not yet compacted) are hashed on the way out, so
+the same visitor gets the same value either way.
+"""
+import csv
+import io
+import json
+
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.orm import aliased
+
+from .view_storage import _ip_hash_key, hash_ip
+
+EXPORT_FIELDS = [
+    'id', 'card_id', 'card_slug', 'viewed_at', 'hits', 'device_type', 'browser', 'platform',
+    'country', 'city', 'referrer', 'user_agent', 'visitor', 'session_id',
+]
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def build_query(card_ids=None, start=None, end=None, since=None, after_id=None):
+    """Keyset-ordered select of export columns with dimension strings joined in"""
+    from .models import Card, CardView, ViewDimension
+
+    user_agent = aliased(ViewDimension)
+    referrer = aliased(ViewDimension)
+    browser = aliased(ViewDimension)
+    platform = aliased(ViewDimension)
+
+    query = select(
+        CardView.id,
+        CardView.card_id,
+        Card.slug.label('card_slug'),
+        CardView.viewed_at,
+        CardView.hits,
+        CardView.device_type,
+        func.coalesce(browser.value, CardView.legacy_browser).label('browser'),
+        func.coalesce(platform.value, CardView.legacy_platform).label('platform'),
+        CardView.country,
+        CardView.city,
+        func.coalesce(referrer.value, CardView.legacy_referrer).label('referrer'),
+        func.coalesce(user_agent.value, CardView.legacy_user_agent).label('user_agent'),
+        CardView.ip_hash,
+        CardView.legacy_ip_address,
+        CardView.session_id,
+    ).join(Card, Card.id == CardView.card_id)\
+     .outerjoin(user_agent, user_agent.id == CardView.user_agent_id)\
+     .outerjoin(referrer, referrer.id == CardView.referrer_host_id)\
+     .outerjoin(browser, browser.id == CardView.browser_id)\
+     .outerjoin(platform, platform.id == CardView.platform_id)
+
+    if card_ids is not None:
+        query = query.where(CardView.card_id.in_(card_ids))
+    if start is not None:
+        query = query.where(CardView.viewed_at >= start)
+    if end is not None:
+        query = query.where(CardView.viewed_at < end)
+    if since is not None:
+        # Resume strictly after the last exported row
+        query = query.where(or_(
+            CardView.viewed_at > since,
+            and_(CardView.viewed_at == since, CardView.id > (after_id or 0))
+        ))
+    return query.order_by(CardView.viewed_at, CardView.id)
+
+
+def iter_rows(session, batch_size=1000, **filters):
+    """Yield export rows one by one through a server-side cursor, as dicts"""
+    key = _ip_hash_key()
+    result = session.execute(
+        build_query(**filters).execution_options(stream_results=True, yield_per=batch_size)
+    )
+    for row in result:
+        data = row._asdict()
+        legacy_ip = data.pop('legacy_ip_address')
+        ip_hash = data.pop('ip_hash') or hash_ip(legacy_ip, key)
+        data['visitor'] = ip_hash.hex() if ip_hash else None
+        yield {field: data[field] for field in EXPORT_FIELDS}
+
+
+def _values(row):
+    data = dict(row)
+    data['viewed_at'] = data['viewed_at'].isoformat() if data['viewed_at'] else None
+    return data
+
+
+def stream_csv(rows, chunk_rows=500):
+    """Yield CSV text chunks, header first"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+    writer.writeheader()
+    pending = 0
+    for row in rows:
+        writer.writerow(_values(row))
+        pending += 1
+        if pending >= chunk_rows:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+    yield buffer.getvalue()
+
+
+def stream_ndjson(rows, chunk_rows=500):
+    """Yield newline-delimited JSON chunks"""
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(_values(row), ensure_ascii=False))
+        if len(lines) >= chunk_rows:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+def stream_export(session, export_format='csv', batch_size=1000, **filters):
+    """Chunks for the chosen format"""
+    rows = iter_rows(session, batch_size=batch_size, **filters)
+    if export_format == 'ndjson':
+        return stream_ndjson(rows)
+    return stream_csv(rows)
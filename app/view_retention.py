@@ -0,0 +1,255 @@
+"""
+Retention for raw card views.
+
+Raw ``card_view`` rows are kept for ``VIEW_RETENTION_DAYS``; older days are
+first downsampled into ``card_view_daily`` and only then removed. A day is
+rolled up once: if its aggregate already exists the raw rows are simply
+deleted, so an interrupted run can be repeated safely.
+
+On MySQL, ``card_view`` can be range-partitioned by month
+(``setup_partitions``); fully expired months are then removed with
+``ALTER TABLE ... DROP PARTITION`` instead of row deletes. Everywhere else
+(and for the partially expired month) rows are deleted in id-ordered chunks.
+"""
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import case, func, select, text
+
+from .timezone_utils import now_utc_for_db
+
+
+def retention_cutoff(days):
+    """UTC midnight before which raw views are expired"""
+    today = now_utc_for_db().replace(hour=0, minute=0, second=0, microsecond=0)
+    return today - timedelta(days=days)
+
+
+def rollup_day(session, day, dry_run=False):
+    """Aggregate one UTC day of raw views into card_view_daily; returns cards rolled up"""
+    from .models import CardView, CardViewDaily
+
+    start = datetime.combine(day, datetime.min.time())
+    end = start + timedelta(days=1)
+
+    def device_count(device):
+        return func.coalesce(func.sum(case((CardView.device_type == device, 1), else_=0)), 0)
+
+    rows = session.query(
+        CardView.card_id,
+        func.count(CardView.id).label('views'),
+        func.coalesce(func.sum(CardView.hits), 0).label('hits'),
+        func.count(func.distinct(CardView.ip_address)).label('unique_visitors'),
+        device_count('mobile').label('mobile_views'),
+        device_count('tablet').label('tablet_views'),
+        device_count('desktop').label('desktop_views')
+    ).filter(
+        CardView.viewed_at >= start,
+        CardView.viewed_at < end
+    ).group_by(CardView.card_id).all()
+    if dry_run or not rows:
+        return len(rows)
+
+    session.add_all([
+        CardViewDaily(card_id=row.card_id, day=day, views=row.views, hits=int(row.hits),
+                      unique_visitors=row.unique_visitors, mobile_views=int(row.mobile_views),
+                      tablet_views=int(row.tablet_views), desktop_views=int(row.desktop_views))
+        for row in rows
+    ])
+    session.commit()
+    return len(rows)
+
+
+def rollup_expired(session, cutoff, dry_run=False):
+    """Roll up every expired day that has raw rows and no aggregate yet"""
+    from .models import CardView, CardViewDaily
+
+    oldest = session.query(func.min(CardView.viewed_at)).filter(CardView.viewed_at < cutoff).scalar()
+    if oldest is None:
+        return {'days': 0, 'aggregates': 0}
+
+    done = {day for (day,) in session.query(CardViewDaily.day).filter(
+        CardViewDaily.day >= oldest.date(), CardViewDaily.day < cutoff.date()).distinct()}
+
+    days = 0
+    aggregates = 0
+    day = oldest.date()
+    while day < cutoff.date():
+        if day not in done:
+            cards = rollup_day(session, day, dry_run=dry_run)
+            if cards:
+                days += 1
+                aggregates += cards
+        day += timedelta(days=1)
+    return {'days': days, 'aggregates': aggregates}
+
+
+def delete_expired(session, cutoff, chunk_size=5000, dry_run=False):
+    """Delete raw views older than cutoff in id-ordered chunks"""
+    from .models import CardView
+
+    table = CardView.__table__
+    if dry_run:
+        return session.query(func.count(CardView.id)).filter(CardView.viewed_at < cutoff).scalar()
+
+    deleted = 0
+    while True:
+        ids = session.execute(
+            select(table.c.id).where(table.c.viewed_at < cutoff).order_by(table.c.id).limit(chunk_size)
+        ).scalars().all()
+        if not ids:
+            break
+        session.execute(table.delete().where(table.c.id.in_(ids)))
+        session.commit()
+        deleted += len(ids)
+    return deleted
+
+
+# ---------------------------------------------------------------------------
+# SQLite: deleted pages go to the freelist until VACUUM
+# ---------------------------------------------------------------------------
+
+def sqlite_free_bytes(session):
+    free_pages = session.execute(text('PRAGMA freelist_count')).scalar()
+    page_size = session.execute(text('PRAGMA page_size')).scalar()
+    return free_pages * page_size
+
+
+# ---------------------------------------------------------------------------
+# MySQL: monthly RANGE partitions on viewed_at
+# ---------------------------------------------------------------------------
+
+def _month_start(value):
+    return date(value.year, value.month, 1)
+
+
+def _next_month(value):
+    return date(value.year + (value.month == 12), value.month % 12 + 1, 1)
+
+
+def _partition_name(month):
+    return f'p{month.year}{month.month:02d}'
+
+
+def _partition_month(name):
+    return date(int(name[1:5]), int(name[5:7]), 1)
+
+
+def mysql_partitions(session):
+    """Monthly partitions of card_view as {name: (upper_bound, bytes)}"""
+    rows = session.execute(text(
+        "SELECT PARTITION_NAME, PARTITION_DESCRIPTION, DATA_LENGTH + INDEX_LENGTH "
+        "FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'card_view' AND PARTITION_NAME IS NOT NULL"
+    )).all()
+    return {name: (description, int(size or 0)) for name, description, size in rows}
+
+
+def setup_partitions(session, months_ahead=3):
+    """
+    Convert card_view into a monthly RANGE-partitioned table.
+    MySQL requires the partition column in every unique key and does not allow
+    foreign keys on partitioned tables, so both are adjusted first.
+    """
+    if mysql_partitions(session):
+        return False
+
+    foreign_keys = session.execute(text(
+        "SELECT CONSTRAINT_NAME FROM information_schema.TABLE_CONSTRAINTS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'card_view' AND CONSTRAINT_TYPE = 'FOREIGN KEY'"
+    )).scalars().all()
+    for name in foreign_keys:
+        session.execute(text(f'ALTER TABLE card_view DROP FOREIGN KEY `{name}`'))
+
+    session.execute(text('UPDATE card_view SET viewed_at = UTC_TIMESTAMP() WHERE viewed_at IS NULL'))
+    session.execute(text('ALTER TABLE card_view MODIFY viewed_at DATETIME NOT NULL, '
+                         'DROP PRIMARY KEY, ADD PRIMARY KEY (id, viewed_at)'))
+
+    oldest = session.execute(text('SELECT MIN(viewed_at) FROM card_view')).scalar() or now_utc_for_db()
+    month = _month_start(oldest)
+    last = _month_start(now_utc_for_db())
+    for _ in range(months_ahead):
+        last = _next_month(last)
+
+    definitions = []
+    while month <= last:
+        upper = _next_month(month)
+        definitions.append(f"PARTITION {_partition_name(month)} VALUES LESS THAN (TO_DAYS('{upper}'))")
+        month = upper
+    definitions.append('PARTITION pmax VALUES LESS THAN MAXVALUE')
+
+    session.execute(text('ALTER TABLE card_view PARTITION BY RANGE (TO_DAYS(viewed_at)) ('
+                         + ', '.join(definitions) + ')'))
+    session.commit()
+    return True
+
+
+def add_future_partitions(session, months_ahead=3):
+    """Split pmax so the next months always have their own partition"""
+    existing = mysql_partitions(session)
+    if not existing:
+        return 0
+
+    # REORGANIZE can only append after the highest bounded partition
+    named = sorted(name for name in existing if name != 'pmax')
+    month = _next_month(_partition_month(named[-1])) if named else _month_start(now_utc_for_db())
+    last = _month_start(now_utc_for_db())
+    for _ in range(months_ahead):
+        last = _next_month(last)
+
+    definitions = []
+    while month <= last:
+        definitions.append(f"PARTITION {_partition_name(month)} VALUES LESS THAN (TO_DAYS('{_next_month(month)}'))")
+        month = _next_month(month)
+    if not definitions:
+        return 0
+
+    definitions.append('PARTITION pmax VALUES LESS THAN MAXVALUE')
+    session.execute(text('ALTER TABLE card_view REORGANIZE PARTITION pmax INTO (' + ', '.join(definitions) + ')'))
+    session.commit()
+    return len(definitions) - 1
+
+
+def drop_expired_partitions(session, cutoff, dry_run=False):
+    """Drop monthly partitions that end before cutoff; returns (names, rows, bytes)"""
+    expired = []
+    rows = 0
+    reclaimed = 0
+    for name, (_, size) in sorted(mysql_partitions(session).items()):
+        if name == 'pmax':
+            continue
+        if _next_month(_partition_month(name)) <= cutoff.date():
+            expired.append(name)
+            reclaimed += size
+
+    if expired:
+        names = ', '.join(expired)
+        rows = session.execute(text(f'SELECT COUNT(*) FROM card_view PARTITION ({names})')).scalar()
+        if not dry_run:
+            session.execute(text(f'ALTER TABLE card_view DROP PARTITION {names}'))
+            session.commit()
+    return expired, rows, reclaimed
+
+
+def apply_retention(session, days, chunk_size=5000, dry_run=False):
+    """Roll up and remove raw views older than `days`; returns a report dict"""
+    dialect = session.get_bind().dialect.name
+    cutoff = retention_cutoff(days)
+    report = {'cutoff': cutoff, 'dialect': dialect, 'partitions_dropped': [], 'bytes_reclaimed': 0}
+
+    report.update(rollup_expired(session, cutoff, dry_run=dry_run))
+
+    free_before = sqlite_free_bytes(session) if dialect == 'sqlite' else 0
+    partition_rows = 0
+    if dialect == 'mysql':
+        if not dry_run:
+            add_future_partitions(session)
+        report['partitions_dropped'], partition_rows, report['bytes_reclaimed'] = \
+            drop_expired_partitions(session, cutoff, dry_run)
+
+    # In a dry run the partition rows are still present and counted by delete_expired
+    deleted = delete_expired(session, cutoff, chunk_size=chunk_size, dry_run=dry_run)
+    report['rows_deleted'] = deleted if dry_run else deleted + partition_rows
+
+    if dialect == 'sqlite' and not dry_run:
+        report['bytes_reclaimed'] += sqlite_free_bytes(session) - free_before
+    return report
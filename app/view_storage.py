@@ -0,0 +1,247 @@
+"""
+Compact storage for card_view rows.
+
+Repeated strings (user agent, referrer host, browser, platform) are interned
+into ``view_dimension`` once and referenced by integer id, and visitor IPs
+are kept only as a 16-byte keyed BLAKE2b digest. ``CardView`` still exposes
+``user_agent``/``referrer``/``browser``/``platform``/``ip_address`` as
+read-only strings. ``compact_card_views`` rewrites pre-existing rows in
+id-ordered chunks.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+from sqlalchemy import bindparam, or_, select, update
+from sqlalchemy.exc import IntegrityError
+
+IP_HASH_BYTES = 16
+
+# Column limits, matching the legacy string columns
+DIMENSION_LIMITS = {
+    'user_agent': 500,
+    'referrer_host': 255,
+    'browser': 50,
+    'platform': 50,
+}
+
+
+def referrer_host(referrer):
+    """Lower-cased host of a referrer URL, or None"""
+    if not referrer:
+        return None
+    try:
+        host = urlsplit(referrer.strip()).hostname
+    except ValueError:
+        return None
+    return host or None
+
+
+class DimensionCache:
+    """
+    Per-worker LRU of (kind, value) -> view_dimension.id.
+    Ids of rows this transaction created are kept in the session until it
+    commits; a rollback would otherwise leave ids of rows that never existed.
+    """
+
+    def __init__(self, max_entries=5000):
+        self.max_entries = max_entries
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        _install_session_hooks()
+
+    def get_id(self, session, kind, value):
+        if not value:
+            return None
+        value = value[:DIMENSION_LIMITS[kind]]
+        key = (kind, value)
+
+        with self._lock:
+            dimension_id = self._ids.get(key)
+            if dimension_id is not None:
+                self._ids.move_to_end(key)
+                self.hits += 1
+                return dimension_id
+            self.misses += 1
+
+        pending = session.info.setdefault(PENDING_KEY, {}).setdefault(self, {})
+        if key in pending:
+            return pending[key]
+
+        dimension_id, created = self._load_or_create(session, kind, value)
+        if created:
+            pending[key] = dimension_id  # cached once the transaction commits
+        else:
+            self.remember(key, dimension_id)
+        return dimension_id
+
+    def remember(self, key, dimension_id):
+        with self._lock:
+            self._ids[key] = dimension_id
+            while len(self._ids) > self.max_entries:
+                self._ids.popitem(last=False)
+
+    @staticmethod
+    def _load_or_create(session, kind, value):
+        """(id, created_in_this_transaction)"""
+        from .models import ViewDimension
+
+        value_hash = hashlib.sha1(value.encode('utf-8')).hexdigest()
+        query = select(ViewDimension.id).where(ViewDimension.kind == kind,
+                                               ViewDimension.value_hash == value_hash)
+        dimension_id = session.execute(query).scalar()
+        if dimension_id is not None:
+            return dimension_id, False
+
+        # Another worker may insert the same value concurrently; the unique
+        # constraint decides and the loser reads the winner's id.
+        try:
+            with session.begin_nested():
+                dimension = ViewDimension(kind=kind, value_hash=value_hash, value=value)
+                session.add(dimension)
+            return dimension.id, True
+        except IntegrityError:
+            return session.execute(query).scalar(), False
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._ids), 'hits': self.hits, 'misses': self.misses}
+
+
+PENDING_KEY = 'view_dimension_pending'  # session.info: {DimensionCache: {(kind, value): id}}
+
+
+def _publish_pending(session):
+    if session.in_nested_transaction():
+        return  # a savepoint released; the outer transaction may still roll back
+    for cache, ids in session.info.pop(PENDING_KEY, {}).items():
+        for key, dimension_id in ids.items():
+            cache.remember(key, dimension_id)
+
+
+def _drop_pending(session):
+    if not session.in_nested_transaction():
+        session.info.pop(PENDING_KEY, None)
+
+
+def _install_session_hooks():
+    from sqlalchemy import event
+    from sqlalchemy.orm import Session
+
+    if not event.contains(Session, 'after_commit', _publish_pending):
+        event.listen(Session, 'after_commit', _publish_pending)
+        event.listen(Session, 'after_rollback', _drop_pending)
+
+
+_dimension_cache = None
+_dimension_cache_lock = threading.Lock()
+
+
+def get_dimension_cache():
+    """Process-wide dimension cache sized by VIEW_DIMENSION_CACHE_SIZE"""
+    global _dimension_cache
+    if _dimension_cache is None:
+        from flask import current_app
+        with _dimension_cache_lock:
+            if _dimension_cache is None:
+                _dimension_cache = DimensionCache(current_app.config.get('VIEW_DIMENSION_CACHE_SIZE', 5000))
+    return _dimension_cache
+
+
+def _ip_hash_key():
+    from flask import current_app
+    secret = current_app.config.get('VIEW_IP_HASH_SECRET') or current_app.config.get('SECRET_KEY', '')
+    return hashlib.sha256(secret.encode('utf-8')).digest()
+
+
+def hash_ip(ip_address, key=None):
+    """Fixed-size keyed digest of an IP; same IP and key always give the same bytes"""
+    if not ip_address:
+        return None
+    digest = hashlib.blake2b(ip_address.strip().encode('utf-8'), digest_size=IP_HASH_BYTES,
+                             key=key or _ip_hash_key())
+    return digest.digest()
+
+
+def encode_view_fields(session, user_agent=None, referrer=None, browser=None, platform=None):
+    """Map raw request strings to CardView foreign-key columns"""
+    cache = get_dimension_cache()
+    return {
+        'user_agent_id': cache.get_id(session, 'user_agent', user_agent),
+        'referrer_host_id': cache.get_id(session, 'referrer_host', referrer_host(referrer)),
+        'browser_id': cache.get_id(session, 'browser', browser),
+        'platform_id': cache.get_id(session, 'platform', platform),
+    }
+
+
+def compact_card_views(session, chunk_size=5000, progress=None):
+    """
+    Move legacy string columns of card_view into dimension ids and IP hashes.
+    Works in id order, committing every chunk, so it can be interrupted and rerun.
+    """
+    from .models import CardView
+
+    table = CardView.__table__
+    legacy = [table.c.ip_address, table.c.user_agent, table.c.referrer, table.c.browser, table.c.platform]
+    key = _ip_hash_key()
+
+    statement = update(table).where(table.c.id == bindparam('row_id')).values(
+        ip_hash=bindparam('new_ip_hash'),
+        user_agent_id=bindparam('new_user_agent_id'),
+        referrer_host_id=bindparam('new_referrer_host_id'),
+        browser_id=bindparam('new_browser_id'),
+        platform_id=bindparam('new_platform_id'),
+        ip_address=None, user_agent=None, referrer=None, browser=None, platform=None,
+    )
+
+    converted = 0
+    bytes_before = 0
+    bytes_after = 0
+    last_id = 0
+    while True:
+        rows = session.execute(
+            select(table.c.id, table.c.ip_hash, table.c.user_agent_id, table.c.referrer_host_id,
+                   table.c.browser_id, table.c.platform_id, *legacy)
+            .where(table.c.id > last_id, or_(*[column.isnot(None) for column in legacy]))
+            .order_by(table.c.id)
+            .limit(chunk_size)
+        ).all()
+        if not rows:
+            break
+
+        params = []
+        for row in rows:
+            fields = encode_view_fields(session, row.user_agent, row.referrer, row.browser, row.platform)
+            params.append({
+                'row_id': row.id,
+                'new_ip_hash': row.ip_hash or hash_ip(row.ip_address, key),
+                'new_user_agent_id': row.user_agent_id or fields['user_agent_id'],
+                'new_referrer_host_id': row.referrer_host_id or fields['referrer_host_id'],
+                'new_browser_id': row.browser_id or fields['browser_id'],
+                'new_platform_id': row.platform_id or fields['platform_id'],
+            })
+            bytes_before += sum(len(value or '') for value in
+                                (row.ip_address, row.user_agent, row.referrer, row.browser, row.platform))
+            bytes_after += (IP_HASH_BYTES if row.ip_address else 0) + 4 * 4
+
+        session.execute(statement, params)
+        session.commit()
+
+        converted += len(rows)
+        last_id = rows[-1].id
+        if progress:
+            progress(converted, last_id)
+
+    return {
+        'rows': converted,
+        'string_bytes_before': bytes_before,
+        'bytes_after': bytes_after,
+        'dimensions': get_dimension_cache().stats(),
+    }
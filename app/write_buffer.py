@@ -0,0 +1,118 @@
+"""
+Shared pieces of the batched writers.
+
+- ``upsert``: insert rows or, where the key already exists, add to some
+  columns and overwrite others. One statement on SQLite, PostgreSQL and
+  MySQL; update-then-insert per row on other databases.
+- ``WriteBuffer``: per-worker Counter of pending increments, flushed by
+  size or age. A failed write is put back for the next flush.
+- ``register_exit_flush``: write what a buffer still holds when the worker
+  shuts down.
+"""
+import atexit
+import threading
+import time
+from collections import Counter
+
+from sqlalchemy import select, update
+
+
+def upsert(connection, table, rows, key, increments=(), replace=()):
+    """Insert rows (a list of dicts) into table. Rows whose `key` columns match an
+    existing row add their `increments` columns to it and overwrite `replace`.
+    `connection` may be a Connection or a Session"""
+    if not rows:
+        return
+    bind = connection.get_bind() if hasattr(connection, 'get_bind') else connection
+    dialect = bind.dialect.name
+    key = list(key)
+
+    if dialect in ('sqlite', 'postgresql'):
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert
+        statement = insert(table)
+        changes = _changes(table, statement.excluded, increments, replace)
+        if changes:
+            statement = statement.on_conflict_do_update(index_elements=key, set_=changes)
+        else:
+            statement = statement.on_conflict_do_nothing(index_elements=key)
+    elif dialect == 'mysql':
+        from sqlalchemy.dialects.mysql import insert
+        statement = insert(table)
+        statement = statement.on_duplicate_key_update(
+            _changes(table, statement.inserted, increments, replace) or {key[0]: table.c[key[0]]}
+        )
+    else:
+        for row in rows:
+            match = [table.c[name] == row[name] for name in key]
+            changes = _changes(table, row, increments, replace)
+            if changes:
+                found = connection.execute(update(table).where(*match).values(changes)).rowcount
+            else:
+                found = connection.execute(select(table.c[key[0]]).where(*match)).first() is not None
+            if not found:
+                connection.execute(table.insert().values(**row))
+        return
+    connection.execute(statement, rows)
+
+
+def _changes(table, new, increments, replace):
+    changes = {name: table.c[name] + new[name] for name in increments}
+    changes.update({name: new[name] for name in replace})
+    return changes
+
+
+class WriteBuffer:
+    """Per-worker Counter of increments waiting to be written"""
+
+    def __init__(self, flush_size=None, flush_interval=10):
+        self.flush_size = flush_size  # None: flush by age only
+        self.flush_interval = flush_interval
+        self._pending = Counter()
+        self._pending_since = None
+        self._lock = threading.Lock()
+
+    def _add(self, key, n=1):
+        """Count n for key; the caller holds the lock"""
+        self._pending[key] += n
+        if self._pending_since is None:
+            self._pending_since = time.time()
+
+    def should_flush(self):
+        with self._lock:
+            if not self._pending:
+                return False
+            return ((self.flush_size is not None and sum(self._pending.values()) >= self.flush_size)
+                    or time.time() - self._pending_since >= self.flush_interval)
+
+    def pending(self):
+        with self._lock:
+            return Counter(self._pending)
+
+    def _take(self):
+        """Everything pending, leaving the buffer empty"""
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+            self._pending_since = None
+        return pending
+
+    def _put_back(self, pending):
+        """Keep increments whose write failed for the next attempt"""
+        with self._lock:
+            self._pending.update(pending)
+            if self._pending_since is None:
+                self._pending_since = time.time()
+
+
+def register_exit_flush(app, flush):
+    """Call flush(db) in an app context when the worker shuts down"""
+    def flush_on_exit():
+        from . import db
+        try:
+            with app.app_context():
+                flush(db)
+        except Exception:
+            pass
+    atexit.register(flush_on_exit)
@@ -265,6 +265,452 @@ def create_partner_key(name):
     click.echo('[!] IMPORTANTE: Copia esta clave ahora. No se podra volver a mostrar.')
     click.echo('==================================================\n')
 
+# ============================================================================
+# COMANDOS DE ANALYTICS
+# ============================================================================
+
+@app.cli.command()
+@click.argument('csv_path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--output', default=None, help='Binary database path (default: GEOIP_DATABASE)')
+@click.option('--format', 'csv_format', type=click.Choice(['simple', 'dbip', 'ip2location']), default='simple',
+              help='Column layout of the CSV dump')
+@click.option('--skip-header', is_flag=True, help='Skip the first CSV row')
+def import_geoip(csv_path, output, csv_format, skip_header):
+    """Import a CSV IP-range dump into the binary geolocation database."""
+    import time
+    from app.geoip import build_database, CSV_FORMATS
+
+    output = output or current_app.config['GEOIP_DATABASE']
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+
+    started = time.time()
+    result = build_database(csv_path, output, columns=CSV_FORMATS[csv_format], skip_header=skip_header)
+    elapsed = time.time() - started
+
+    click.echo(f'IPv4 ranges: {result["ipv4_ranges"]}')
+    click.echo(f'IPv6 ranges: {result["ipv6_ranges"]}')
+    click.echo(f'Locations: {result["locations"]}')
+    click.echo(f'Skipped rows: {result["skipped"]}')
+    click.echo(f'Database written to {output} in {elapsed:.1f}s ({os.path.getsize(output)} bytes)')
+
+
+@app.cli.command()
+@click.option('--chunk-size', default=5000, help='Rows converted per transaction')
+@click.option('--vacuum', is_flag=True, help='Reclaim freed space afterwards (VACUUM / OPTIMIZE TABLE)')
+def compact_card_views(chunk_size, vacuum):
+    """Convert legacy card_view strings and IPs into interned ids and hashes."""
+    import time
+    from sqlalchemy import text
+    from app.view_storage import compact_card_views as run_compaction
+
+    started = time.time()
+    result = run_compaction(
+        db.session, chunk_size=chunk_size,
+        progress=lambda rows, last_id: click.echo(f'  {rows} rows converted (last id {last_id})')
+    )
+    elapsed = time.time() - started
+
+    click.echo(f'Rows converted: {result["rows"]}')
+    click.echo(f'Legacy string bytes: {result["string_bytes_before"]} -> {result["bytes_after"]}')
+    click.echo(f'Dimension cache: {result["dimensions"]["entries"]} values, '
+               f'{result["dimensions"]["hits"]} hits / {result["dimensions"]["misses"]} misses')
+    click.echo(f'Done in {elapsed:.1f}s')
+
+    if vacuum and result['rows']:
+        dialect = db.engine.dialect.name
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            if dialect == 'sqlite':
+                conn.execute(text('VACUUM'))
+            elif dialect == 'mysql':
+                conn.execute(text('OPTIMIZE TABLE card_view'))
+        click.echo(f'Storage reclaimed ({dialect})')
+
+
+@app.cli.command()
+@click.option('--days', type=int, default=None, help='Raw retention window (default: VIEW_RETENTION_DAYS)')
+@click.option('--chunk-size', type=int, default=None, help='Rows deleted per transaction')
+@click.option('--dry-run', is_flag=True, help='Only report what would be rolled up and removed')
+@click.option('--setup-partitions', is_flag=True, help='MySQL: convert card_view to monthly partitions first')
+@click.option('--vacuum', is_flag=True, help='SQLite: VACUUM afterwards to shrink the file')
+def apply_view_retention(days, chunk_size, dry_run, setup_partitions, vacuum):
+    """Downsample expired card views into daily aggregates and remove raw rows."""
+    import time
+    from sqlalchemy import text
+    from app.view_retention import apply_retention, setup_partitions as create_partitions
+
+    days = days or current_app.config['VIEW_RETENTION_DAYS']
+    chunk_size = chunk_size or current_app.config['VIEW_RETENTION_CHUNK_SIZE']
+    dialect = db.engine.dialect.name
+
+    if setup_partitions:
+        if dialect != 'mysql':
+            click.echo('Partitioning is only available on MySQL; chunked deletes will be used.')
+        elif create_partitions(db.session):
+            click.echo('card_view converted to monthly partitions.')
+        else:
+            click.echo('card_view is already partitioned.')
+
+    started = time.time()
+    report = apply_retention(db.session, days, chunk_size=chunk_size, dry_run=dry_run)
+    elapsed = time.time() - started
+
+    prefix = '[dry-run] ' if dry_run else ''
+    click.echo(f'{prefix}Retention: {days} days (raw views before {report["cutoff"]:%Y-%m-%d} UTC)')
+    click.echo(f'{prefix}Days rolled up: {report["days"]} ({report["aggregates"]} daily aggregates)')
+    if report['partitions_dropped']:
+        click.echo(f'{prefix}Partitions dropped: {", ".join(report["partitions_dropped"])}')
+    click.echo(f'{prefix}Raw rows removed: {report["rows_deleted"]}')
+    click.echo(f'{prefix}Bytes reclaimed: {report["bytes_reclaimed"]}')
+
+    if vacuum and not dry_run and dialect == 'sqlite' and report['rows_deleted']:
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.execute(text('VACUUM'))
+        click.echo('SQLite file compacted (VACUUM)')
+    click.echo(f'Done in {elapsed:.1f}s')
+
+
+@app.cli.command()
+def rebuild_view_counters():
+    """Recompute per-card daily counters and the popular-cards leaderboard."""
+    import time
+    from app.view_counters import rebuild_counters
+    from app.leaderboard import rebuild_leaderboard
+
+    started = time.time()
+    buckets = rebuild_counters(db.session)
+    board = rebuild_leaderboard(db.session)
+    click.echo(f'Counter buckets: {buckets}')
+    for window, entries in board['windows'].items():
+        click.echo(f'Leaderboard {window}: {len(entries)} cards')
+    click.echo(f'Done in {time.time() - started:.1f}s')
+
+
+@app.cli.command()
+def reconcile_view_counters():
+    """Nightly check of Card/User view counters against card_view (run from cron)."""
+    import time
+    from app.view_counters import reconcile_card_totals
+
+    started = time.time()
+    result = reconcile_card_totals(db.session)
+    click.echo(f'Cards corrected: {result["cards_corrected"]}')
+    click.echo(f'Users corrected: {result["users_corrected"]}')
+    click.echo(f'Done in {time.time() - started:.1f}s')
+
+
+@app.cli.command()
+@click.option('--format', 'export_format', type=click.Choice(['csv', 'ndjson']), default='csv')
+@click.option('--output', default='-', help='Output file (default: stdout)')
+@click.option('--email', default=None, help='Only cards owned by this user')
+@click.option('--card', 'card_slug', default=None, help='Only this card (slug)')
+@click.option('--start', type=click.DateTime(['%Y-%m-%d']), default=None, help='First UTC day')
+@click.option('--end', type=click.DateTime(['%Y-%m-%d']), default=None, help='Last UTC day (inclusive)')
+@click.option('--since', type=click.DateTime(['%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S']), default=None,
+              help='Resume after this viewed_at (from a previous run)')
+@click.option('--after-id', type=int, default=None, help='Resume after this id when viewed_at equals --since')
+@click.option('--batch-size', default=1000, help='Rows fetched per round trip')
+def export_card_views(export_format, output, email, card_slug, start, end, since, after_id, batch_size):
+    """Stream raw card views to CSV/NDJSON without loading them into memory."""
+    import sys
+    import time
+    from datetime import timedelta
+    from app.view_export import iter_rows, stream_csv, stream_ndjson
+
+    card_ids = None
+    if email:
+        user = User.query.filter_by(email=email).first()
+        if not user:
+            click.echo(f'User not found: {email}', err=True)
+            return
+        card_ids = [card.id for card in user.cards]
+    if card_slug:
+        card = Card.query.filter_by(slug=card_slug).first()
+        if not card or (card_ids is not None and card.id not in card_ids):
+            click.echo(f'Card not found: {card_slug}', err=True)
+            return
+        card_ids = [card.id]
+
+    last = {'rows': 0, 'row': None}
+
+    def tracked(rows):
+        for row in rows:
+            last['rows'] += 1
+            last['row'] = row
+            yield row
+
+    rows = tracked(iter_rows(db.session, batch_size=batch_size, card_ids=card_ids, start=start,
+                             end=end + timedelta(days=1) if end else None, since=since, after_id=after_id))
+    chunks = stream_ndjson(rows) if export_format == 'ndjson' else stream_csv(rows)
+
+    started = time.time()
+    out = sys.stdout if output == '-' else open(output, 'w', newline='', encoding='utf-8')
+    try:
+        for chunk in chunks:
+            out.write(chunk)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    click.echo(f'Rows exported: {last["rows"]} in {time.time() - started:.1f}s', err=True)
+    if last['row'] is not None:
+        click.echo(f'Resume with: --since {last["row"]["viewed_at"].isoformat()} --after-id {last["row"]["id"]}', err=True)
+
+
+
+
+@app.cli.command()
+@click.option('--days', type=int, default=None, help='Only the last N days (default: all history)')
+def backfill_funnel_conversions(days):
+    """Rebuild booking/ticket counts of the booking funnel from appointments and tickets."""
+    import time
+    from app.funnel import backfill_conversions
+
+    started = time.time()
+    conversions = backfill_conversions(db.session, days=days)
+    click.echo(f'Conversions counted: {conversions}')
+    click.echo(f'Done in {time.time() - started:.1f}s')
+
+@app.cli.command()
+@click.argument('output')
+@click.option('--gzip', 'compress', is_flag=True, help='Compress on the fly (add .gz to OUTPUT)')
+@click.option('--since', type=click.DateTime(['%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d']),
+              default=None, help='Only rows changed since this UTC time')
+@click.option('--since-manifest', type=click.Path(exists=True), default=None,
+              help='Only rows changed since a previous backup (its file or .manifest.json)')
+def backup_export(output, compress, since, since_manifest):
+    """Stream a full or incremental backup of every table to NDJSON."""
+    import json
+    import time
+    from datetime import datetime
+    from app.backup import iter_backup_chunks, read_manifest
+
+    if since_manifest:
+        if since_manifest.endswith('.manifest.json'):
+            with open(since_manifest, encoding='utf-8') as f:
+                previous = json.load(f)
+        else:
+            previous, end = read_manifest(since_manifest)
+            if previous is None or end is None:
+                click.echo(f'Incomplete backup: {since_manifest}', err=True)
+                return
+        since = datetime.fromisoformat(previous['started_at'])
+
+    started = time.time()
+    report = {}
+    with open(output, 'wb') as out:
+        for chunk in iter_backup_chunks(db.session, since=since, compress=compress, report=report):
+            out.write(chunk)
+    manifest, end = report['manifest'], report['end']
+
+    with open(output + '.manifest.json', 'w', encoding='utf-8') as f:
+        json.dump(dict(manifest, counts=end['counts'], finished_at=end['finished_at']), f, indent=2)
+
+    click.echo(f'Mode: {manifest["mode"]}' + (f' (since {manifest["since"]})' if since else ''))
+    click.echo(f'Rows: {sum(end["counts"].values())} in {len(end["counts"])} tables')
+    click.echo(f'Size: {os.path.getsize(output) / 1024:.1f} KB')
+    click.echo(f'Done in {time.time() - started:.1f}s')
+
+
+@app.cli.command()
+@click.argument('path', type=click.Path(exists=True))
+@click.option('--batch-size', default=1000, help='Rows written per statement')
+@click.option('--yes', is_flag=True, help='Do not ask for confirmation')
+def restore_backup(path, batch_size, yes):
+    """Bulk-load a backup written by backup-export; existing rows are overwritten."""
+    import time
+    from app.backup import restore_backup as restore
+
+    if not yes and not click.confirm(f'Restore {path} into {db.engine.url.render_as_string()}?'):
+        return
+
+    started = time.time()
+    result = restore(db.session, path, batch_size=batch_size)
+    for table, count in result['counts'].items():
+        click.echo(f'{table}: {count}')
+    if result['skipped']:
+        click.echo(f'Rows for unknown tables skipped: {result["skipped"]}')
+    if not result['complete']:
+        click.echo('Warning: backup has no end record (truncated file?)', err=True)
+    click.echo(f'Done in {time.time() - started:.1f}s')
+
+
+@app.cli.command()
+@click.option('--limit', default=None, type=int, help='Top cards to warm (default CACHE_WARM_LIMIT)')
+@click.option('--workers', default=None, type=int, help='Parallel warm-up threads (default CACHE_WARM_WORKERS)')
+@click.option('--budget', default=None, type=float, help='Time budget in seconds (default CACHE_WARM_BUDGET)')
+def warm_cache(limit, workers, budget):
+    """Prefetch top card pages, theme templates and the slug filter into the cache."""
+    from app import cache
+    from app.cache_metrics import unwrap
+    from app.cache_warmup import warm_cache as warm
+
+    backend = type(unwrap(cache.cache)).__name__
+    if backend in ('SimpleCache', 'NullCache'):
+        click.echo(f'Warning: {backend} lives inside this process; workers will not see these entries.', err=True)
+
+    report = warm(app, limit=limit, workers=workers, budget=budget)
+    click.echo(f'Cards warmed: {report["cards"]}')
+    click.echo(f'Templates compiled: {report["templates"]}')
+    click.echo(f'Slug filter built: {"yes" if report["slug_filter"] else "no"}')
+    if report['skipped']:
+        click.echo(f'Skipped: {report["skipped"]}')
+    for failure in report['failed']:
+        click.echo(f'Failed: {failure}', err=True)
+    if report['budget_exceeded']:
+        click.echo('Time budget exhausted before every task ran', err=True)
+    click.echo(f'Done in {report["elapsed"]:.1f}s')
+
+
+@app.cli.command()
+@click.option('--stale-after', default=600, help='Seconds after which a running job is considered abandoned')
+@click.option('--limit', default=100, help='Jobs per pass')
+@click.option('--loop', is_flag=True, help='Keep polling for jobs')
+@click.option('--interval', default=5.0, help='Seconds between passes with --loop')
+@click.option('--purge-days', default=7, help='Delete finished jobs older than this many days')
+def process_image_jobs(stale_after, limit, loop, interval, purge_days):
+    """Run pending and abandoned background image jobs."""
+    import time
+    from app.image_jobs import process_pending, purge_finished
+
+    while True:
+        report = process_pending(db.engine, stale_after=stale_after, limit=limit)
+        if any(report.values()) or not loop:
+            click.echo(f'Done: {report["done"]}, retried: {report["retried"]}, '
+                       f'failed: {report["failed"]}, claimed elsewhere: {report["skipped"]}')
+        if not loop:
+            break
+        time.sleep(interval)
+
+    purged = purge_finished(db.engine, older_than_days=purge_days)
+    if purged:
+        click.echo(f'Finished jobs purged: {purged}')
+
+
+@app.cli.command()
+@click.option('--workers', default=None, type=int, help='Processes (default: one per core)')
+@click.option('--force', is_flag=True, help='Rebuild derivatives that are already up to date')
+def build_image_derivatives(workers, force):
+    """Build responsive WebP/JPEG widths for gallery, product, service and avatar images."""
+    from app.image_derivatives import backfill
+
+    def progress(done, total):
+        if done == total or done % 100 == 0:
+            click.echo(f'  {done}/{total} images processed')
+
+    report = backfill(db.session, workers=workers, force=force, progress=progress)
+    if report is None:
+        click.echo('IMAGE_DERIVATIVES_ENABLED is off; nothing to do.')
+        return
+    click.echo(f'Referenced images: {report["images"]}')
+    click.echo(f'Built: {report["built"]} ({report["files"]} files, {report["bytes"] / 1024 / 1024:.1f} MB)')
+    click.echo(f'Already up to date: {report["current"]}')
+    if report['missing']:
+        click.echo(f'Missing source files: {report["missing"]}')
+    for failure in report['failed']:
+        click.echo(f'Failed: {failure}', err=True)
+    click.echo(f'Done in {report["elapsed"]:.1f}s')
+
+
+@app.cli.command()
+@click.option('--max-bytes', default=None, type=int, help='Size cap (default IMAGE_RESIZE_CACHE_MAX_BYTES)')
+def prune_image_cache(max_bytes):
+    """Evict least recently used on-demand image variants down to the size cap."""
+    from app.image_resize import prune
+
+    root = app.config['IMAGE_RESIZE_CACHE_DIR']
+    cap = max_bytes if max_bytes is not None else app.config['IMAGE_RESIZE_CACHE_MAX_BYTES']
+    report = prune(root, cap)
+    click.echo(f'Cached variants: {report["files"]} ({report["bytes"] / 1024 / 1024:.1f} MB, cap {cap / 1024 / 1024:.1f} MB)')
+    click.echo(f'Removed: {report["removed"]} ({report["freed"] / 1024 / 1024:.1f} MB)')
+
+
+@app.cli.command()
+@click.option('--iterations', default=5, help='Runs per scenario (the median is reported)')
+def benchmark_image_pipeline(iterations):
+    """Compare the upload image pipeline with the previous multi-decode path."""
+    from app.image_benchmark import run_benchmark
+
+    click.echo(f'{"Scenario":<22}{"Input":>10}{"Before ms":>11}{"After ms":>10}{"Speedup":>9}{"Main bytes":>22}')
+    for result in run_benchmark(iterations=iterations):
+        legacy, current = result['legacy'], result['current']
+        click.echo(f'{result["scenario"]:<22}{result["input_bytes"] // 1024:>8}KB'
+                   f'{legacy["median_ms"]:>11}{current["median_ms"]:>10}{result["speedup"]:>8}x'
+                   f'{legacy["main_bytes"]:>11} -> {current["main_bytes"]:<8}')
+
+
+@app.cli.command()
+@click.option('--dry-run', is_flag=True, help='Only report what would be moved and deduplicated')
+def migrate_uploads(dry_run):
+    """Move uploads with random names into the content-addressed layout (cas/ab/cd/<hash>)."""
+    from app.upload_store import migrate_legacy
+
+    report = migrate_legacy(db.session, dry_run=dry_run,
+                            progress=lambda done, total: click.echo(f'  {done}/{total}'))
+    click.echo(f'Files: {report["paths"]} (missing: {report["missing"]}, duplicates: {report["duplicates"]})')
+    click.echo(f'Storage: {report["bytes_before"] / 1024 / 1024:.1f} MB -> {report["bytes_after"] / 1024 / 1024:.1f} MB')
+    if dry_run:
+        click.echo('Dry run: nothing was changed.')
+    else:
+        click.echo(f'Rows updated: {report["rows"]}')
+
+
+@app.cli.command()
+def rebuild_upload_refs():
+    """Recount references to content-addressed uploads (after bulk edits or restores)."""
+    from app.upload_store import rebuild_refcounts
+
+    paths, references = rebuild_refcounts(db.session)
+    click.echo(f'{paths} files, {references} references')
+
+@app.cli.command()
+@click.option('--dry-run', is_flag=True, help='Report orphans without moving anything')
+@click.option('--grace-hours', type=float, default=None, help='Skip files modified more recently (default UPLOAD_GC_GRACE_HOURS)')
+@click.option('--purge-days', type=int, default=None, help='Delete quarantine batches older than this (default UPLOAD_GC_QUARANTINE_DAYS)')
+@click.option('--verbose', is_flag=True, help='List every orphan')
+def gc_uploads(dry_run, grace_hours, purge_days, verbose):
+    """Quarantine uploads, thumbnails and derivatives no row refers to; purge old quarantine."""
+    from app.upload_gc import collect_garbage
+
+    on_orphan = (lambda area, path, size: click.echo(f'  {area}/{path} ({size} bytes)')) if verbose else None
+    report = collect_garbage(db.session, db.engine, grace_hours, purge_days, dry_run, on_orphan)
+    click.echo(f'Referenced paths: {report["references"]}')
+    for area in ('uploads', 'thumbs', 'derived'):
+        stats = report[area]
+        click.echo(f'{area:<8} scanned {stats["scanned"]:>7}  orphans {stats["orphans"]:>6} '
+                   f'({stats["bytes"] / 1024 / 1024:.1f} MB)  too recent {stats["recent"]}')
+    quarantine = report['quarantine']
+    click.echo(f'Quarantine: {quarantine["batches"]} old batches, {quarantine["purged"]} files deleted '
+               f'({quarantine["purged_bytes"] / 1024 / 1024:.1f} MB), {quarantine["restored"]} restored')
+    if dry_run:
+        click.echo('Dry run: nothing was moved or deleted.')
+    elif report['batch']:
+        click.echo(f'Quarantined into {report["batch"]}')
+    click.echo(f'Elapsed: {report["elapsed"]}s')
+
+@app.cli.command()
+@click.option('--workers', default=None, type=int, help='Processes (default: one per CPU)')
+@click.option('--force', is_flag=True, help='Ignore the manifest and look at every file again')
+@click.option('--max-dim', default=None, type=int, help='Longest side (default IMAGE_OPTIMIZE_MAX_DIM)')
+def optimize_images(workers, force, max_dim):
+    """Recompress uploads (under new names) and thumbnails in parallel."""
+    from app.image_optimizer import optimize_uploads
+
+    def progress(done, total):
+        if done == total or done % 100 == 0:
+            click.echo(f'  {done}/{total} files processed')
+
+    report = optimize_uploads(workers=workers, force=force, max_dim=max_dim, progress=progress)
+    click.echo(f'Files: {report["files"]} ({report["current"]} unchanged since the last run)')
+    click.echo(f'Recompressed: {report["optimized"]}, already optimal: {report["kept"]}, '
+               f'touched only: {report["unchanged"]}, unsupported: {report["skipped"]}, '
+               f'unreferenced: {report["unreferenced"]}')
+    click.echo(f'Rows pointed at recompressed uploads: {report["rows"]}')
+    click.echo(f'Saved: {report["bytes_saved"] / 1024 / 1024:.2f} MB '
+               f'({report["bytes_before"] / 1024 / 1024:.2f} MB -> {report["bytes_after"] / 1024 / 1024:.2f} MB)')
+    click.echo(f'Throughput: {report["files_per_second"]} files/s, {report["mb_per_second"]} MB/s '
+               f'in {report["elapsed"]:.1f}s')
+    for failure in report['failed']:
+        click.echo(f'Failed: {failure}', err=True)
 
 if __name__ == '__main__':
     app.cli()
\ No newline at end of file
@@ -0,0 +1,47 @@
+"""Drop live_card_second and live_card_visitor; live viewers are shared through the cache
+
+Revision ID: a4d6f8b0c2e3
+Revises: f3c5e7a9b1d2
+Create Date: 2026-10-20 11:02:15.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4d6f8b0c2e3'
+down_revision = 'f3c5e7a9b1d2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('live_card_visitor', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_live_card_visitor_last_seen'))
+
+    op.drop_table('live_card_visitor')
+    with op.batch_alter_table('live_card_second', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_live_card_second_second'))
+
+    op.drop_table('live_card_second')
+
+
+def downgrade():
+    op.create_table('live_card_second',
+    sa.Column('card_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('second', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('hits', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('card_id', 'second')
+    )
+    with op.batch_alter_table('live_card_second', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_live_card_second_second'), ['second'], unique=False)
+
+    op.create_table('live_card_visitor',
+    sa.Column('card_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('visitor', sa.String(length=32), nullable=False),
+    sa.Column('last_seen', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('card_id', 'visitor')
+    )
+    with op.batch_alter_table('live_card_visitor', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_live_card_visitor_last_seen'), ['last_seen'], unique=False)
@@ -0,0 +1,35 @@
+"""Add cache_invalidation change-sequence table
+
+Revision ID: a7c9e1b3d5f2
+Revises: f3a5c7e9b1d4
+Create Date: 2026-10-19 17:05:33.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7c9e1b3d5f2'
+down_revision = 'f3a5c7e9b1d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('cache_invalidation',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('key', sa.String(length=255), nullable=False),
+    sa.Column('origin', sa.String(length=32), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('cache_invalidation', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_cache_invalidation_created_at'), ['created_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('cache_invalidation', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_cache_invalidation_created_at'))
+
+    op.drop_table('cache_invalidation')
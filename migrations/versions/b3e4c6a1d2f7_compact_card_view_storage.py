@@ -0,0 +1,54 @@
+"""Compact card_view storage: interned strings and hashed IPs
+
+Revision ID: b3e4c6a1d2f7
+Revises: f855b5b6e1d5
+Create Date: 2026-10-19 11:40:05.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3e4c6a1d2f7'
+down_revision = 'f855b5b6e1d5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('view_dimension',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.String(length=20), nullable=False),
+    sa.Column('value_hash', sa.String(length=40), nullable=False),
+    sa.Column('value', sa.String(length=500), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('kind', 'value_hash', name='uq_view_dimension_kind_hash')
+    )
+
+    # Legacy string columns stay until `flask compact-card-views` has emptied them
+    with op.batch_alter_table('card_view', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('ip_hash', sa.LargeBinary(length=16), nullable=True))
+        batch_op.add_column(sa.Column('user_agent_id', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('referrer_host_id', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('browser_id', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('platform_id', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key('fk_card_view_user_agent', 'view_dimension', ['user_agent_id'], ['id'])
+        batch_op.create_foreign_key('fk_card_view_referrer_host', 'view_dimension', ['referrer_host_id'], ['id'])
+        batch_op.create_foreign_key('fk_card_view_browser', 'view_dimension', ['browser_id'], ['id'])
+        batch_op.create_foreign_key('fk_card_view_platform', 'view_dimension', ['platform_id'], ['id'])
+
+
+def downgrade():
+    with op.batch_alter_table('card_view', schema=None) as batch_op:
+        batch_op.drop_constraint('fk_card_view_platform', type_='foreignkey')
+        batch_op.drop_constraint('fk_card_view_browser', type_='foreignkey')
+        batch_op.drop_constraint('fk_card_view_referrer_host', type_='foreignkey')
+        batch_op.drop_constraint('fk_card_view_user_agent', type_='foreignkey')
+        batch_op.drop_column('platform_id')
+        batch_op.drop_column('browser_id')
+        batch_op.drop_column('referrer_host_id')
+        batch_op.drop_column('user_agent_id')
+        batch_op.drop_column('ip_hash')
+
+    op.drop_table('view_dimension')
@@ -0,0 +1,42 @@
+"""Add cache_metric_daily for per-family cache counters
+
+Revision ID: b8d0f2a4c6e7
+Revises: a7c9e1b3d5f2
+Create Date: 2026-10-19 18:42:07.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8d0f2a4c6e7'
+down_revision = 'a7c9e1b3d5f2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('cache_metric_daily',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('family', sa.String(length=64), nullable=False),
+    sa.Column('gets', sa.BigInteger(), nullable=False),
+    sa.Column('hits', sa.BigInteger(), nullable=False),
+    sa.Column('misses', sa.BigInteger(), nullable=False),
+    sa.Column('sets', sa.BigInteger(), nullable=False),
+    sa.Column('deletes', sa.BigInteger(), nullable=False),
+    sa.Column('bytes_set', sa.BigInteger(), nullable=False),
+    sa.Column('evictions', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('family', 'day', name='uq_cache_metric_daily_family_day')
+    )
+    with op.batch_alter_table('cache_metric_daily', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_cache_metric_daily_day'), ['day'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('cache_metric_daily', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_cache_metric_daily_day'))
+
+    op.drop_table('cache_metric_daily')
@@ -0,0 +1,42 @@
+"""Add card_view_daily aggregates for raw view retention
+
+Revision ID: c5a7e9d2b4f1
+Revises: b3e4c6a1d2f7
+Create Date: 2026-10-19 12:25:31.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5a7e9d2b4f1'
+down_revision = 'b3e4c6a1d2f7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('card_view_daily',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('card_id', sa.Integer(), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('views', sa.Integer(), nullable=False),
+    sa.Column('hits', sa.Integer(), nullable=False),
+    sa.Column('unique_visitors', sa.Integer(), nullable=False),
+    sa.Column('mobile_views', sa.Integer(), nullable=False),
+    sa.Column('tablet_views', sa.Integer(), nullable=False),
+    sa.Column('desktop_views', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['card_id'], ['card.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('card_id', 'day', name='uq_card_view_daily_card_day')
+    )
+    with op.batch_alter_table('card_view_daily', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_card_view_daily_day'), ['day'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('card_view_daily', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_card_view_daily_day'))
+
+    op.drop_table('card_view_daily')
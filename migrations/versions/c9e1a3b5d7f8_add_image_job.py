@@ -0,0 +1,48 @@
+"""Add image_job for background upload processing
+
+Revision ID: c9e1a3b5d7f8
+Revises: b8d0f2a4c6e7
+Create Date: 2026-10-19 20:15:32.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c9e1a3b5d7f8'
+down_revision = 'b8d0f2a4c6e7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('image_job',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('kind', sa.String(length=20), nullable=False),
+    sa.Column('filename', sa.String(length=255), nullable=False),
+    sa.Column('staging_path', sa.String(length=500), nullable=False),
+    sa.Column('params', sa.Text(), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('error', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('started_at', sa.DateTime(), nullable=True),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('image_job', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_image_job_filename'), ['filename'], unique=False)
+        batch_op.create_index(batch_op.f('ix_image_job_status'), ['status'], unique=False)
+        batch_op.create_index(batch_op.f('ix_image_job_user_id'), ['user_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('image_job', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_image_job_user_id'))
+        batch_op.drop_index(batch_op.f('ix_image_job_status'))
+        batch_op.drop_index(batch_op.f('ix_image_job_filename'))
+
+    op.drop_table('image_job')
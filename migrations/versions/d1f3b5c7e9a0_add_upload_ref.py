@@ -0,0 +1,32 @@
+"""Add upload_ref for content-addressed upload reference counts
+
+Revision ID: d1f3b5c7e9a0
+Revises: c9e1a3b5d7f8
+Create Date: 2026-10-19 22:03:11.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd1f3b5c7e9a0'
+down_revision = 'c9e1a3b5d7f8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('upload_ref',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('path', sa.String(length=255), nullable=False),
+    sa.Column('refcount', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('path')
+    )
+
+
+def downgrade():
+    op.drop_table('upload_ref')
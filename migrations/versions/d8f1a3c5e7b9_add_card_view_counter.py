@@ -0,0 +1,52 @@
+"""Add card_view_counter daily buckets for maintained view counters
+
+Revision ID: d8f1a3c5e7b9
+Revises: c5a7e9d2b4f1
+Create Date: 2026-10-19 13:10:47.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd8f1a3c5e7b9'
+down_revision = 'c5a7e9d2b4f1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('card_view_counter',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('card_id', sa.Integer(), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('views', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['card_id'], ['card.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('card_id', 'day', name='uq_card_view_counter_card_day')
+    )
+    with op.batch_alter_table('card_view_counter', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_card_view_counter_day'), ['day'], unique=False)
+
+    # Backfill from raw and archived views so the leaderboard and top cards
+    # are right from the first request (same result as `flask rebuild-view-counters`)
+    card_view = sa.table('card_view', sa.column('card_id'), sa.column('viewed_at'))
+    card_view_daily = sa.table('card_view_daily', sa.column('card_id'), sa.column('day'), sa.column('views'))
+    counter = sa.table('card_view_counter', sa.column('card_id'), sa.column('day'), sa.column('views'))
+
+    raw_day = sa.func.date(card_view.c.viewed_at)
+    raw = sa.select(card_view.c.card_id, raw_day.label('day'), sa.func.count().label('views')).where(
+        card_view.c.viewed_at.isnot(None)).group_by(card_view.c.card_id, raw_day)
+    archived = sa.select(card_view_daily.c.card_id, card_view_daily.c.day, card_view_daily.c.views)
+    views = sa.union_all(raw, archived).subquery()
+    op.execute(counter.insert().from_select(
+        ['card_id', 'day', 'views'],
+        sa.select(views.c.card_id, views.c.day, sa.func.sum(views.c.views)).group_by(views.c.card_id, views.c.day)))
+
+
+def downgrade():
+    with op.batch_alter_table('card_view_counter', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_card_view_counter_day'))
+
+    op.drop_table('card_view_counter')
@@ -0,0 +1,47 @@
+"""Add live_card_second and live_card_visitor for cross-worker live viewers
+
+Revision ID: e2a4c6e8f0b1
+Revises: d1f3b5c7e9a0
+Create Date: 2026-10-19 23:18:40.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2a4c6e8f0b1'
+down_revision = 'd1f3b5c7e9a0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('live_card_second',
+    sa.Column('card_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('second', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('hits', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('card_id', 'second')
+    )
+    with op.batch_alter_table('live_card_second', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_live_card_second_second'), ['second'], unique=False)
+
+    op.create_table('live_card_visitor',
+    sa.Column('card_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('visitor', sa.String(length=32), nullable=False),
+    sa.Column('last_seen', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('card_id', 'visitor')
+    )
+    with op.batch_alter_table('live_card_visitor', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_live_card_visitor_last_seen'), ['last_seen'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('live_card_visitor', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_live_card_visitor_last_seen'))
+
+    op.drop_table('live_card_visitor')
+    with op.batch_alter_table('live_card_second', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_live_card_second_second'))
+
+    op.drop_table('live_card_second')
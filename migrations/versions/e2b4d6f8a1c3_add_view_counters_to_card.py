@@ -0,0 +1,47 @@
+"""Add maintained view counters to card
+
+Revision ID: e2b4d6f8a1c3
+Revises: d8f1a3c5e7b9
+Create Date: 2026-10-19 13:52:09.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2b4d6f8a1c3'
+down_revision = 'd8f1a3c5e7b9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('card', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('views_total', sa.Integer(), nullable=False, server_default='0'))
+        batch_op.add_column(sa.Column('views_today', sa.Integer(), nullable=False, server_default='0'))
+        batch_op.add_column(sa.Column('views_month', sa.Integer(), nullable=False, server_default='0'))
+        batch_op.add_column(sa.Column('views_counted_on', sa.Date(), nullable=True))
+
+    # Backfill totals; today/month are filled by `flask reconcile-view-counters`
+    card = sa.table('card', sa.column('id'), sa.column('owner_id'), sa.column('views_total'))
+    card_view = sa.table('card_view', sa.column('card_id'))
+    card_view_daily = sa.table('card_view_daily', sa.column('card_id'), sa.column('views'))
+    user = sa.table('user', sa.column('id'), sa.column('total_views'))
+
+    raw = sa.select(sa.func.count()).where(card_view.c.card_id == card.c.id).scalar_subquery()
+    archived = sa.select(sa.func.coalesce(sa.func.sum(card_view_daily.c.views), 0)).where(
+        card_view_daily.c.card_id == card.c.id).scalar_subquery()
+    op.execute(card.update().values(views_total=raw + archived))
+
+    owned = sa.select(sa.func.coalesce(sa.func.sum(card.c.views_total), 0)).where(
+        card.c.owner_id == user.c.id).scalar_subquery()
+    op.execute(user.update().values(total_views=owned))
+
+
+def downgrade():
+    with op.batch_alter_table('card', schema=None) as batch_op:
+        batch_op.drop_column('views_counted_on')
+        batch_op.drop_column('views_month')
+        batch_op.drop_column('views_today')
+        batch_op.drop_column('views_total')
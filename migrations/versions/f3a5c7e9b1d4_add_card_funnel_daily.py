@@ -0,0 +1,39 @@
+"""Add card_funnel_daily for booking funnel events
+
+Revision ID: f3a5c7e9b1d4
+Revises: e2b4d6f8a1c3
+Create Date: 2026-10-19 15:20:12.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3a5c7e9b1d4'
+down_revision = 'e2b4d6f8a1c3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('card_funnel_daily',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('card_id', sa.Integer(), nullable=False),
+    sa.Column('service_id', sa.Integer(), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('stage', sa.String(length=20), nullable=False),
+    sa.Column('events', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['card_id'], ['card.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('card_id', 'service_id', 'day', 'stage', name='uq_card_funnel_daily_key')
+    )
+    with op.batch_alter_table('card_funnel_daily', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_card_funnel_daily_day'), ['day'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('card_funnel_daily', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_card_funnel_daily_day'))
+
+    op.drop_table('card_funnel_daily')
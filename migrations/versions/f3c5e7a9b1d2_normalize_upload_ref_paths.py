@@ -0,0 +1,44 @@
+"""Count upload references under paths relative to static/uploads
+
+Revision ID: f3c5e7a9b1d2
+Revises: e2a4c6e8f0b1
+Create Date: 2026-10-20 10:14:36.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3c5e7a9b1d2'
+down_revision = 'e2a4c6e8f0b1'
+branch_labels = None
+depends_on = None
+
+PREFIXES = ('static/uploads/', 'uploads/')
+
+
+def upgrade():
+    # Service images from the mobile API were counted as 'uploads/cas/..',
+    # the same files as 'cas/..' elsewhere; fold them together
+    upload_ref = sa.table('upload_ref', sa.column('path'), sa.column('refcount'))
+    connection = op.get_bind()
+    prefixed = connection.execute(
+        sa.select(upload_ref.c.path, upload_ref.c.refcount)
+        .where(sa.or_(*[upload_ref.c.path.startswith(prefix) for prefix in PREFIXES]))
+    ).all()
+    for path, refcount in prefixed:
+        prefix = next(prefix for prefix in PREFIXES if path.startswith(prefix))
+        target = path[len(prefix):]
+        merged = connection.execute(
+            upload_ref.update().where(upload_ref.c.path == target)
+            .values(refcount=upload_ref.c.refcount + refcount)
+        ).rowcount
+        if merged:
+            connection.execute(upload_ref.delete().where(upload_ref.c.path == path))
+        else:
+            connection.execute(upload_ref.update().where(upload_ref.c.path == path).values(path=target))
+
+
+def downgrade():
+    pass
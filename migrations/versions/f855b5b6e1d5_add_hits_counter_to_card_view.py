@@ -0,0 +1,26 @@
+"""Add hits counter to card_view for session-window deduplication
+
+Revision ID: f855b5b6e1d5
+Revises: 80eca5ede607, 9f1a2b3c4d5e
+Create Date: 2026-10-19 10:12:41.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f855b5b6e1d5'
+down_revision = ('80eca5ede607', '9f1a2b3c4d5e')
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('card_view', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('hits', sa.Integer(), nullable=False, server_default='1'))
+
+
+def downgrade():
+    with op.batch_alter_table('card_view', schema=None) as batch_op:
+        batch_op.drop_column('hits')
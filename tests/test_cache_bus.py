@@ -0,0 +1,116 @@
+"""
+Cross-process check of the cache invalidation bus (app.cache_bus).
+
+Each process is a separate app worker with its own SimpleCache, all of
+them on one SQLite file. One worker saves a card and a theme and clears
+their caches. Every other worker must drop its local copies within one
+CACHE_BUS_POLL_INTERVAL, and keep keys that were not invalidated.
+"""
+import multiprocessing
+import os
+import queue
+import time
+
+POLL_INTERVAL = 0.5
+SLACK = 0.5  # process scheduling and the poll query itself
+LISTENERS = 2
+
+
+def _make_app(db_path):
+    # The database URL is read when app.config is imported, hence the late imports
+    os.environ['DATABASE_URL'] = f'sqlite:///{db_path}'
+    os.environ['CACHE_TYPE'] = 'simple'
+    os.environ['CACHE_BUS_POLL_INTERVAL'] = str(POLL_INTERVAL)
+    from app import create_app
+
+    app = create_app('production')
+    app.config['CACHE_WARM_ON_START'] = False
+    return app
+
+
+def _poll(app):
+    """What every request does first"""
+    with app.test_request_context('/'):
+        app.preprocess_request()
+
+
+def _publisher(db_path, ids, ready, published):
+    from app import db
+    from app.cache_utils import clear_card_cache, clear_theme_cache
+    from app.models import Card, Theme, User
+
+    app = _make_app(db_path)
+    with app.app_context():
+        db.create_all()
+        user = User(email='owner@example.com', role='user', is_approved=True)
+        user.set_password('pw')
+        db.session.add(user)
+        db.session.flush()
+        theme = Theme(name='Bus', template_name='classic')
+        db.session.add(theme)
+        db.session.flush()
+        card = Card(owner_id=user.id, name='Bus Card', theme_id=theme.id, is_public=True)
+        card.generate_slug()
+        db.session.add(card)
+        db.session.commit()
+        for _ in range(LISTENERS):
+            ids.put((card.id, card.slug, theme.id))
+
+        for _ in range(LISTENERS):
+            ready.get(timeout=60)
+
+        card.name = 'Bus Card 2'
+        db.session.commit()
+        clear_card_cache(card.id)
+        clear_theme_cache(theme.id)
+        published.put(time.time())
+
+
+def _listener(db_path, ids, ready, results):
+    from app import cache
+
+    card_id, slug, theme_id = ids.get(timeout=60)
+    app = _make_app(db_path)
+    with app.app_context():
+        invalidated = [f'card_data_{slug}', f'card_services_{card_id}', f'theme_{theme_id}']
+        cache.set_many({key: 'stale' for key in invalidated})
+        cache.set('unrelated', 'kept')
+        _poll(app)  # a fresh worker starts from the current end of the sequence
+        ready.put(os.getpid())
+
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            _poll(app)
+            if all(cache.get(key) is None for key in invalidated):
+                results.put((time.time(), cache.get('unrelated')))
+                return
+            time.sleep(0.02)
+        results.put((None, cache.get('unrelated')))
+
+
+def test_invalidation_reaches_every_worker(tmp_path):
+    db_path = str(tmp_path / 'bus.db')
+    context = multiprocessing.get_context('spawn')
+    ids, ready, published, results = (context.Queue() for _ in range(4))
+
+    processes = [context.Process(target=_publisher, args=(db_path, ids, ready, published))]
+    processes += [context.Process(target=_listener, args=(db_path, ids, ready, results))
+                  for _ in range(LISTENERS)]
+    for process in processes:
+        process.start()
+    try:
+        published_at = published.get(timeout=90)
+        for _ in range(LISTENERS):
+            try:
+                evicted_at, unrelated = results.get(timeout=30)
+            except queue.Empty:
+                raise AssertionError('a worker never reported back')
+            assert evicted_at is not None, 'a worker kept invalidated keys'
+            assert evicted_at - published_at <= POLL_INTERVAL + SLACK
+            assert unrelated == 'kept'
+    finally:
+        for process in processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+    assert all(process.exitcode == 0 for process in processes)